@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Scenario results held as their differences from a base (BAU) frame. Only the rows an
+intervention changed are kept for each scenario, and within them only the changed years are
+stored, as sparse columns filled with zero; so memory grows with the interventions applied
+rather than with scenarios times the portfolio
+"""
+
+import numpy as np
+import pandas as pd
+
+import pathwayFunctions as path
+
+
+class ScenarioDeltas:
+    def __init__(self, base: pd.DataFrame, base_name: str = 'BAU', full: dict = None, listed: bool = True):
+        """
+        base is the base scenario's frame (UID on the first index level, years on the columns).
+        full holds scenarios kept whole, such as the targets, by name. With listed unset, the base
+        is only the reference of the deltas, and not one of the scenarios
+        """
+        self.base = base
+        self.base_name = base_name
+        self.listed = listed
+        self.full = dict(full or {})
+        self.deltas = {}
+        self.names = [base_name, *self.full] if listed else list(self.full)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self.names
+
+    def add(self, name: str, frame: pd.DataFrame, reference: pd.DataFrame = None):
+        """
+        Stores a scenario as its difference from reference (by default the base), which holds
+        the same rows as frame would have without the scenario. Rows not differing in any year
+        are dropped; NaN is taken as zero in those kept
+        """
+        reference = self.base if reference is None else reference
+        columns = self.base.columns
+        values = (np.nan_to_num(frame.reindex(columns=columns).to_numpy(dtype=float))
+                  - np.nan_to_num(reference.reindex(index=frame.index, columns=columns).to_numpy(dtype=float)))
+        changed = (values != 0).any(axis=1)
+        self.deltas[name] = path.to_sparse(values[changed], frame.index[changed], columns)
+        self.names.append(name)
+
+    def changed(self, name: str) -> pd.Index:
+        """
+        UIDs whose rows in the scenario differ from the base
+        """
+        if name in self.deltas:
+            return self.deltas[name].index.unique('UID')
+        if name in self.full:
+            return self.full[name].index.unique('UID')
+        return self.base.index[:0].unique('UID')
+
+    @staticmethod
+    def _rows(frame: pd.DataFrame, uids) -> pd.DataFrame:
+        if uids is None:
+            return frame
+        return frame[frame.index.get_level_values('UID').isin(uids)]
+
+    def scenario(self, name: str, uids=None) -> pd.DataFrame:
+        """
+        The scenario's full frame, or its rows of the given UIDs
+        """
+        if name in self.full:
+            return ScenarioDeltas._rows(self.full[name], uids).copy()
+        base = ScenarioDeltas._rows(self.base, uids)
+        if name == self.base_name:
+            return base.copy()
+
+        delta = ScenarioDeltas._rows(self.deltas[name], uids)
+        positions = base.index.get_indexer(delta.index)
+        known = positions >= 0
+        changes = delta.to_numpy(dtype=float)
+
+        values = base.to_numpy(dtype=float, copy=True)
+        values[positions[known]] = np.nan_to_num(values[positions[known]]) + changes[known]
+        frame = pd.DataFrame(values, index=base.index, columns=base.columns)
+        if not known.all():
+            # Rows absent from the base start from zero
+            frame = pd.concat([frame, pd.DataFrame(changes[~known], index=delta.index[~known],
+                                                   columns=base.columns)]).sort_index()
+        return frame
+
+    def to_frame(self, scenarios=None, uids=None) -> pd.DataFrame:
+        """
+        The full frames of the scenarios (by default all) under a Scenario level, as
+        Model.apply_interventions returns them without deltas
+        """
+        names = [name for name in self.names if scenarios is None or name in scenarios]
+        return pd.concat([self.scenario(name, uids) for name in names], keys=names, names=['Scenario'])
+
+    def to_long(self) -> pd.DataFrame:
+        """
+        The base and full scenarios' rows, followed by the changed rows of the others holding their
+        deltas, under a Scenario level; from_long reverses it. The base is included even if not listed
+        """
+        frames = [self.base, *self.full.values(),
+                  *(delta.sparse.to_dense() for delta in self.deltas.values())]
+        return pd.concat(frames, keys=[self.base_name, *self.full, *self.deltas], names=['Scenario'])
+
+    @classmethod
+    def from_long(cls, frame: pd.DataFrame, base_name: str = 'BAU', full=(), names=None,
+                  listed: bool = True) -> 'ScenarioDeltas':
+        """
+        Splits a frame written by to_long, under its Scenario level, back into the base, the full
+        scenarios and the deltas (whose rows are stored sparse again). names gives the order of
+        the scenarios, including any with no rows; by default, that of the frame
+        """
+        parts = {str(name): part.droplevel('Scenario')
+                 for name, part in frame.groupby(level='Scenario', sort=False, observed=True)}
+        empty = frame.iloc[:0].droplevel('Scenario')
+        deltas = cls(parts.get(base_name, empty), base_name, {name: parts.get(name, empty) for name in full}, listed)
+        for name in (names if names is not None else parts):
+            if name in deltas.names or name == base_name:
+                continue
+            part = parts.get(name, empty)
+            deltas.deltas[name] = path.to_sparse(part.to_numpy(dtype=float), part.index, part.columns)
+            deltas.names.append(name)
+        return deltas
+
+    def aggregate(self, levels: list, asset_data: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        Sums every listed scenario down to the given levels (Scenario first), a scenario held as
+        deltas being the base's sums plus its deltas'. Levels not on the index, such as Country
+        Code, are looked up by UID in asset_data
+        """
+        lookups = [level for level in levels if level not in self.base.index.names]
+        attributes = asset_data.set_index('UID')[lookups] if lookups else None
+
+        def sums(frame: pd.DataFrame) -> pd.DataFrame:
+            if lookups:
+                uids = frame.index.get_level_values('UID')
+                frame = frame.set_index([pd.Index(attributes[level].reindex(uids).to_numpy(), name=level)
+                                         for level in lookups], append=True)
+            summed = path.aggregate(frame, levels)
+            return summed.sparse.to_dense() if path.is_sparse(summed) else summed
+
+        base = sums(self.base)
+        parts = {self.base_name: base} if self.listed else {}
+        parts.update((name, sums(frame)) for name, frame in self.full.items())
+        for name, delta in self.deltas.items():
+            parts[name] = base.add(sums(delta), fill_value=0) if len(delta) else base
+        return pd.concat([parts[name] for name in self.names], keys=self.names, names=['Scenario'])
+
+    @property
+    def nbytes(self) -> int:
+        frames = [self.base, *self.full.values(), *self.deltas.values()]
+        return int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised intervention engine. A scenario's whole intervention list is compiled
+into linear operators over the (Utility, Use) axis of each asset, which are then
+applied to a split consumption frame in a single pass rather than one frame copy
+per intervention
+"""
+
+import numpy as np
+import pandas as pd
+import ReferenceData as data
+import pathwayFunctions as path
+from Ledger import ImpactLedger
+from Profiling import profiled, profiler, row_count
+
+
+def EfficiencyOperator(intervention_type: str, axis: pd.MultiIndex, parameters: pd.DataFrame = None) -> np.ndarray:
+    """
+    Diagonal operator scaling each (Utility, Use) row by one minus its efficiency saving
+    """
+    parameters = data.efficiency_parameters if parameters is None else parameters
+    savings = (parameters[intervention_type]
+               .reindex(axis)
+               .fillna(0)
+               .to_numpy(dtype=float)
+               )
+    return np.diag(1 - savings)
+
+
+def ReassignmentOperator(intervention_type: str, axis: pd.MultiIndex, parameters: pd.DataFrame = None) -> np.ndarray:
+    """
+    Transfer operator moving consumption between (Utility, Use) rows, with the CoP as divisor.
+    Rows are applied in sheet order, as each one overwrites the destination and zeroes the source
+    """
+    parameters = data.reassignment_parameters if parameters is None else parameters
+    operator = np.eye(len(axis))
+    for row in parameters[parameters['Type'] == intervention_type].itertuples():
+        source = axis.get_loc((row.FromUtility, row.FromUse))
+        destination = axis.get_loc((row.ToUtility, row.ToUse))
+        step = np.eye(len(axis))
+        step[destination] = 0
+        step[destination, source] = 1 / row.CoP
+        step[source] = 0
+        operator = step @ operator
+    return operator
+
+
+operator_constructors = {'Efficiency': EfficiencyOperator,
+                         'Relative Reassignment': ReassignmentOperator}
+
+_operators = {}
+
+
+def compile_operator(intervention_type: str, kind: str, axis: pd.MultiIndex) -> np.ndarray:
+    """
+    Returns the operator for an intervention type over a (Utility, Use) axis, compiling it from
+    the reference parameters the first time it is asked for. The (Utility, Use) axis only has a
+    handful of rows, so operators are held as small dense matrices
+    """
+    key = (intervention_type, kind, tuple(axis))
+    if key not in _operators:
+        _operators[key] = operator_constructors[kind](intervention_type, axis)
+    return _operators[key]
+
+
+def available_types(constructors: dict) -> list:
+    """
+    The intervention types for which the reference data holds parameters
+    """
+    return [intervention_type for intervention_type, kind in constructors.items()
+            if (intervention_type in data.efficiency_parameters.columns if kind == 'Efficiency'
+                else (data.reassignment_parameters['Type'] == intervention_type).any())]
+
+
+def clear_operators():
+    """
+    Drops compiled operators, to be called if the reference parameters are changed
+    """
+    _operators.clear()
+
+
+def fuse(types, constructors: dict, axis: pd.MultiIndex) -> np.ndarray:
+    """
+    Composes the operators of a sequence of intervention types, first applied first,
+    into the single operator for the whole chain
+    """
+    operator = np.eye(len(axis))
+    for intervention_type in types:
+        operator = compile_operator(intervention_type, constructors[intervention_type], axis) @ operator
+    return operator
+
+
+class Chains:
+    """
+    Interns ordered sequences of intervention types per asset, storing the fused
+    operator for each distinct sequence. Id 0 is the empty chain (identity)
+    """
+
+    def __init__(self, axis: pd.MultiIndex, constructors: dict):
+        self.axis = axis
+        self.constructors = constructors
+        self.ids = {(): 0}
+        self.matrices = [np.eye(len(axis))]
+
+    def operator(self, intervention_type: str) -> np.ndarray:
+        return compile_operator(intervention_type, self.constructors[intervention_type], self.axis)
+
+    def extend(self, chain_id: int, chain: tuple, intervention_type: str):
+        new_chain = chain + (intervention_type,)
+        if new_chain not in self.ids:
+            self.ids[new_chain] = len(self.matrices)
+            self.matrices.append(self.operator(intervention_type) @ self.matrices[chain_id])
+        return self.ids[new_chain], new_chain
+
+    def stack(self) -> np.ndarray:
+        return np.stack(self.matrices)
+
+
+def compile_chains(targets, types, axis: pd.MultiIndex, constructors: dict):
+    """
+    Walks an intervention list once to find each intervention's chain before and after it acts.
+    Returns the Chains and the before and after chain ids of each intervention
+    """
+    chains = Chains(axis, constructors)
+    state = {}
+    before_ids = np.empty(len(types), dtype=int)
+    after_ids = np.empty(len(types), dtype=int)
+    for i, (target, intervention_type) in enumerate(zip(targets, types)):
+        chain_id, chain = state.get(target, (0, ()))
+        before_ids[i] = chain_id
+        state[target] = chains.extend(chain_id, chain, intervention_type)
+        after_ids[i] = state[target][0]
+    return chains, before_ids, after_ids
+
+
+def chain_grid(shape: tuple, target_pos: np.ndarray, columns: np.ndarray, after_ids: np.ndarray) -> np.ndarray:
+    """
+    The chain id in force for each (asset, year) cell: that of the last intervention acting on
+    the asset on or before the year, or 0 if none has
+    """
+    events = (pd.DataFrame({'asset': target_pos, 'column': columns, 'chain': after_ids})
+              .drop_duplicates(['asset', 'column'], keep='last')
+              )
+    grid = np.full(shape, -1)
+    grid[events['asset'], events['column']] = events['chain']
+    grid[:, 0] = np.where(grid[:, 0] < 0, 0, grid[:, 0])
+    last_event = np.maximum.accumulate(np.where(grid >= 0, np.arange(shape[1]), 0), axis=1)
+    return np.take_along_axis(grid, last_event, axis=1)
+
+
+def apply_chains(block: np.ndarray, target_pos: np.ndarray, columns: np.ndarray, after_ids: np.ndarray,
+                 matrices: np.ndarray):
+    """
+    Applies compiled chains in place to an (asset, year, use) block
+    """
+    grid = chain_grid(block.shape[:2], target_pos, columns, after_ids)
+    for chain_id in np.unique(grid):
+        if chain_id == 0:
+            continue
+        mask = grid == chain_id
+        block[mask] = block[mask] @ matrices[chain_id].T
+
+
+def replace_rows(df: pd.DataFrame, rows: np.ndarray, values: np.ndarray) -> pd.DataFrame:
+    """
+    Returns a copy of df with the given row positions replaced. Sparse frames are spliced
+    together so that only the replaced rows are ever densified
+    """
+    if not path.is_sparse(df):
+        result = df.to_numpy(copy=True)
+        result[rows] = values
+        return pd.DataFrame(result, index=df.index, columns=df.columns)
+
+    untouched = np.setdiff1d(np.arange(len(df)), rows)
+    combined = pd.concat([df.iloc[untouched], path.to_sparse(values, df.index[rows], df.columns)])
+    return combined.iloc[np.argsort(np.concatenate([untouched, rows]))]
+
+
+def unfilled(consumption: pd.DataFrame, target, year, axis: pd.MultiIndex) -> np.ndarray:
+    """
+    Which of an asset's (Utility, Use) rows have no consumption in a year, looked up in its
+    (UID, Utility) consumption
+    """
+    rows = pd.MultiIndex.from_arrays([np.full(len(axis), target, dtype=object), axis.get_level_values('Utility')])
+    return (consumption.reindex(index=rows, columns=[year])
+                       .isna()
+                       .to_numpy()[:, 0]
+            )
+
+
+@profiled('Engine.apply_batch', rows=row_count)
+def apply_batch(df: pd.DataFrame, targets, years, types, constructors: dict, mask_first: bool = True,
+                consumption: pd.DataFrame = None, costs=None):
+    """
+    Applies interventions, given as equal length sequences of targets, years and types
+    (already in application order), to a split consumption frame with (UID, Utility, Use)
+    rows and year columns.
+    Returns the resulting frame and an ImpactLedger, both matching sequential application
+    of the same interventions through Intervention.act. mask_first should be unset when the
+    list does not start with the scenario's first intervention. The first intervention's
+    unfilled rows are those missing from the (UID, Utility) consumption if given, which frames
+    holding no NaN (sparse or zero-filled) need; otherwise the NaN rows of df. costs, if given,
+    are recorded in the ledger against each intervention
+    """
+    targets = np.asarray(targets, dtype=object)
+    years = np.asarray(years)
+    types = list(types)
+    utilities = df.index.get_level_values('Utility')
+    utility_index = pd.Index(utilities.unique()).sort_values()
+    if len(types) == 0:
+        return df.copy(), ImpactLedger(utility_index)
+    if profiler.enabled:
+        for intervention_type, n in pd.Series(types).value_counts().items():
+            profiler.count(f"interventions [{intervention_type}]", n)
+
+    result = df.fillna(0)
+    axis = df.index.droplevel('UID').unique()
+    uid_codes, uids = pd.factorize(df.index.get_level_values('UID'))
+    use_codes = axis.get_indexer(df.index.droplevel('UID'))
+
+    # Only the targeted assets are gathered into a dense (asset, year, use) block
+    touched = pd.Index(pd.unique(targets))
+    target_pos = touched.get_indexer(targets)
+    row_asset = touched.get_indexer(uids)[uid_codes]
+    rows = np.flatnonzero(row_asset >= 0)
+    block = np.zeros((len(touched), len(df.columns), len(axis)))
+    block[row_asset[rows], :, use_codes[rows]] = result.iloc[rows].to_numpy(dtype=float)
+    profiler.count('Engine.apply_batch rows touched', len(rows))
+
+    chains, before_ids, after_ids = compile_chains(targets, types, axis, constructors)
+    matrices = chains.stack()
+    columns = df.columns.get_indexer(years)
+    if (columns < 0).any():
+        raise KeyError(f"Intervention years {sorted(set(years[columns < 0]))} are outside the pathway")
+
+    # Impacts are the change in the intervention year's column, summed by utility
+    baseline = block[target_pos, columns]
+    delta = (np.einsum('nij,nj->ni', matrices[after_ids], baseline)
+             - np.einsum('nij,nj->ni', matrices[before_ids], baseline))
+    if mask_first:
+        # unfilled rows do not register against the first intervention
+        if consumption is None:
+            delta[0, df.loc[targets[0], years[0]].reindex(axis).isna().to_numpy()] = 0
+        else:
+            delta[0, unfilled(consumption, targets[0], years[0], axis)] = 0
+
+    apply_chains(block, target_pos, columns, after_ids, matrices)
+    result = replace_rows(result, rows, block[row_asset[rows], :, use_codes[rows]])
+
+    grouping = (utility_index.get_indexer(axis.get_level_values('Utility'))[None, :]
+                == np.arange(len(utility_index))[:, None])
+    ledger = ImpactLedger.from_arrays(targets, years, types, delta @ grouping.T, utility_index, costs)
+
+    return result, ledger
@@ -3,12 +3,26 @@
 Module handling interventions and intervention plans
 """
 
+import os
+import hashlib
+import tempfile
+import numpy as np
 import pandas as pd
 import ReferenceData as data
 from typing import List, Callable, Tuple
 from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from Schemas import Asset_Data, Asset_Data_Sortable, Intervention_Data, Rollout_Data
 import pathwayFunctions as path
+import Engine
+import Optimiser
+import Uncertainty
+from Ledger import ImpactLedger
+from Results import StrandingIndex
+from Deltas import ScenarioDeltas
+from Store import ResultStore
+from Profiling import profiled, profiler, row_count
 
 idx = pd.IndexSlice
 
@@ -30,8 +44,11 @@ intervention_constructors = {'Monitoring & Targeting': 'Efficiency',
 
 class Model:
     @staticmethod
+    @profiled('Model.compute_CRREM_pathways', rows=row_count)
     def compute_CRREM_pathways(consumption_pathway, asset_data):
-        energy = consumption_pathway.groupby('UID').sum()
+        energy = path.aggregate(consumption_pathway, ['UID'])
+        if path.is_sparse(energy):
+            energy = energy.sparse.to_dense()
 
         emissions = path.carbon_conversion(consumption_pathway, asset_data)
 
@@ -43,73 +60,376 @@ class Model:
                           )
         return CRREM_pathways
 
-    def __init__(self, asset_data, con_data, base_year=2020):
+    def __init__(self, asset_data, con_data, base_year=2020, sparse: bool = False, asset_cache_size: int = 50_000):
         """
         Using the input data, the basic calculations are done, and the BAU Consumption
         is stored to the instance, as well as a dataframe of pathways in the BAU and CRREM target
         scenarios.
+        With sparse set, split consumption and scenario consumption are held in sparse columns; missing
+        consumption is then stored as zero, and the BAU consumption tells which rows the first
+        intervention's impact should leave out, as the dense frames' NaN do. This only covers the
+        frames at rest: the batch engine densifies the targeted assets' rows, but sequential
+        application (Scenario.act) and the carbon conversion of each scenario's (UID, Utility)
+        consumption work on dense copies, and the aligned emissions factors are dense. The saving
+        also shrinks as the frame fills, a sparse column storing an index beside each value.
+        asset_cache_size bounds the per-asset results kept for incremental evaluation
         """
         self.scenarios = None
         self.base_year = base_year
+        self.sparse = sparse
+        self.asset_cache = OrderedDict()
+        self.asset_cache_size = asset_cache_size
+        self._cache_reference = None
+        self._bau_split = None
+        self.impact_ledger = None
+        self._scenario_impact_data = (None, None)
+        self.scenario_pathway_data = None
 
         self.asset_data = asset_data
         self.BAU_Consumption = path.forecast_BAU_Consumption(asset_data, con_data)
         self.BAU_Pathways = Model.compute_CRREM_pathways(self.BAU_Consumption, asset_data)
         self.CRREM_Targets = data.pathways.get_data(asset_data)
 
+    @profiled('Model.scenarios_from_df')
     def scenarios_from_df(self, interventions_df: Intervention_Data, rollouts_df: Rollout_Data):
-        scenario_names = (pd.concat([interventions_df['Scenario'], rollouts_df['Scenario']])
-                          .unique()
-                          .tolist()
-                          )
-        scenarios = []
+        plan = InterventionPlan.from_df(interventions_df, rollouts_df, self)
+        self.scenarios = [Scenario(name, plan=scenario_plan) for name, scenario_plan in plan.by_scenario().items()]
 
-        for name in scenario_names:
-            scenarios.append(Scenario.from_df(name,
-                                              interventions_df[interventions_df['Scenario'] == name],
-                                              rollouts_df[rollouts_df['Scenario'] == name],
-                                              self)
-                             )
-
-        self.scenarios = scenarios
-
-    def apply_interventions(self, scenarios):
+    def bau_split(self):
+        """
+        Returns the BAU consumption split across end uses, along with its (UID, Utility)
+        totals and their pathways, computing them on first use
+        """
+        if self._bau_split is None:
+            split_consumption = path.split_pathway(self.asset_data, self.BAU_Consumption, sparse=self.sparse)
+            consumption = path.aggregate(split_consumption, ['UID', 'Utility'])
+            self._bau_split = (split_consumption,
+                               consumption,
+                               Model.compute_CRREM_pathways(consumption, self.asset_data))
+        return self._bau_split
+
+    @profiled('Model.apply_interventions', rows=row_count)
+    def apply_interventions(self, scenarios, batch: bool = True, workers: int = 1, incremental: bool = False,
+                            deltas: bool = False):
+        """
+        Applies each scenario to the split BAU consumption. With batch set, scenarios are
+        evaluated through the vectorised engine; otherwise each intervention acts in turn.
+        With more than one worker, scenarios are evaluated concurrently in a process pool
+        (always through the batch engine). With incremental set, per-asset results are
+        reused from earlier runs wherever an asset's interventions are unchanged.
+        With deltas set, the scenario consumption and pathways are kept as ScenarioDeltas
+        against those of the split BAU consumption, holding only what each scenario changed; every
+        scenario is then evaluated on the assets it targets alone. Either way, the same frames result
+        """
         all_names = ["BAU", "Target"]
         scenario_names = []
         scenario_pathways = [self.BAU_Pathways, self.CRREM_Targets]
         scenario_consumptions = []
-        scenario_impacts = []
+        scenario_ledgers = []
+
+        split_consumption, bau_consumption, bau_pathways = self.bau_split()
+        if deltas:
+            # The split BAU results are the reference of the deltas, being what untouched assets
+            # hold in every scenario; the BAU and target pathways are kept whole
+            consumption_deltas = ScenarioDeltas(bau_consumption, listed=False)
+            pathway_deltas = ScenarioDeltas(bau_pathways, 'Split BAU', full={'BAU': self.BAU_Pathways,
+                                                                            'Target': self.CRREM_Targets},
+                                            listed=False)
+
+        if incremental:
+            results = (self.evaluate_incremental(scenario, complete=not deltas) for scenario in scenarios)
+        elif workers > 1:
+            results = evaluate_parallel(scenarios, split_consumption, self.asset_data, self.BAU_Consumption, workers)
+            if not deltas:
+                results = ((*self.with_bau(scenario_data, new_pathway), ledger)
+                           for scenario_data, new_pathway, ledger in results)
+        elif deltas:
+            results = (self.evaluate_targeted(scenario, batch) for scenario in scenarios)
+        else:
+            results = (Model.evaluate_scenario(scenario, split_consumption, self.asset_data, batch,
+                                               self.unfilled_source())
+                       for scenario in scenarios)
+
+        for scenario, (scenario_data, new_pathway, ledger) in zip(scenarios, results):
+            scenario_names.append(scenario.name)
+            scenario.ledger = ledger
+            scenario_ledgers.append(ledger)
 
-        split_consumption = path.split_pathway(self.asset_data, self.BAU_Consumption)
+            if deltas:
+                consumption_deltas.add(scenario.name, scenario_data)
+                pathway_deltas.add(scenario.name, new_pathway)
+            else:
+                scenario_consumptions.append(scenario_data)
+                scenario_pathways.append(new_pathway)
 
-        for scenario in scenarios:
-            scenario_names.append(scenario.name)
-            consumption_copy = split_consumption.copy()
-            scenario_data = (scenario(consumption_copy).groupby(['UID', 'Utility'])
-                             .sum()
-                             )
+        all_names.extend(scenario_names)
+        self.impact_ledger = ImpactLedger.concat(scenario_ledgers, keys=scenario_names)
+        if deltas:
+            self.scenario_consumption_data = consumption_deltas
+            self.scenario_pathway_data = pathway_deltas
+        else:
+            self.scenario_consumption_data = pd.concat(scenario_consumptions, keys=scenario_names, names=['Scenario'])
+            self.scenario_pathway_data = pd.concat(scenario_pathways, keys=all_names, names=['Scenario'])
+        return self.scenario_pathway_data
+
+    def with_bau(self, consumption: pd.DataFrame, pathways: pd.DataFrame):
+        """
+        Completes a scenario's consumption and pathways for the assets it targets with the
+        split BAU results of every other asset
+        """
+        _, bau_consumption, bau_pathways = self.bau_split()
+        touched = consumption.index.unique('UID')
+        return (pd.concat([bau_consumption.drop(touched, level='UID'), consumption]).sort_index(),
+                pd.concat([bau_pathways.drop(touched, level='UID'), pathways]).sort_index())
 
-            new_pathway = Model.compute_CRREM_pathways(scenario_data, self.asset_data)
+    def unfilled_source(self):
+        """
+        The consumption from which the first intervention's unfilled rows are found: the BAU
+        consumption when split consumption is sparse (so holds no NaN), otherwise None
+        """
+        return self.BAU_Consumption if self.sparse else None
 
-            scenario_consumptions.append(scenario_data)
-            scenario_pathways.append(new_pathway)
-            scenario_impacts.append(scenario.impact_log)
+    def targeted(self, scenario):
+        """
+        The split BAU consumption and asset data of the assets a scenario's interventions target
+        """
+        split_consumption = self.bau_split()[0]
+        targets = pd.unique(np.asarray(scenario.plan()[0], dtype=object))
+        return (split_consumption[split_consumption.index.get_level_values('UID').isin(targets)],
+                self.asset_data[self.asset_data['UID'].isin(targets)])
 
-        all_names.extend(scenario_names)
-        self.scenario_consumption_data = pd.concat(scenario_consumptions, keys=scenario_names, names=['Scenario'])
-        self.scenario_impact_data = pd.concat(scenario_impacts, keys=scenario_names, names=['Scenario'])
-        return pd.concat(scenario_pathways, keys=all_names, names=['Scenario'])
+    def evaluate_targeted(self, scenario, batch: bool = True):
+        """
+        As evaluate_scenario, but on the assets the scenario targets alone, so returning only their
+        consumption and pathways
+        """
+        split_consumption, bau_consumption, bau_pathways = self.bau_split()
+        if len(scenario.plan()[0]) == 0:
+            scenario.ledger = ImpactLedger(split_consumption.index.unique('Utility').sort_values())
+            return bau_consumption.iloc[:0], bau_pathways.iloc[:0], scenario.ledger
+        return Model.evaluate_scenario(scenario, *self.targeted(scenario), batch, self.unfilled_source())
+
+    @property
+    def scenario_impact_data(self) -> pd.DataFrame:
+        """
+        The impact ledger of the last apply_interventions, as a frame under a Scenario level.
+        A frame assigned here is kept until interventions are next applied
+        """
+        ledger, impacts = self._scenario_impact_data
+        if ledger is self.impact_ledger and impacts is not None:
+            return impacts
+        return self.impact_ledger.to_frame() if self.impact_ledger is not None else None
+
+    @scenario_impact_data.setter
+    def scenario_impact_data(self, impacts: pd.DataFrame):
+        self._scenario_impact_data = (self.impact_ledger, impacts)
+
+    @staticmethod
+    @profiled('Model.evaluate_scenario', rows=row_count)
+    def evaluate_scenario(scenario, split_consumption, asset_data, batch: bool = True, consumption=None):
+        """
+        Returns a scenario's (UID, Utility) consumption, its pathways and its impact ledger.
+        consumption is passed on to Scenario.act or act_batch
+        """
+        if batch:
+            scenario_result = scenario.act_batch(split_consumption, consumption)
+        else:
+            scenario_result = scenario(split_consumption.copy(), consumption)
+        scenario_data = path.aggregate(scenario_result, ['UID', 'Utility'])
+
+        new_pathway = Model.compute_CRREM_pathways(scenario_data, asset_data)
+        return scenario_data, new_pathway, scenario.ledger
+
+    def write_results(self, root: str, pathways: pd.DataFrame = None, file_format: str = 'parquet') -> ResultStore:
+        """
+        Writes the pathways returned by apply_interventions (by default those of the last run), along
+        with the scenario consumption and impacts of that run, to a ResultStore at root. Each row gets
+        its asset's Country Code and Sector Code (and the pathways its Area) to filter on.
+        ScenarioDeltas are stored as such (see ResultStore.write), with the asset data alongside
+        """
+        pathways = pathways if pathways is not None else self.scenario_pathway_data
+        consumption = self.scenario_consumption_data
+        encodings = {}
+        for name, frame in (('pathways', pathways), ('consumption', consumption)):
+            if isinstance(frame, ScenarioDeltas):
+                encodings[name] = {'base': frame.base_name, 'listed': frame.listed, 'full': list(frame.full),
+                                   'scenarios': list(frame.names), 'keys': list(frame.base.index.names)}
+        if isinstance(pathways, ScenarioDeltas):
+            pathways = pathways.to_long()
+        if isinstance(consumption, ScenarioDeltas):
+            consumption = consumption.to_long()
+
+        pathways = (pathways.pipe(path.attach_asset_data, self.asset_data, ['Country Code', 'Sector Code', 'Area'])
+                            .reset_index()
+                    )
+        consumption = path.attach_asset_data(consumption, self.asset_data, ['Country Code', 'Sector Code'])
+        impacts = self.scenario_impact_data
+        if impacts is not None and 'Target' in impacts.columns:
+            codes = self.asset_data.set_index('UID')[['Country Code', 'Sector Code']].reindex(impacts['Target'])
+            impacts = impacts.assign(**{column: codes[column].to_numpy() for column in codes.columns})
+        else:
+            impacts = None  # no scenario made any intervention
+
+        store = ResultStore(root)
+        store.write(pathways, consumption, impacts, file_format,
+                    assets=self.asset_data if encodings else None, deltas=encodings)
+        return store
+
+    def stranding(self, pathways: pd.DataFrame) -> StrandingIndex:
+        """
+        Stranding years, cumulative excess and yearly gaps of the pathways returned by
+        apply_interventions, against the CRREM targets
+        """
+        if isinstance(pathways, ScenarioDeltas):
+            return StrandingIndex.from_deltas(pathways)
+        return StrandingIndex(pathways, self.CRREM_Targets)
+
+    @profiled('Model.optimise')
+    def optimise(self, name: str = 'Optimised', types: list = None, costs: dict = None, path_type: str = 'GHG-Int',
+                 start_year: int = None, max_interventions: int = None):
+        """
+        Searches for a plan keeping each asset within its CRREM target pathway from start_year
+        (by default the year after the base year), installing interventions as late as possible
+        and preferring those which remove the most excess per unit of cost (see Optimiser.PlanKernel).
+        Returns the plan as a Scenario, ready for apply_interventions, and a summary of it per
+        country and sector
+        """
+        types = types if types is not None else Engine.available_types(intervention_constructors)
+        kernel = Optimiser.PlanKernel(self, types, intervention_constructors, costs, path_type)
+        table, unresolved = kernel.search(start_year if start_year is not None else self.base_year + 1,
+                                          max_interventions)
+
+        plan = InterventionPlan(table.assign(Scenario=name), self, [name])
+        return Scenario(name, plan=plan), Optimiser.summarise(table, unresolved, self.asset_data)
+
+    @profiled('Model.uncertainty')
+    def uncertainty(self, scenarios, samples: int = 100, spread: dict = None, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+                    seed: int = 0, workers: int = 1, chunk: int = 32, by_asset: bool = False) -> pd.DataFrame:
+        """
+        Monte Carlo bands for the BAU and scenario pathways. Efficiency savings, CoPs and emissions
+        factors are perturbed by lognormal multipliers whose log standard deviations are given in
+        spread (see Uncertainty.default_spread), and all samples of a chunk are evaluated together.
+        Returns the mean and quantiles over samples of the portfolio's total pathways, or of each
+        asset's with by_asset set, with (Scenario, [UID,] Pathway Code, Statistic) rows
+        """
+        kernel = Optimiser.PlanKernel(self, [], intervention_constructors)
+        plans = {'BAU': ([], [], []), **{scenario.name: scenario.plan() for scenario in scenarios}}
+        sample_kernel = Uncertainty.SampleKernel(kernel, plans, intervention_constructors)
+        pathways = Uncertainty.run(sample_kernel, samples, seed, spread, chunk, workers, by_asset)
+        return Uncertainty.bands(pathways, kernel.years, quantiles, kernel.uids if by_asset else None)
+
+    @staticmethod
+    def sequence_key(years, types, leads_scenario: bool) -> str:
+        """
+        Hashes an asset's ordered intervention sequence. Whether the asset holds the scenario's
+        first intervention is included, as that intervention logs against unfilled rows differently
+        """
+        return hashlib.blake2b(repr((tuple(years), tuple(types), leads_scenario)).encode(),
+                               digest_size=16).hexdigest()
+
+    def clear_cache(self):
+        """
+        Drops the per-asset results kept for incremental evaluation
+        """
+        self.asset_cache.clear()
+
+    @profiled('Model.evaluate_incremental', rows=row_count)
+    def evaluate_incremental(self, scenario, complete: bool = True):
+        """
+        Evaluates a scenario asset by asset. Results are cached against each asset's intervention
+        sequence and the reference data in use, so only assets whose sequence has not been seen
+        before are recomputed, and the rest are recombined from the cache and the BAU results.
+        The cache keeps the asset_cache_size most recently used results, and is emptied whenever
+        the reference data changes. With complete unset, only the targeted assets' consumption
+        and pathways are returned
+        """
+        split_consumption, bau_consumption, bau_pathways = self.bau_split()
+        targets, years, types = scenario.plan()
+        if len(targets) == 0:
+            scenario.ledger = ImpactLedger(split_consumption.index.unique('Utility').sort_values())
+            if not complete:
+                return bau_consumption.iloc[:0], bau_pathways.iloc[:0], scenario.ledger
+            return bau_consumption.copy(), bau_pathways.copy(), scenario.ledger
+
+        reference = data.reference_digest()
+        if reference != self._cache_reference:
+            self.asset_cache.clear()
+            self._cache_reference = reference
+
+        plan = pd.DataFrame({'Target': targets, 'Year': years, 'Type': types})
+        plan['Step'] = plan.groupby('Target', observed=True).cumcount()
+        keys = {target: (reference, Model.sequence_key(steps['Year'], steps['Type'], target == targets[0]))
+                for target, steps in plan.groupby('Target', sort=False, observed=True)}
+
+        parts = {}
+        missing = [target for target, key in keys.items() if (target, key) not in self.asset_cache]
+        if missing:
+            todo = plan[plan['Target'].isin(missing)]
+            result, ledger = Engine.apply_batch(split_consumption.loc[missing].sort_index(),
+                                                    todo['Target'], todo['Year'], todo['Type'],
+                                                    intervention_constructors,
+                                                    mask_first=todo.index[0] == 0,
+                                                    consumption=self.unfilled_source())
+            consumption = path.aggregate(result, ['UID', 'Utility'])
+            pathways = Model.compute_CRREM_pathways(consumption,
+                                                    self.asset_data[self.asset_data['UID'].isin(missing)])
+
+            consumption_parts = dict(tuple(consumption.groupby(level='UID', observed=True)))
+            pathway_parts = dict(tuple(pathways.groupby(level='UID', observed=True)))
+            impact_positions = todo.reset_index(drop=True).groupby('Target', sort=False, observed=True).indices
+            for target in missing:
+                parts[target] = (consumption_parts[target],
+                                 pathway_parts[target],
+                                 ledger.take(impact_positions[target]))
+
+        for item in keys.items():
+            if item[0] in parts:
+                self.asset_cache[item] = parts[item[0]]
+            else:
+                self.asset_cache.move_to_end(item)
+                parts[item[0]] = self.asset_cache[item]
+        while len(self.asset_cache) > self.asset_cache_size:
+            self.asset_cache.popitem(last=False)
+
+        cached = [parts[target] for target in keys]
+        touched = list(keys)
+        untouched = (([bau_consumption.drop(touched, level='UID')], [bau_pathways.drop(touched, level='UID')])
+                     if complete else ([], []))
+        scenario_data = (pd.concat([*untouched[0], *(part[0] for part in cached)])
+                         .sort_index()
+                         )
+        new_pathway = (pd.concat([*untouched[1], *(part[1] for part in cached)])
+                       .sort_index()
+                       )
+        # Each cached ledger holds its asset's impacts in step order, so plan rows index into their concatenation
+        ledgers = [part[2] for part in cached]
+        offsets = dict(zip(keys, np.cumsum([0] + [len(ledger) for ledger in ledgers[:-1]])))
+        scenario.ledger = (ImpactLedger.concat(ledgers)
+                           .take(plan['Target'].map(offsets).to_numpy() + plan['Step'].to_numpy())
+                           )
+        # Costs do not change the results cached, so are taken from the plan rather than the cache
+        scenario.ledger.set_costs(scenario.costs())
+        return scenario_data, new_pathway, scenario.ledger
 
 
 class Intervention:
-    # TODO Implement costs
-    def __init__(self, target: str, year: int, intervention_type: str, model: Model):
-        self.impact_log = None
+    # TODO Implement costs; for now they are only carried from the plan (eg an optimised one)
+    def __init__(self, target: str, year: int, intervention_type: str, model: Model, cost: float = 0):
+        self.impact = None
+        self._impact_log = (None, None)
         self.target = target
         self.year = year
         self.intervention_type = intervention_type
-        self.asset_info = model.asset_data[model.asset_data['UID'] == target]
-        self.BAU_data = model.BAU_Consumption.loc[target, year]
+        self.model = model
+        self.cost = cost
+
+    @property
+    def asset_info(self):
+        return self.model.asset_data[self.model.asset_data['UID'] == self.target]
+
+    @property
+    def BAU_data(self):
+        return self.model.BAU_Consumption.loc[self.target, self.year]
 
     def effect(self):
         if intervention_constructors[self.intervention_type] == 'Efficiency':
@@ -117,20 +437,51 @@ class Intervention:
         elif intervention_constructors[self.intervention_type] == 'Relative Reassignment':
             return RelativeReassignment(self)
 
-    def act(self, df: pd.DataFrame):
-        result = df.copy().fillna(0)
-        result.loc[self.target, result.columns >= self.year] = (result.loc[self.target, df.columns >= self.year]
-                                                                .apply(self.effect())
-                                                                .values
-                                                                )
-
-        info = pd.Series([self.target, self.year, self.intervention_type, 0], index=['Target', 'Year', 'Type', 'Cost'])
-        impact = ((result.loc[self.target, self.year] - df.loc[self.target, self.year])
-                  .groupby('Utility')
-                  .sum()
-                  )
+    def operator(self, axis: pd.MultiIndex):
+        """
+        The intervention's effect as a matrix over the given (Utility, Use) axis
+        """
+        return Engine.compile_operator(self.intervention_type, intervention_constructors[self.intervention_type], axis)
 
-        self.impact_log = pd.concat([info, impact], axis=0)
+    @property
+    def impact_log(self) -> pd.Series:
+        """
+        The intervention's Target, Year, Type and Cost, then its impact on each utility. A log
+        assigned here is kept until the intervention next acts
+        """
+        impact, log = self._impact_log
+        if impact is self.impact and log is not None:
+            return log
+        if self.impact is None:
+            return None
+        info = pd.Series([self.target, self.year, self.intervention_type, self.cost], index=['Target', 'Year', 'Type', 'Cost'])
+        return pd.concat([info, self.impact], axis=0)
+
+    @impact_log.setter
+    def impact_log(self, log: pd.Series):
+        self._impact_log = (self.impact, log)
+
+    def act(self, df: pd.DataFrame, ledger: ImpactLedger = None):
+        """
+        Returns a copy of df with the intervention applied. The change it makes to each utility
+        in its year is kept as self.impact, and recorded in the ledger if one is given
+        """
+        with profiler.stage(f"Intervention.act [{self.intervention_type}]", rows=len(df)):
+            result = df.copy().fillna(0)
+            affected = result.loc[self.target, result.columns >= self.year]
+            # one matrix product covers every affected year
+            result.loc[self.target, result.columns >= self.year] = self.operator(affected.index) @ affected.to_numpy()
+
+        before = df.loc[self.target, self.year]
+        utilities = (ledger.utilities if ledger is not None
+                     else before.index.unique('Utility').sort_values())
+        change = np.nan_to_num(result.loc[self.target, self.year].to_numpy() - before.to_numpy())
+        deltas = np.bincount(utilities.get_indexer(before.index.get_level_values('Utility')), change,
+                             minlength=len(utilities))
+
+        self.impact = pd.Series(deltas, index=utilities)
+        if ledger is not None:
+            ledger.append(self.target, self.year, self.intervention_type, deltas, self.cost)
         return result
 
     __call__ = act
@@ -148,15 +499,8 @@ def EfficiencyEffect(intervention: Intervention):
 def RelativeReassignment(intervention: Intervention):
     # TODO Add exception handling when the intervention type cannot be handle by this constructor
 
-    # TODO use a configured data object for this
-    effect_coeffs = data.reassignment_parameters.reset_index()[
-        data.reassignment_parameters['Type'] == intervention.intervention_type]
-
     def reassignment_effect(df):
-        for _, row in effect_coeffs.iterrows():
-            df.loc[(row.ToUtility, row.ToUse)] = df.loc[(row.FromUtility, row.FromUse)] / row.CoP
-            df.loc[(row.FromUtility, row.FromUse)] = 0
-        return df
+        return pd.Series(intervention.operator(df.index) @ df.to_numpy(), index=df.index)
 
     return reassignment_effect
 
@@ -181,7 +525,7 @@ class Rollout:
                        .reset_index()
                        .drop(columns=['Pathway Code'])
                        .set_index('UID')
-                       .rename(columns={2020: 'Intensities'}))
+                       .rename(columns={model.base_year: 'Intensities'}))
 
         sortable_assets = asset_data.merge(intensities, left_on='UID', right_index=True)
 
@@ -209,15 +553,120 @@ class Rollout:
         return intervention_list
 
 
+class InterventionPlan:
+    fields = ['Scenario', 'Target', 'Year', 'Type']
+
+    def __init__(self, table: pd.DataFrame, model: Model, scenario_names: list = None):
+        """
+        Stores interventions as a table of (Scenario, Target, Year, Type, Cost) rows, ordered by
+        year as they are applied. Rows of equal year keep the order they were given in. The Cost
+        column is optional, costs being zero where it is not given
+        """
+        if 'Cost' not in table.columns:
+            table = table.assign(Cost=0)
+        self.table = (table[[*InterventionPlan.fields, 'Cost']]
+                      .sort_values('Year', kind='stable')
+                      .reset_index(drop=True)
+                      )
+        self.model = model
+        self.scenario_names = (scenario_names if scenario_names is not None
+                               else self.table['Scenario'].unique().tolist())
+
+    @staticmethod
+    @profiled('InterventionPlan.schedule_rollouts', rows=len)
+    def schedule_rollouts(rollouts_df: Rollout_Data, model: Model) -> pd.DataFrame:
+        """
+        Expands every rollout into its interventions at once. Each rollout's assets in scope are
+        ranked by descending base-year intensity and installed 'Installations per year' at a time
+        from the start year, matching the order of Rollout.unpack
+        """
+        asset_data = model.asset_data
+        intensities = (model.BAU_Pathways.xs('kWh-Int', level='Pathway Code')[model.base_year]
+                       .rename('Intensities')
+                       )
+        assets = asset_data[['UID', 'Country Code', 'Sector Code']].merge(intensities, left_on='UID', right_index=True)
+
+        rollouts = rollouts_df.reset_index(drop=True).rename_axis('Rollout').reset_index()
+        candidates = rollouts.merge(assets, how='cross')
+        in_scope = (((candidates['Country Scope'] == '-') | (candidates['Country Scope'] == candidates['Country Code']))
+                    & ((candidates['Sector Scope'] == '-') | (candidates['Sector Scope'] == candidates['Sector Code'])))
+
+        # Each rollout's assets are sorted alone, with the same (unstable) sort as Rollout, so that
+        # assets of equal intensity keep its order; reversed, that is the order of popping from Rollout.targets
+        scoped = candidates[in_scope]
+        scheduled = pd.concat([scoped.iloc[:0],
+                               *(rollout.sort_values('Intensities').iloc[::-1]
+                                 for _, rollout in scoped.groupby('Rollout', sort=True))])
+        rank = scheduled.groupby('Rollout').cumcount()
+        scheduled = scheduled.assign(Target=scheduled['UID'],
+                                     Year=scheduled['Start'] + rank // scheduled['Installations per year'])
+        return scheduled[InterventionPlan.fields]
+
+    @classmethod
+    def from_df(cls, interventions_df: Intervention_Data, rollouts_df: Rollout_Data, model: Model):
+        """
+        Builds the plan for every scenario in the Interventions and Rollouts sheets. Within a
+        scenario, individual interventions come before rollouts, as in Scenario.from_df
+        """
+        scenario_names = (pd.concat([interventions_df['Scenario'], rollouts_df['Scenario']])
+                          .unique()
+                          .tolist()
+                          )
+        table = pd.concat([interventions_df[InterventionPlan.fields],
+                           InterventionPlan.schedule_rollouts(rollouts_df, model)],
+                          ignore_index=True)
+        return cls(table, model, scenario_names)
+
+    def by_scenario(self) -> dict:
+        """
+        Splits the plan into one plan per scenario, keyed by scenario name
+        """
+        groups = dict(tuple(self.table.groupby('Scenario', sort=False, observed=True)))
+        return {name: InterventionPlan(groups.get(name, self.table.iloc[:0]), self.model, [name])
+                for name in self.scenario_names}
+
+    def columns(self) -> Tuple[list, list, list]:
+        return (self.table['Target'].tolist(),
+                self.table['Year'].tolist(),
+                self.table['Type'].tolist())
+
+    def costs(self) -> list:
+        return self.table['Cost'].tolist()
+
+    def interventions(self) -> List[Intervention]:
+        return [Intervention(target, year, intervention_type, self.model, cost)
+                for target, year, intervention_type, cost in zip(*self.columns(), self.costs())]
+
+
 class Scenario:
-    def __init__(self, name: str, interventions: List[Intervention], rollouts: List[Rollout] = []):
-        self.impact_log = None
+    def __init__(self, name: str, interventions: List[Intervention] = None, rollouts: List[Rollout] = [],
+                 plan: InterventionPlan = None):
+        """
+        A scenario is built either from Intervention and Rollout objects, or from an
+        InterventionPlan, in which case Intervention objects are only created if the
+        intervention list is asked for
+        """
+        self.ledger = None
+        self._impact_log = (None, None)
         self.name = name
-        self.intervention_list = interventions
-        if len(rollouts) > 0:
-            rollout_contents = chain(*[rollout.unpack() for rollout in rollouts])
-            self.intervention_list.extend(rollout_contents)
-        self.intervention_list.sort(key=lambda x: x.year)
+        self.intervention_plan = plan
+        self._intervention_list = None
+        if plan is None:
+            self.intervention_list = interventions if interventions is not None else []
+            if len(rollouts) > 0:
+                rollout_contents = chain(*[rollout.unpack() for rollout in rollouts])
+                self.intervention_list.extend(rollout_contents)
+            self.intervention_list.sort(key=lambda x: x.year)
+
+    @property
+    def intervention_list(self) -> List[Intervention]:
+        if self._intervention_list is None:
+            self._intervention_list = self.intervention_plan.interventions()
+        return self._intervention_list
+
+    @intervention_list.setter
+    def intervention_list(self, interventions: List[Intervention]):
+        self._intervention_list = interventions
 
     @classmethod
     def from_df(cls, name: str, interventions_df: Intervention_Data, rollouts_df: Rollout_Data, model: Model):
@@ -233,13 +682,127 @@ class Scenario:
 
         return Scenario(name, interventions, rollouts)
 
-    def act(self, df: pd.DataFrame):
-        result = df.copy()
-        log_list = []
+    @property
+    def impact_log(self) -> pd.DataFrame:
+        """
+        The impacts of the intervention list, one row each, built from the ledger of the last run.
+        A log assigned here is kept until the scenario next runs
+        """
+        ledger, log = self._impact_log
+        if ledger is self.ledger and log is not None:
+            return log
+        return self.ledger.to_frame() if self.ledger is not None else None
+
+    @impact_log.setter
+    def impact_log(self, log: pd.DataFrame):
+        self._impact_log = (self.ledger, log)
+
+    def act(self, df: pd.DataFrame, consumption: pd.DataFrame = None):
+        """
+        Applies the intervention list in turn. A frame holding no NaN (sparse or zero-filled) should
+        come with its (UID, Utility) consumption, in which the first intervention's unfilled rows
+        are looked up, as in Engine.apply_batch. Sparse frames are acted on densely, and the result
+        stored sparse again
+        """
+        result = df.sparse.to_dense() if path.is_sparse(df) else df.copy()
+        self.ledger = ImpactLedger(df.index.unique('Utility').sort_values(), len(self.intervention_list))
         for intervention in self.intervention_list:
-            result = intervention(result)
-            log_list.append(intervention.impact_log)
-        self.impact_log = pd.DataFrame(log_list)
+            result = intervention(result, self.ledger)
+        if consumption is not None and len(self.ledger):
+            first = self.intervention_list[0]
+            rows = pd.MultiIndex.from_product([[first.target], self.ledger.utilities])
+            unfilled = consumption.reindex(index=rows, columns=[first.year]).isna().to_numpy()[:, 0]
+            self.ledger.deltas[0, unfilled] = 0
+            first.impact = first.impact.where(~unfilled, 0)
+        if path.is_sparse(df):
+            return path.to_sparse(result.to_numpy(dtype=float), result.index, result.columns)
+        return result
+
+    def plan(self) -> Tuple[list, list, list]:
+        """
+        Returns the targets, years and types of the intervention list, in application order
+        """
+        if self._intervention_list is None:
+            return self.intervention_plan.columns()
+        return ([i.target for i in self.intervention_list],
+                [i.year for i in self.intervention_list],
+                [i.intervention_type for i in self.intervention_list])
+
+    def costs(self) -> list:
+        """
+        Returns the costs of the intervention list, in the order of plan
+        """
+        if self._intervention_list is None:
+            return self.intervention_plan.costs()
+        return [i.cost for i in self.intervention_list]
+
+    def act_batch(self, df: pd.DataFrame, consumption: pd.DataFrame = None):
+        """
+        Equivalent to act, but compiles the intervention list and applies it in one pass
+        """
+        result, self.ledger = Engine.apply_batch(df, *self.plan(), intervention_constructors,
+                                                 consumption=consumption, costs=self.costs())
         return result
 
     __call__ = act
+
+
+#%% Process-parallel scenario evaluation
+
+_worker_state = {}
+
+
+def _init_worker(values_path, index, columns, asset_data, consumption, custom):
+    """
+    Runs once per worker process: maps the shared split consumption read-only and keeps
+    the asset table and BAU consumption, so tasks only carry their scenario's plan. custom
+    holds the parent's custom reference data, by the name of its Configured_Data
+    """
+    values = np.load(values_path, mmap_mode='r')
+    _worker_state['split_consumption'] = pd.DataFrame(values, index=index, columns=columns, copy=False)
+    _worker_state['asset_data'] = asset_data
+    _worker_state['consumption'] = consumption
+    for name, custom_data in custom.items():
+        getattr(data, name).custom = custom_data
+
+
+def _evaluate_plan(targets, years, types, costs):
+    # Only the targeted assets' rows are copied out of the shared array
+    split_consumption = _worker_state['split_consumption']
+    asset_data = _worker_state['asset_data']
+    touched = pd.unique(np.asarray(targets, dtype=object))
+    scenario_result, ledger = Engine.apply_batch(split_consumption[split_consumption.index.get_level_values('UID').isin(touched)],
+                                                 targets, years, types,
+                                                 intervention_constructors,
+                                                 consumption=_worker_state['consumption'],
+                                                 costs=costs)
+    if len(touched) == 0:  # no rows were touched to take the utilities from
+        ledger = ImpactLedger(split_consumption.index.unique('Utility').sort_values())
+    scenario_data = path.aggregate(scenario_result, ['UID', 'Utility'])
+    new_pathway = Model.compute_CRREM_pathways(scenario_data, asset_data[asset_data['UID'].isin(touched)])
+    return scenario_data, new_pathway, ledger
+
+
+@profiled('evaluate_parallel', rows=row_count)
+def evaluate_parallel(scenarios, split_consumption, asset_data, consumption, workers: int = None):
+    """
+    Evaluates scenarios in a process pool, yielding results in scenario order. Each result
+    covers only the assets the scenario targets (see Model.with_bau). The split consumption
+    is zero-filled and written once to a memory-mapped file shared by all workers rather than
+    pickled per task, the BAU (UID, Utility) consumption telling which rows were unfilled.
+    Reference tables come from each worker's on-disk workbook cache, overridden by the
+    parent's custom data
+    """
+    workers = workers if workers else os.cpu_count()
+    custom = {name: getattr(data, name).custom for name in ('factors', 'pathways', 'splits')}
+    with tempfile.TemporaryDirectory() as tmp:
+        values_path = os.path.join(tmp, 'split_consumption.npy')
+        np.save(values_path, np.nan_to_num(split_consumption.to_numpy(dtype=float)))
+
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(scenarios), 1)),
+                                 initializer=_init_worker,
+                                 initargs=(values_path, split_consumption.index,
+                                           split_consumption.columns, asset_data, consumption, custom)) as executor:
+            plans = [(*scenario.plan(), scenario.costs()) for scenario in scenarios]
+            if plans:
+                yield from executor.map(_evaluate_plan, *zip(*plans))
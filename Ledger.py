@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store of intervention impacts. Each intervention adds one row of its target,
+year, type, cost and the change it makes to each utility's consumption in its year,
+written into preallocated arrays rather than collected as one Series per intervention
+"""
+
+import numpy as np
+import pandas as pd
+
+import ReferenceData as data
+
+
+class ImpactLedger:
+    def __init__(self, utilities, capacity: int = 0):
+        """
+        Preallocates room for capacity impacts over the given utilities. Appending beyond
+        capacity grows the arrays by doubling. Costs are held as integers, as the impact log's
+        zero costs are, until a fractional cost is recorded
+        """
+        self.utilities = pd.Index(utilities, name=None)
+        self.size = 0
+        self.scenarios = None
+        self._costs = np.zeros(0, dtype=np.int64)
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        old = self.size
+        targets = np.empty(capacity, dtype=object)
+        years = np.zeros(capacity, dtype=np.int64)
+        types = np.empty(capacity, dtype=object)
+        costs = np.zeros(capacity, dtype=self._costs.dtype)
+        deltas = np.zeros((capacity, len(self.utilities)))
+        if old:
+            targets[:old], years[:old], types[:old] = self.targets, self.years, self.types
+            costs[:old], deltas[:old] = self.costs, self.deltas
+        self._targets, self._years, self._types, self._costs, self._deltas = targets, years, types, costs, deltas
+
+    def _reserve(self, n: int):
+        capacity = len(self._years)
+        if self.size + n > capacity:
+            self._allocate(max(self.size + n, 2 * capacity))
+
+    @classmethod
+    def from_arrays(cls, targets, years, types, deltas: np.ndarray, utilities, costs=None) -> 'ImpactLedger':
+        ledger = cls(utilities, 0)
+        ledger.extend(targets, years, types, deltas, costs)
+        return ledger
+
+    def _fit_costs(self, costs):
+        costs = np.asarray(costs)
+        if not np.can_cast(costs.dtype, self._costs.dtype, casting='safe'):
+            self._costs = self._costs.astype(np.result_type(self._costs, costs))
+
+    def append(self, target, year: int, intervention_type: str, deltas: np.ndarray, cost: float = 0):
+        self._reserve(1)
+        self._fit_costs(cost)
+        i = self.size
+        self._targets[i], self._years[i], self._types[i], self._costs[i] = target, year, intervention_type, cost
+        self._deltas[i] = deltas
+        self.size += 1
+
+    def set_costs(self, costs):
+        """
+        Replaces the costs of the filled rows
+        """
+        self._fit_costs(costs)
+        self._costs[:self.size] = costs
+
+    def extend(self, targets, years, types, deltas: np.ndarray, costs=None):
+        n = len(years)
+        self._reserve(n)
+        rows = slice(self.size, self.size + n)
+        if costs is not None:
+            self._fit_costs(costs)
+        self._targets[rows] = targets
+        self._years[rows] = years
+        self._types[rows] = types
+        self._costs[rows] = 0 if costs is None else costs
+        self._deltas[rows] = deltas
+        self.size += n
+
+    # Views of the filled rows
+    @property
+    def targets(self) -> np.ndarray:
+        return self._targets[:self.size]
+
+    @property
+    def years(self) -> np.ndarray:
+        return self._years[:self.size]
+
+    @property
+    def types(self) -> np.ndarray:
+        return self._types[:self.size]
+
+    @property
+    def costs(self) -> np.ndarray:
+        return self._costs[:self.size]
+
+    @property
+    def deltas(self) -> np.ndarray:
+        return self._deltas[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def take(self, positions) -> 'ImpactLedger':
+        positions = np.asarray(positions, dtype=int)
+        ledger = ImpactLedger.from_arrays(self.targets[positions], self.years[positions], self.types[positions],
+                                          self.deltas[positions], self.utilities, self.costs[positions])
+        if self.scenarios is not None:
+            ledger.scenarios = self.scenarios[positions]
+        return ledger
+
+    @classmethod
+    def concat(cls, ledgers: list, keys: list = None) -> 'ImpactLedger':
+        """
+        Joins ledgers over the same utilities. With keys, each row records the key of its
+        ledger as its scenario
+        """
+        utilities = ledgers[0].utilities if ledgers else pd.Index([])
+        ledger = cls(utilities, sum(len(part) for part in ledgers))
+        for part in ledgers:
+            ledger.extend(part.targets, part.years, part.types, part.deltas, part.costs)
+        if keys is not None:
+            ledger.scenarios = np.repeat(np.asarray(keys, dtype=object), [len(part) for part in ledgers])
+        return ledger
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        The impact log layout: Target, Year, Type and Cost, then one column per utility. Rows
+        are numbered within each scenario, under a Scenario level if the ledger has scenarios.
+        An empty ledger gives an empty frame
+        """
+        if self.size == 0:
+            return pd.DataFrame()
+        df = pd.concat([pd.DataFrame({'Target': self.targets, 'Year': self.years,
+                                      'Type': self.types, 'Cost': self.costs}),
+                        pd.DataFrame(self.deltas, columns=self.utilities)],
+                       axis=1)
+        if self.scenarios is not None:
+            df.index = pd.MultiIndex.from_arrays([self.scenarios, pd.Series(self.scenarios).groupby(self.scenarios, sort=False).cumcount()],
+                                                 names=['Scenario', None])
+        return df
+
+    #%% Aggregates
+
+    def savings_by_type(self) -> pd.DataFrame:
+        """
+        Consumption saved in the intervention year, per intervention type and utility. Utilities
+        gaining consumption (the destination of a reassignment) show as negative savings
+        """
+        codes, types = pd.factorize(self.types)
+        savings = np.zeros((len(types), len(self.utilities)))
+        np.add.at(savings, codes, -self.deltas)
+        return pd.DataFrame(savings, index=pd.Index(types, name='Type'), columns=self.utilities)
+
+    def emission_factors(self, factors: pd.DataFrame) -> np.ndarray:
+        """
+        Gathers the emissions factor of each impact's target and utility for every year of the
+        (UID, Utility) x year factor table, as an (impact, utility, year) array. Missing factors are zero
+        """
+        rows = factors.index.get_indexer(pd.MultiIndex.from_arrays([np.repeat(self.targets, len(self.utilities)),
+                                                                   np.tile(self.utilities, self.size)]))
+        values = np.vstack([np.nan_to_num(factors.to_numpy(dtype=float)), np.zeros(len(factors.columns))])
+        return values[rows].reshape(self.size, len(self.utilities), len(factors.columns))
+
+    def abatement_by_year(self, factors: pd.DataFrame, scale: float = None) -> pd.Series:
+        """
+        Emissions abated in each intervention year by the interventions of that year, from the
+        (UID, Utility) x year emissions factors. scale converts the factors' emissions to tCO2e;
+        by default, from the unit of the reference emissions factors
+        """
+        scale = data.tonnes[data.factors.default.unit] if scale is None else scale
+        columns = factors.columns.get_indexer(self.years)
+        gathered = self.emission_factors(factors)
+        year_factors = gathered[np.arange(self.size), :, columns] * (columns >= 0)[:, None]
+        abated = -(self.deltas * year_factors).sum(axis=1) * scale
+        years, codes = np.unique(self.years, return_inverse=True)
+        return pd.Series(np.bincount(codes, abated, minlength=len(years)), index=pd.Index(years, name='Year'),
+                         name='Abatement')
+
+    def emissions_avoided(self, factors: pd.DataFrame, scale: float = None) -> pd.DataFrame:
+        """
+        Emissions avoided each year, and cumulatively, over the years of the emissions factors.
+        Each impact is held at its intervention-year consumption change from that year on, and
+        valued at each later year's factor. scale is as for abatement_by_year
+        """
+        scale = data.tonnes[data.factors.default.unit] if scale is None else scale
+        gathered = self.emission_factors(factors)
+        active = self.years[:, None] <= np.asarray(factors.columns)[None, :]
+        avoided = -(np.einsum('nu,nuy->ny', self.deltas, gathered) * active).sum(axis=0) * scale
+        return pd.DataFrame({'Avoided': avoided, 'Cumulative': np.cumsum(avoided)},
+                            index=pd.Index(factors.columns, name='Year'))
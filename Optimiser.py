@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Searches for intervention plans which keep each asset within its CRREM target pathway.
+PlanKernel holds a portfolio as dense (asset, year, use) arrays, so that candidate plans are
+scored with array operations rather than by building Scenario and Intervention objects
+"""
+
+import numpy as np
+import pandas as pd
+import ReferenceData as data
+import pathwayFunctions as path
+import Engine
+
+
+class PlanKernel:
+    def __init__(self, model, types: list, constructors: dict, costs: dict = None, path_type: str = 'GHG-Int'):
+        """
+        Gathers the model's split BAU consumption, the per-use weights converting it to the pathway
+        type (emissions factors for GHG-Int, ones for kWh-Int) and the asset targets into arrays.
+        costs maps intervention types to the cost of one installation; types left out cost 1
+        """
+        split = model.bau_split()[0]
+        if path.is_sparse(split):
+            split = split.sparse.to_dense()
+
+        self.axis = split.index.droplevel('UID').unique()
+        self.uids = split.index.unique('UID')
+        self.years = split.columns
+        uid_codes = self.uids.get_indexer(split.index.get_level_values('UID'))
+        use_codes = self.axis.get_indexer(split.index.droplevel('UID'))
+        self.consumption = np.zeros((len(self.uids), len(self.years), len(self.axis)))
+        self.consumption[uid_codes, :, use_codes] = split.fillna(0).to_numpy(dtype=float)
+
+        if path_type == 'GHG-Int':
+            factors = data.factors.get_data(model.asset_data)
+            utilities = self.axis.get_level_values('Utility')
+            rows = factors.index.get_indexer(pd.MultiIndex.from_arrays([np.repeat(self.uids, len(utilities)),
+                                                                       np.tile(utilities, len(self.uids))]))
+            values = np.vstack([np.nan_to_num(factors.reindex(columns=self.years).to_numpy(dtype=float)),
+                                np.zeros(len(self.years))])
+            self.weights = values[rows].reshape(len(self.uids), len(self.axis), len(self.years)).transpose(0, 2, 1)
+        elif path_type == 'kWh-Int':
+            self.weights = np.ones_like(self.consumption)
+        else:
+            raise ValueError(f"Cannot search plans against pathway type {path_type}")
+
+        self.targets = (model.CRREM_Targets.xs(path_type, level='Pathway Code')
+                        .reindex(index=self.uids, columns=self.years)
+                        .fillna(np.inf)  # assets without a target never strand
+                        .to_numpy(dtype=float)
+                        )
+
+        self.types = list(types)
+        self.constructors = constructors
+        self.operators = np.zeros((len(self.types), len(self.axis), len(self.axis)))
+        for i, intervention_type in enumerate(self.types):
+            self.operators[i] = Engine.compile_operator(intervention_type, constructors[intervention_type], self.axis)
+        costs = costs or {}
+        self.costs = np.array([costs.get(intervention_type, 1) for intervention_type in self.types], dtype=float)
+
+    def emissions(self, consumption: np.ndarray = None, weights: np.ndarray = None) -> np.ndarray:
+        """
+        Pathways (asset, year) of a consumption block, by default the BAU
+        """
+        consumption = self.consumption if consumption is None else consumption
+        weights = self.weights if weights is None else weights
+        return np.einsum('ayk,ayk->ay', weights, consumption)
+
+    def score(self, targets, years, types) -> pd.DataFrame:
+        """
+        Evaluates a plan, given as equal length sequences in application order, returning the cost
+        of each targeted asset's interventions and the total by which its pathway exceeds its target
+        """
+        targets = np.asarray(targets, dtype=object)
+        touched = pd.Index(pd.unique(targets))
+        positions = self.uids.get_indexer(touched)
+        chains, _, after_ids = Engine.compile_chains(targets, list(types), self.axis, self.constructors)
+        matrices = chains.stack()
+
+        block = self.consumption[positions]
+        Engine.apply_chains(block, touched.get_indexer(targets), self.years.get_indexer(years), after_ids, matrices)
+        excess = np.clip(self.emissions(block, self.weights[positions]) - self.targets[positions], 0, None)
+
+        type_costs = dict(zip(self.types, self.costs))
+        costs = np.bincount(touched.get_indexer(targets), [type_costs.get(t, 1) for t in types], minlength=len(touched))
+        return pd.DataFrame({'Cost': costs, 'Excess': excess.sum(axis=1)}, index=pd.Index(touched, name='UID'))
+
+    def search(self, start_year: int, max_interventions: int = None, tolerance: float = 1e-9):
+        """
+        Greedy search. Each round, every asset still exceeding its target from start_year on is
+        given one more intervention, in the first year it exceeds the target, of whichever unused
+        type removes the most excess per unit cost. All candidates of a round are scored together.
+        Returns the plan (Target, Year, Type, Cost) and the assets still exceeding their targets
+        """
+        n_assets, n_years, n_uses = self.consumption.shape
+        n_types = len(self.types)
+        max_interventions = n_types if max_interventions is None else min(max_interventions, n_types)
+
+        eligible = np.asarray(self.years) >= start_year
+        consumption = self.consumption.copy()
+        pathway = self.emissions(consumption)
+        exceeding = (pathway - self.targets > tolerance) & eligible
+        used = np.zeros((n_assets, n_types), dtype=bool)
+        # (use, type x use) form of the operators, so weights are carried through every type in one product
+        stacked = self.operators.transpose(1, 0, 2).reshape(n_uses, n_types * n_uses)
+
+        steps = []
+        active = np.flatnonzero(exceeding.any(axis=1))
+        for _ in range(max_interventions):
+            if active.size == 0:
+                break
+            first = exceeding[active].argmax(axis=1)
+            after = np.arange(n_years)[None, :] >= first[:, None]
+            current = consumption[active]
+
+            weighted = (self.weights[active].reshape(-1, n_uses) @ stacked).reshape(len(active), n_years, n_types, n_uses)
+            candidates = np.einsum('aytk,ayk->aty', weighted, current)
+            candidates = np.where(after[:, None, :], candidates, pathway[active][:, None, :])
+            remaining = (np.clip(candidates - self.targets[active][:, None, :], 0, None) * eligible).sum(axis=2)
+            gain = (np.clip(pathway[active] - self.targets[active], 0, None) * eligible).sum(axis=1)[:, None] - remaining
+            value = np.where(~used[active] & (gain > tolerance), gain / self.costs, -np.inf)
+
+            best = value.argmax(axis=1)
+            ok = np.isfinite(value[np.arange(len(active)), best])
+            chosen, best, first, after = active[ok], best[ok], first[ok], after[ok]
+
+            applied = np.einsum('akj,ayj->ayk', self.operators[best], consumption[chosen])
+            consumption[chosen] = np.where(after[:, :, None], applied, consumption[chosen])
+            pathway[chosen] = self.emissions(consumption[chosen], self.weights[chosen])
+            exceeding[chosen] = (pathway[chosen] - self.targets[chosen] > tolerance) & eligible
+            used[chosen, best] = True
+            steps.append(pd.DataFrame({'Target': self.uids[chosen],
+                                       'Year': np.asarray(self.years)[first],
+                                       'Type': np.asarray(self.types, dtype=object)[best],
+                                       'Cost': self.costs[best]}))
+            active = chosen[exceeding[chosen].any(axis=1)]
+
+        plan = (pd.concat(steps, ignore_index=True) if steps
+                else pd.DataFrame({'Target': [], 'Year': [], 'Type': [], 'Cost': []}))
+        plan = (plan.sort_values('Year', kind='stable')
+                .reset_index(drop=True)
+                .astype({'Year': int})
+                )
+        unresolved = self.uids[exceeding.any(axis=1)]
+        return plan, unresolved
+
+
+def summarise(plan: pd.DataFrame, unresolved: pd.Index, asset_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Describes a plan per country and sector: the assets treated and left exceeding their
+    targets, the interventions, their cost, the years they span and the installation rate,
+    along with the count of each intervention type
+    """
+    assets = asset_data[['UID', 'Country Code', 'Sector Code']]
+    keys = ['Country Code', 'Sector Code']
+    plan = plan.merge(assets, left_on='Target', right_on='UID')
+
+    grouped = plan.groupby(keys, observed=True)
+    summary = pd.DataFrame({'Assets': assets.groupby(keys, observed=True)['UID'].count(),
+                            'Treated': grouped['Target'].nunique(),
+                            'Unresolved': assets[assets['UID'].isin(unresolved)].groupby(keys, observed=True)['UID'].count(),
+                            'Interventions': grouped.size(),
+                            'Cost': grouped['Cost'].sum(),
+                            'Start': grouped['Year'].min(),
+                            'End': grouped['Year'].max()})
+    summary[['Treated', 'Unresolved', 'Interventions', 'Cost']] = summary[['Treated', 'Unresolved', 'Interventions', 'Cost']].fillna(0)
+    summary['Installations per year'] = summary['Interventions'] / (summary['End'] - summary['Start'] + 1)
+    mix = (plan.groupby([*keys, 'Type'], observed=True)
+               .size()
+               .unstack('Type', fill_value=0)
+           )
+    return summary.join(mix).fillna({column: 0 for column in mix.columns})
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Dense array representation of pathway data. Each dimension of the array is a named axis
+(UID, Utility, Use, Pathway Code, Scenario, Year...) with an index of labels, so that
+operations broadcast by axis name and position instead of aligning pandas indexes
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class PathwayCube:
+    def __init__(self, values: np.ndarray, axes: dict, area: np.ndarray = None):
+        """
+        Stores an array of values along with an ordered dict of axis name -> labels, one per
+        array dimension. An optional area array over the UID axis is carried for normalisation
+        """
+        axes = {name: pd.Index(labels, name=name) for name, labels in axes.items()}
+        if values.shape != tuple(len(labels) for labels in axes.values()):
+            raise ValueError(f"Values of shape {values.shape} do not match axes {list(axes)}")
+        self.values = values
+        self.axes = axes
+        self.area = area
+
+    @property
+    def names(self) -> list:
+        return list(self.axes)
+
+    def position(self, name: str, labels) -> np.ndarray:
+        """
+        Maps labels on an axis to their integer positions, raising if any are missing
+        """
+        positions = self.axes[name].get_indexer(labels)
+        if (positions < 0).any():
+            raise KeyError(f"Labels {list(pd.Index(labels)[positions < 0])} not on axis {name}")
+        return positions
+
+    @classmethod
+    def from_series(cls, series: pd.Series) -> 'PathwayCube':
+        """
+        Builds a cube with one axis per index level. Label combinations absent from the
+        series are NaN
+        """
+        return cls.from_frame(series.to_frame('value'), column_axis=None)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, column_axis: str = 'Year') -> 'PathwayCube':
+        """
+        Builds a cube with one axis per index level, and the columns as the last axis. An
+        'Area' column, as attached by path.attach_asset_data, is taken as the area over UIDs.
+        Label combinations absent from the frame are NaN
+        """
+        area = None
+        if 'Area' in df.columns:
+            area = df['Area'].groupby('UID', observed=True).first()
+            df = df.drop(columns=['Area'])
+
+        index = df.index if isinstance(df.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([df.index])
+        axes = {}
+        codes = []
+        for level in range(index.nlevels):
+            labels = index.get_level_values(level)
+            axes[index.names[level]] = labels.unique().sort_values()
+            codes.append(axes[index.names[level]].get_indexer(labels))
+
+        shape = tuple(len(labels) for labels in axes.values())
+        if column_axis is None:
+            values = np.full(shape, np.nan)
+            values[tuple(codes)] = df.iloc[:, 0].to_numpy(dtype=float)
+        else:
+            axes[column_axis] = df.columns
+            values = np.full(shape + (len(df.columns),), np.nan)
+            values[tuple(codes)] = df.to_numpy(dtype=float)
+
+        cube = cls(values, axes)
+        if area is not None:
+            cube.area = area.reindex(cube.axes['UID']).to_numpy(dtype=float)
+        return cube
+
+    def to_frame(self, column_axis: str = 'Year', dropna: bool = True) -> pd.DataFrame:
+        """
+        Converts back to the DataFrame layout, with every other axis on the rows. Rows that are
+        entirely NaN, which include any label combinations absent from the source, are dropped by default
+        """
+        rows = [name for name in self.names if name != column_axis]
+        values = np.moveaxis(self.values, self.names.index(column_axis), -1)
+        index = (pd.MultiIndex.from_product([self.axes[name] for name in rows]) if len(rows) > 1
+                 else self.axes[rows[0]])
+        df = pd.DataFrame(values.reshape(len(index), -1), index=index, columns=self.axes[column_axis])
+        if dropna:
+            df = df.dropna(how='all')
+        if self.area is not None:
+            area = pd.Series(self.area, index=self.axes['UID'])
+            df['Area'] = area.reindex(df.index.get_level_values('UID')).to_numpy()
+        return df
+
+    def reindex(self, name: str, labels) -> 'PathwayCube':
+        """
+        Conforms an axis to new labels, filling new positions with NaN
+        """
+        positions = self.axes[name].get_indexer(labels)
+        dim = self.names.index(name)
+        values = np.take(self.values, positions, axis=dim)
+        missing = [slice(None)] * self.values.ndim
+        missing[dim] = positions < 0
+        values[tuple(missing)] = np.nan
+
+        axes = dict(self.axes)
+        axes[name] = pd.Index(labels, name=name)
+        area = self.area
+        if name == 'UID' and area is not None:
+            area = np.where(positions < 0, np.nan, area[positions])
+        return PathwayCube(values, axes, area)
+
+    def transpose(self, names: list) -> 'PathwayCube':
+        order = [self.names.index(name) for name in names]
+        return PathwayCube(self.values.transpose(order), {name: self.axes[name] for name in names}, self.area)
+
+    def multiply(self, other: 'PathwayCube') -> 'PathwayCube':
+        """
+        Broadcasting product by axis name. Shared axes are conformed to this cube's labels; axes
+        only on the other cube are appended after this cube's axes
+        """
+        for name in self.names:
+            if name in other.axes and not other.axes[name].equals(self.axes[name]):
+                other = other.reindex(name, self.axes[name])
+
+        extra = [name for name in other.names if name not in self.axes]
+        shared = [name for name in self.names if name in other.axes]
+        other_values = other.transpose(shared + extra).values
+        for dim, name in enumerate(self.names):
+            if name not in other.axes:
+                other_values = np.expand_dims(other_values, dim)
+
+        self_values = self.values.reshape(self.values.shape + (1,) * len(extra))
+        axes = dict(self.axes)
+        axes.update({name: other.axes[name] for name in extra})
+        return PathwayCube(self_values * other_values, axes, self.area)
+
+    def sum(self, names, column_axis: str = 'Year') -> 'PathwayCube':
+        """
+        Sums out the named axes as groupby sums do: NaN counts as zero within a group, and a
+        group with no data, on any label of column_axis, is NaN (so dropped by to_frame) rather
+        than zero. Without a column_axis, each cell with no data is NaN
+        """
+        names = [names] if isinstance(names, str) else list(names)
+        dims = tuple(self.names.index(name) for name in names)
+        axes = {name: labels for name, labels in self.axes.items() if name not in names}
+        area = None if 'UID' in names else self.area
+
+        empty = np.isnan(self.values).all(axis=dims)
+        if column_axis in axes:
+            empty = empty.all(axis=list(axes).index(column_axis), keepdims=True)
+        values = np.where(empty, np.nan, np.nansum(self.values, axis=dims))
+        return PathwayCube(values, axes, area)
+
+    def dropna(self, name: str) -> 'PathwayCube':
+        """
+        Drops labels on an axis whose slices are entirely NaN
+        """
+        dim = self.names.index(name)
+        other_dims = tuple(d for d in range(self.values.ndim) if d != dim)
+        keep = ~np.isnan(self.values).all(axis=other_dims)
+        return self.reindex(name, self.axes[name][keep])
+
+    def scale_by_area(self, power: int) -> 'PathwayCube':
+        """
+        Multiplies (power 1) or divides (power -1) every slice by its asset's area
+        """
+        if self.area is None:
+            raise ValueError("Cube does not carry an area")
+        shape = [1] * self.values.ndim
+        shape[self.names.index('UID')] = -1
+        return PathwayCube(self.values * (self.area ** power).reshape(shape), self.axes)
+
+    @classmethod
+    def stack(cls, cubes: dict, name: str = 'Scenario') -> 'PathwayCube':
+        """
+        Stacks cubes with matching axes along a new leading axis, labelled by the dict keys
+        """
+        first = next(iter(cubes.values()))
+        parts = [cube.transpose(first.names) for cube in cubes.values()]
+        for part in parts:
+            for axis_name in first.names:
+                if not part.axes[axis_name].equals(first.axes[axis_name]):
+                    raise ValueError(f"Cubes differ along axis {axis_name}")
+        axes = {name: list(cubes), **first.axes}
+        return cls(np.stack([part.values for part in parts]), axes, first.area)
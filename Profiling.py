@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of model runs. Stages are timed and counted, along with the rows
+they handle and (optionally) the memory they allocate, and the totals are available as a
+structured report. While disabled, each instrumented call costs one attribute check
+"""
+
+import inspect
+import json
+import time
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+
+_disabled = nullcontext()
+
+
+class _Stage:
+    def __init__(self, profiler, name, rows):
+        self.profiler = profiler
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        if self.profiler.memory:
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.perf_counter() - self.start, self.rows,
+                          tracemalloc.get_traced_memory()[0] - self.start_bytes if self.profiler.memory else 0)
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.stages = {}
+        self.counters = {}
+
+    def enable(self, memory: bool = False):
+        """
+        Starts collecting. With memory set, tracemalloc also records the net bytes each stage
+        allocates, which slows allocation-heavy stages considerably
+        """
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.enabled = False
+        self.memory = False
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name: str, rows: int = None):
+        """
+        Context manager timing a stage. rows, if given, is added to the stage's rows touched
+        """
+        if not self.enabled:
+            return _disabled
+        return _Stage(self, name, rows)
+
+    def add(self, name: str, seconds: float, rows: int = None, nbytes: int = 0, calls: int = 1):
+        """
+        Adds to a stage's totals directly, for work not timed by one context
+        """
+        stats = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0})
+        stats['calls'] += calls
+        stats['seconds'] += seconds
+        stats['rows'] += rows or 0
+        stats['bytes'] += nbytes
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self) -> dict:
+        """
+        Totals per stage, slowest first, and the counters. Only work done in this process is
+        included, so scenarios evaluated in a process pool appear as a single stage
+        """
+        stages = dict(sorted(self.stages.items(), key=lambda item: item[1]['seconds'], reverse=True))
+        return {'stages': {name: dict(stats) for name, stats in stages.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.report(), **kwargs)
+
+
+profiler = Profiler()
+
+
+def row_count(result) -> int:
+    """
+    Rows in a frame, or in a tuple led by one, or row-equivalents (every axis but the last) in a PathwayCube,
+    or the rows held by a ScenarioDeltas (its base, full frames and deltas)
+    """
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(getattr(result, 'axes', None), dict):
+        return result.values.size // max(result.values.shape[-1], 1)
+    if isinstance(getattr(result, 'deltas', None), dict):
+        return len(result.base) + sum(len(frame) for frames in (result.full, result.deltas) for frame in frames.values())
+    return len(result)
+
+
+def profiled(name: str, rows=None):
+    """
+    Decorator timing every call of a function as a stage of the given name. rows, if given,
+    is applied to the function's result to count the rows touched. For a generator function,
+    the time spent producing its items is summed over the whole iteration, as one call, and
+    rows is applied to each item
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator(*args, **kwargs):
+                if not profiler.enabled:
+                    return (yield from func(*args, **kwargs))
+                seconds, count, nbytes = 0.0, 0, 0
+                iterator = func(*args, **kwargs)
+                try:
+                    while True:
+                        start_bytes = tracemalloc.get_traced_memory()[0] if profiler.memory else 0
+                        start = time.perf_counter()
+                        try:
+                            item = next(iterator)
+                        except StopIteration as stop:
+                            return stop.value
+                        finally:
+                            seconds += time.perf_counter() - start
+                            if profiler.memory:
+                                nbytes += tracemalloc.get_traced_memory()[0] - start_bytes
+                        if rows is not None:
+                            count += rows(item)
+                        yield item
+                finally:
+                    iterator.close()
+                    profiler.add(name, seconds, count, nbytes)
+            return generator
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.stage(name) as stage:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    stage.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
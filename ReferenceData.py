@@ -4,13 +4,142 @@ Establishes classes to handle lookups against default parameters which may be
 customised, then uses these to create instances contained configured data for
 the reference parameters used throughout the model
 """
+import os
+import hashlib
+import threading
+import numpy as np
 import pandas as pd
 from abc import ABC, abstractmethod
-from Schemas import Asset_Data
+from collections import OrderedDict
+from Schemas import Asset_Data, key_columns
+from Profiling import profiler
 
 sparse = pd.SparseDtype(float,fill_value=0)
 
+# tonnes CO2e in one unit of emissions
+tonnes = {'kgCO2e': 1e-3, 'tCO2e': 1.0}
+
+_digests = {}
+
+def workbook_digest(filepath):
+    '''
+    Hashes a workbook's contents, remembering the result for as long as its mtime and size hold
+    '''
+    stat = os.stat(filepath)
+    stamp = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    if stamp not in _digests:
+        with open(filepath, 'rb') as f:
+            _digests[stamp] = hashlib.sha256(f.read()).hexdigest()
+    return _digests[stamp], stat.st_mtime_ns
+
+def read_excel_cached(filepath, sheet_name, cache_dir=None, **kwargs) -> pd.DataFrame:
+    '''
+    Reads a sheet through a binary (pickle) copy held in cache_dir, by default a .cache folder
+    beside the workbook. The copy is keyed by the workbook's hash and mtime, so it is rebuilt
+    whenever the workbook changes
+    '''
+    digest, mtime = workbook_digest(filepath)
+    key = hashlib.sha256(repr((digest, mtime, sheet_name, sorted(kwargs.items()))).encode()).hexdigest()[:16]
+    
+    cache_dir = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(filepath), '.cache')
+    prefix = ''.join(c if c.isalnum() else '_' for c in f"{os.path.basename(filepath)}-{sheet_name}")
+    cache_path = os.path.join(cache_dir, f"{prefix}-{key}.pkl")
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+    
+    df = pd.read_excel(filepath, sheet_name=sheet_name, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(f"{prefix}-"):
+            os.remove(os.path.join(cache_dir, stale))
+    temp_path = f"{cache_path}.{os.getpid()}"
+    df.to_pickle(temp_path)
+    os.replace(temp_path, cache_path)  # atomic, so concurrent workers never read a partial file
+    return df
+
+def key_dtypes(*frames) -> dict:
+    '''
+    Categorical dtypes for the key columns found in the given frames (as columns or index levels),
+    shared with the reference tables: each key's categories are the sorted values it takes in the
+    frames and in the default pathways, factors and splits. Frames encoded with these dtypes then
+    merge and group on integer codes, with each other and with the reference data
+    '''
+    references = [default_pathways.default, default_factors.default, default_splits.default]
+    values = {key: [] for key in key_columns}
+    for df in [*frames, *references]:
+        for key in key_columns:
+            if key in df.columns:
+                values[key].append(pd.unique(df[key]))
+            elif key in df.index.names:
+                values[key].append(df.index.unique(key))
+    values['Sector Code'].append(default_splits.default.columns)
+    return {key: pd.CategoricalDtype(pd.Index(np.concatenate(parts)).unique().sort_values())
+            for key, parts in values.items() if parts}
+
+def encode_keys(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    '''
+    Converts the key columns of a frame to the given shared categorical dtypes
+    '''
+    return df.astype({key: dtype for key, dtype in dtypes.items() if key in df.columns})
+
+def conform_keys(df: pd.DataFrame, like: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Gives the key columns of a reference frame the categorical dtypes of another frame's key
+    columns, so that merging the two joins on codes. Values outside the categories (which could
+    not match anyway) become NaN
+    '''
+    return df.astype({key: like[key].dtype for key in key_columns
+                      if key in df.columns and key in like.columns and isinstance(like[key].dtype, pd.CategoricalDtype)})
+
+def freeze(df):
+    '''
+    Returns the frame over read-only copies of its values, so that a table shared by every model
+    in the process cannot be changed in place by any of them. Copies of the frame are writeable.
+    A frame of one numpy dtype is kept as a single array; otherwise each numpy column is frozen
+    alone, and extension columns (eg categoricals) are left as they are
+    '''
+    if not isinstance(df, pd.DataFrame):
+        return df
+    dtypes = df.dtypes.unique()
+    if len(dtypes) == 1 and isinstance(dtypes[0], np.dtype):
+        values = df.to_numpy(copy=True)
+        values.flags.writeable = False
+        return pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
+    columns = {}
+    for position in range(df.shape[1]):
+        column = df.iloc[:, position]
+        if isinstance(column.dtype, np.dtype):
+            column = column.to_numpy(copy=True)
+            column.flags.writeable = False
+        columns[position] = column
+    frozen = pd.DataFrame(columns, index=df.index, copy=False)
+    frozen.columns = df.columns
+    return frozen
+
 class Default_Data(ABC):
+    # asset columns which the defaults depend on, used to fingerprint asset tables
+    columns = ['UID']
+    
+    def __init__(self, filepath):
+        '''
+        Stores the path to the source workbook; the defaults are only read on first access
+        '''
+        self.filepath = filepath
+        self._default = None
+    
+    @property
+    def default(self) -> pd.DataFrame:
+        if self._default is None:
+            self._default = freeze(self.load())
+        return self._default
+    
+    @abstractmethod
+    def load(self) -> pd.DataFrame:
+        '''
+        Should read the default parameters from self.filepath
+        '''
+        pass
+    
     @abstractmethod
     def get_defaults(self, assets: Asset_Data) -> pd.DataFrame:
         '''
@@ -18,28 +147,103 @@ class Default_Data(ABC):
         '''
         pass
 
+def fingerprint(df: pd.DataFrame, index: bool = False) -> str:
+    '''
+    Hashes the contents of a frame (or index), for use as a cache key
+    '''
+    if df is None:
+        return None
+    hashes = pd.util.hash_pandas_object(df, index=index).to_numpy()
+    return hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
 class Configured_Data:
-    def __init__(self, default: Default_Data, custom_data: pd.DataFrame = None):
+    def __init__(self, default: Default_Data, custom_data: pd.DataFrame = None, maxsize: int = 16):
         '''
-        Stores a Default_Data store, and a dataframe of custom values to override with
+        Stores a Default_Data store, and a dataframe of custom values to override with.
+        Lookups are memoised, keyed by a fingerprint of the asset columns the defaults depend on
+        and of the custom data; at most maxsize results are kept, least recently used first out
         '''
         self.default = default
         self.custom = custom_data
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._requested = OrderedDict()  # keys of alignments asked for once, not yet cached
+        self._lock = threading.Lock()
         
-        
-    def get_data(self, assets: Asset_Data) -> pd.DataFrame:
+    def invalidate(self):
         '''
-        Gets the default data, then overwrites it with custom data wherever specified
+        Drops all memoised lookups, eg after a default table has been replaced
         '''
-        df = self.default.get_defaults(assets)
-        if self.custom == None:
+        with self._lock:
+            self._cache.clear()
+            self._requested.clear()
+        
+    def _memoised(self, key, compute):
+        # The lock guards the cache itself, so models built on several threads can share it;
+        # lookups missing on two threads at once are both computed, and the later one kept
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                profiler.count(f"{type(self.default).__name__}.get_data cache hits")
+                return self._cache[key]
+        value = compute()
+        with self._lock:
+            self._cache[key] = value
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return value
+        
+    def _key(self, assets: Asset_Data, **kwargs) -> tuple:
+        columns = [column for column in self.default.columns if column in assets.columns]
+        return (fingerprint(assets[columns]), fingerprint(self.custom, index=True), tuple(sorted(kwargs.items())))
+        
+    def _compute(self, assets: Asset_Data, **kwargs) -> pd.DataFrame:
+        with profiler.stage(f"{type(self.default).__name__}.get_data", rows=len(assets)):
+            df = self.default.get_defaults(assets, **kwargs)
+            if self.custom is None:
+                return df
+            df.loc[df.index.intersection(self.custom.index)]=self.custom
             return df
-        df.loc[df.index.intersection(self.custom.index)]=self.custom
-        return df
+        
+    def get_data(self, assets: Asset_Data, **kwargs) -> pd.DataFrame:
+        '''
+        Gets the default data, then overwrites it with custom data wherever specified.
+        Keyword arguments are passed to the default's get_defaults, and the custom data
+        should share the layout they request. A copy is returned, so the cached result is never modified
+        '''
+        key = ('data',) + self._key(assets, **kwargs)
+        return self._memoised(key, lambda: self._compute(assets, **kwargs)).copy()
+    
+    def get_aligned(self, assets: Asset_Data, like: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Gets the data conformed to the rows and columns of another frame (eg factors to a frame of
+        consumption pathways), so the two can be multiplied without index alignment. Rows or columns
+        with no data are NaN. Results are keyed by a fingerprint of like's index, and only kept once
+        the same alignment has been asked for twice, so one-off alignments never fill the cache.
+        The result may be shared between calls, so is read-only
+        '''
+        key = ('aligned', fingerprint(like.index), tuple(like.columns)) + self._key(assets)
+        compute = lambda: freeze(self.get_data(assets).reindex(index=like.index, columns=like.columns))
+        with self._lock:
+            repeated = key in self._cache or key in self._requested
+            self._requested[key] = None
+            self._requested.move_to_end(key)
+            if len(self._requested) > self.maxsize:
+                self._requested.popitem(last=False)
+        return self._memoised(key, compute) if repeated else compute()
+    
+    def get_index(self, assets: Asset_Data) -> pd.Index:
+        '''
+        Gets the index of the data for the assets, without copying the data
+        '''
+        key = ('index',) + self._key(assets)
+        return self._memoised(key, lambda: self._compute(assets).index)
         
 class Default_Pathways(Default_Data):
-    def __init__(self,filepath):
-        self.default = pd.concat([pd.read_excel(filepath,
+    columns = ['UID','Country Code','Sector Code','Area']
+    
+    def load(self):
+        return pd.concat([read_excel_cached(self.filepath,
                                             sheet_name=sheetname,
                                             index_col=[2, 1,0]) 
                                   for sheetname in ["GHG Pathways", "CO2 Pathways", "Energy Pathways"]])
@@ -47,14 +251,14 @@ class Default_Pathways(Default_Data):
     def get_defaults(self, assets: Asset_Data,) -> pd.DataFrame:   
         CRREM_Pathways = self.default
         
-        pathways = (assets[['UID','Country Code','Sector Code','Area']]
-                               .merge(CRREM_Pathways.reset_index(),
-                                      left_on=['Sector Code','Country Code'],
-                                      right_on=['Sector Code','Country Code'])
-                               .drop(columns=['Country Code','Sector Code'])
-                               .set_index(['UID','Pathway Code'])
-                               .sort_index()
-                               )
+        assets = assets[['UID','Country Code','Sector Code','Area']]
+        pathways = (assets.merge(conform_keys(CRREM_Pathways.reset_index(), assets),
+                                 left_on=['Sector Code','Country Code'],
+                                 right_on=['Sector Code','Country Code'])
+                          .drop(columns=['Country Code','Sector Code'])
+                          .set_index(['UID','Pathway Code'])
+                          .sort_index()
+                    )
         
         budgets = (pathways.multiply(pathways['Area'],axis=0)
                             .drop(columns=['Area'])
@@ -63,31 +267,53 @@ class Default_Pathways(Default_Data):
         return budgets
 
 class Default_Splits(Default_Data):
-    def __init__(self,filepath):
-        self.default = (pd.read_excel(filepath,
-                                      sheet_name='Energy Splits',
-                                      index_col=[0,1])
-                             .sort_index())
+    columns = ['UID','Sector Code']
     
-    def get_defaults(self, assets: Asset_Data) -> pd.DataFrame:
-        splits = pd.concat([self.default[assets.loc[assets['UID']==asset,'Sector Code']].squeeze() for asset in assets['UID']],
-                              keys = assets['UID'],
-                              names=['UID'])
+    def load(self):
+        return (read_excel_cached(self.filepath,
+                                  sheet_name='Energy Splits',
+                                  index_col=[0,1])
+                       .sort_index())
+    
+    def get_defaults(self, assets: Asset_Data, dense: bool = False) -> pd.DataFrame:
+        '''
+        Looks up each asset's sector column of splits. By default these are returned stacked,
+        with (UID, Utility, Use) rows; with dense set, a UID x (Utility, Use) frame is returned
+        instead, whose values are the array broadcast against in path.split_pathway
+        '''
+        sectors = self.default.columns.get_indexer(assets['Sector Code'])
+        if (sectors < 0).any():
+            raise KeyError(f"No default splits for sectors {assets['Sector Code'][sectors < 0].unique().tolist()}")
+        
+        values = self.default.to_numpy()[:, sectors].T
+        if dense:
+            return pd.DataFrame(values, index=pd.Index(assets['UID'], name='UID'), columns=self.default.index)
+        
+        uses = self.default.index
+        index = pd.MultiIndex.from_arrays([np.repeat(assets['UID'].to_numpy(), len(uses)),
+                                           *(np.tile(uses.get_level_values(level), len(assets))
+                                             for level in range(uses.nlevels))],
+                                          names=['UID', *uses.names])
+        splits = pd.Series(values.ravel(), index=index)
         return splits
 
 class Default_Factors(Default_Data):
-    def __init__(self,filepath):
+    columns = ['UID','Country Code']
+    # emissions per kWh of the factor workbook
+    unit = 'kgCO2e'
+    
+    def load(self):
         utilities = ["Elec Emissions Factors", "DH&C Emissions Factors", "Gas Emissions Factors"]
-        self.default = pd.concat([pd.read_excel(filepath,
-                                           sheet_name=sheetname,
-                                           index_col=[1,0])
-                             for sheetname in utilities])
+        return pd.concat([read_excel_cached(self.filepath,
+                                            sheet_name=sheetname,
+                                            index_col=[1,0])
+                          for sheetname in utilities])
     
     def get_defaults(self, assets: Asset_Data) -> pd.DataFrame:
-        factors = (assets[['UID','Country Code']]
-                           .merge(self.default.reset_index(), left_on='Country Code', right_on='Country Code')
-                           .drop(columns=['Country Code'])
-                           .set_index(['UID','Utility'])
+        assets = assets[['UID','Country Code']]
+        factors = (assets.merge(conform_keys(self.default.reset_index(), assets), left_on='Country Code', right_on='Country Code')
+                         .drop(columns=['Country Code'])
+                         .set_index(['UID','Utility'])
                    )
         return factors
 
@@ -102,16 +328,32 @@ pathways = Configured_Data(default_pathways)
 default_splits = Default_Splits('Reference Data/Intervention Parameters.xlsx')
 splits = Configured_Data(default_splits)
 
-efficiency_parameters = (pd.read_excel('Reference Data/Intervention Parameters.xlsx',
-                              sheet_name='Efficiency Interventions',
-                              index_col=[0,1])
-                           .sort_index())
+def reference_digest() -> str:
+    '''
+    Identifies the reference data in use: the contents of the reference workbooks (which also
+    hold the intervention parameters) and any custom data
+    '''
+    parts = [workbook_digest(default.filepath)[0] for default in (default_factors, default_pathways, default_splits)]
+    parts += [str(fingerprint(configured.custom, index=True)) for configured in (factors, pathways, splits)]
+    return hashlib.sha256(' '.join(parts).encode()).hexdigest()[:16]
 
-utility_use = efficiency_parameters.index
+# Parameter tables are loaded on first attribute access (PEP 562), then kept as module globals
+_lazy_tables = {
+    'efficiency_parameters': lambda: (read_excel_cached('Reference Data/Intervention Parameters.xlsx',
+                                                        sheet_name='Efficiency Interventions',
+                                                        index_col=[0,1])
+                                      .sort_index()),
+    'utility_use': lambda: __getattr__('efficiency_parameters').index,
+    'reassignment_parameters': lambda: read_excel_cached('Reference Data/Intervention Parameters.xlsx',
+                                                         sheet_name='Reassignment Interventions'),
+    }
 
-reassignment_parameters = (pd.read_excel('Reference Data/Intervention Parameters.xlsx',
-                              sheet_name='Reassignment Interventions')
-                           )
+def __getattr__(name):
+    if name not in _lazy_tables:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name not in globals():
+        globals()[name] = freeze(_lazy_tables[name]())
+    return globals()[name]
 
 
 #%% Legacy code to be converted
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Hosts the models of many portfolios in one process, keyed by portfolio id and the hash of
+the portfolio's contents. Every model reads the same module-level (read-only) reference
+data; the models themselves are bounded in number and size, the least recently used being
+evicted first, and optionally spilled to disk so they are reloaded rather than rebuilt
+"""
+
+import os
+import sys
+import pickle
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+import ReferenceData as data
+import Runner
+from Ledger import ImpactLedger
+from Deltas import ScenarioDeltas
+from Interventions import Model, Scenario, InterventionPlan, Intervention
+
+
+def content_hash(source) -> str:
+    """
+    Identifies a portfolio's contents: a workbook by its hash along with the reference workbooks',
+    as Runner.results_key, and a dict of sheets by the fingerprints of its frames
+    """
+    if isinstance(source, dict):
+        fingerprints = ' '.join(f"{sheet}:{data.fingerprint(df)}" for sheet, df in sorted(source.items()))
+        return hashlib.sha256(fingerprints.encode()).hexdigest()[:16]
+    return Runner.results_key(source)
+
+
+def build_model(source):
+    """
+    Reads (or ingests) a portfolio, builds its model and applies its scenarios. The pathways
+    are kept on the model as scenario_pathway_data
+    """
+    portfolio = Runner.ingest(source) if isinstance(source, dict) else Runner.read_portfolio(source)
+    return Runner.run_portfolio(portfolio)[0]
+
+
+def model_nbytes(model) -> int:
+    """
+    Estimates the memory held by a model: its frames (including their indexes), impact ledgers
+    and cached results, and its scenarios with their plans and interventions. Objects reached
+    more than once are counted once
+    """
+    seen = set()
+
+    def nbytes(value) -> int:
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(deep=True).sum())
+        if isinstance(value, (pd.Series, pd.Index)):
+            return int(value.memory_usage(deep=True))
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, ScenarioDeltas):
+            return value.nbytes
+        if isinstance(value, ImpactLedger):
+            return sum(array.nbytes for array in (value.targets, value.years, value.types, value.costs, value.deltas))
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(item) for item in value)
+        if isinstance(value, dict):
+            return sum(nbytes(item) for item in value.values())
+        if isinstance(value, (Model, Scenario, InterventionPlan, Intervention)):
+            return sys.getsizeof(value) + nbytes(vars(value))
+        return 0
+
+    return nbytes(model)
+
+
+class ModelRegistry:
+    def __init__(self, max_models: int = 8, max_bytes: int = None, spill_dir: str = None, build=build_model):
+        """
+        Holds at most max_models models, and (if given) at most max_bytes of them as estimated by
+        model_nbytes, though always the most recently used. With spill_dir set, evicted models
+        are pickled there and reloaded on their next use; processes sharing the directory share
+        the spilled models. build turns a portfolio source (workbook path or dict of sheets) into a model
+        """
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.build = build
+        self._models = OrderedDict()  # (portfolio id, content hash) -> model
+        self._sizes = {}
+        self._current = {}  # portfolio id -> content hash
+        self._lock = threading.Lock()
+        self._building = {}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    def __contains__(self, portfolio_id) -> bool:
+        return (portfolio_id, self._current.get(portfolio_id)) in self._models
+
+    def keys(self) -> list:
+        """
+        The (portfolio id, content hash) of each model in memory, least recently used first
+        """
+        with self._lock:
+            return list(self._models)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def spill_path(self, key: tuple) -> str:
+        portfolio_id, digest = key
+        name = ''.join(c if c.isalnum() else '_' for c in str(portfolio_id))
+        return os.path.join(self.spill_dir, f"{name}-{digest}.pkl")
+
+    def get(self, portfolio_id, source, digest: str = None):
+        """
+        The model of a portfolio's current contents, from memory, else from the spill directory,
+        else built from source. digest defaults to content_hash(source). A portfolio whose
+        contents have changed has its previous model dropped. Concurrent requests for the same
+        model wait for a single build
+        """
+        digest = digest or content_hash(source)
+        key = (portfolio_id, digest)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            building = self._building.setdefault(key, threading.Lock())
+
+        try:
+            with building:
+                with self._lock:
+                    if key in self._models:
+                        self._models.move_to_end(key)
+                        return self._models[key]
+                model = self._load(key)
+                if model is None:
+                    model = self.build(source)
+                self._insert(key, model)
+            return model
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+
+    def _load(self, key: tuple):
+        if not self.spill_dir:
+            return None
+        try:
+            with open(self.spill_path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _spill(self, key: tuple, model):
+        path = self.spill_path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)  # atomic, so other processes never load a partial model
+
+    def _insert(self, key: tuple, model):
+        portfolio_id, digest = key
+        with self._lock:
+            previous = self._current.get(portfolio_id)
+            self._current[portfolio_id] = digest
+            stale = previous is not None and previous != digest
+            if stale:
+                self._models.pop((portfolio_id, previous), None)
+                self._sizes.pop((portfolio_id, previous), None)
+            self._models[key] = model
+            self._sizes[key] = model_nbytes(model)
+
+            evicted = []
+            while len(self._models) > 1 and (len(self._models) > self.max_models
+                                             or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                old_key, old_model = self._models.popitem(last=False)
+                self._sizes.pop(old_key)
+                evicted.append((old_key, old_model))
+
+        if self.spill_dir:
+            if stale:
+                try:
+                    os.remove(self.spill_path((portfolio_id, previous)))
+                except FileNotFoundError:
+                    pass
+            for old_key, old_model in evicted:
+                self._spill(old_key, old_model)
+
+    def evict(self, portfolio_id, spill: bool = True):
+        """
+        Drops a portfolio's model from memory, spilling it to disk if the registry spills
+        """
+        with self._lock:
+            key = (portfolio_id, self._current.get(portfolio_id))
+            model = self._models.pop(key, None)
+            self._sizes.pop(key, None)
+        if model is not None and spill and self.spill_dir:
+            self._spill(key, model)
+
+    def clear(self):
+        """
+        Drops every model from memory, leaving the spill directory as it is
+        """
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
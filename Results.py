@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Result stores built once after the model has run, so that dashboard queries resolve
+against pre-aggregated rows rather than the full long-format results
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def compress(groups: np.ndarray, values: np.ndarray, weights: np.ndarray, size: int):
+    """
+    Reduces the weighted values of each group to a sketch of at most size centroids, each the
+    weighted mean of an equal share of the group's weight. Groups with no more than size values
+    are kept exactly. Sketches merge by concatenation, so weighted quantiles of any union of
+    groups are within about 1/size of the exact ones. NaN values are dropped.
+    Returns the group, value and weight of each centroid
+    """
+    keep = ~np.isnan(values)
+    groups, values, weights = groups[keep], values[keep], weights[keep]
+    order = np.lexsort((values, groups))
+    groups, values, weights = groups[order], values[order], weights[order]
+
+    counts = np.bincount(groups)
+    totals = np.bincount(groups, weights)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(groups)) - starts[groups]
+    before = np.cumsum(weights) - weights
+    before -= before[starts][groups]
+    midpoint = (before + weights / 2) / totals[groups]
+    bucket = np.where(counts[groups] > size, np.floor(midpoint * size).astype(int), rank)
+
+    keys, inverse = np.unique(groups * size + bucket, return_inverse=True)
+    centroid_weights = np.bincount(inverse, weights)
+    centroid_values = np.bincount(inverse, values * weights) / centroid_weights
+    return keys // size, centroid_values, centroid_weights
+
+
+def weighted_quantiles(values: np.ndarray, weights: np.ndarray, quantiles) -> np.ndarray:
+    """
+    Quantiles of weighted values, interpolating between the weight midpoints of the sorted values
+    """
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    cumulative = np.cumsum(weights)
+    return np.interp(quantiles, (cumulative - weights / 2) / cumulative[-1], values)
+
+
+class ResultCube:
+    keys = ['Scenario', 'Pathway Code', 'Country Code', 'Sector Code']
+    sketch_size = 64
+    quantiles = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+    def __init__(self, results: pd.DataFrame):
+        """
+        Takes long-format results (one row per Scenario, UID and Pathway Code, with year columns
+        and the attached Country Code, Sector Code and Area) and pre-sums the year columns and
+        area of each (Scenario, Pathway Code, Country Code, Sector Code) group. The asset
+        intensities of each group are also summarised, as per-year minima, maxima and
+        area-weighted quantile sketches
+        """
+        self.deltas = None
+        self.store = None
+        self.attributes = None
+        self.by_asset = ResultCube.index_rows(results)
+        self.cube, self.minimum, self.maximum, self.sketches = ResultCube.summarise(self.by_asset)
+
+    @classmethod
+    def from_store(cls, store, results: pd.DataFrame = None) -> 'ResultCube':
+        """
+        Builds the cube from the pathways of a ResultStore (or results already read from it),
+        keeping only the summaries: queries on assets read the selected assets' rows from the
+        store, so processes serving the same store do not each hold its rows
+        """
+        cube = cls.__new__(cls)
+        cube.deltas = cube.attributes = cube.by_asset = None
+        cube.store = store
+        results = store.read() if results is None else results
+        cube.cube, cube.minimum, cube.maximum, cube.sketches = ResultCube.summarise(ResultCube.index_rows(results))
+        return cube
+
+    @staticmethod
+    def index_rows(results: pd.DataFrame) -> pd.DataFrame:
+        """
+        Indexes long-format results by UID and the cube's keys
+        """
+        return (results.set_index(['UID', *ResultCube.keys])
+                       .sort_index()
+                )
+
+    @classmethod
+    def from_deltas(cls, pathways, asset_data: pd.DataFrame) -> 'ResultCube':
+        """
+        Builds the cube from pathways held as ScenarioDeltas, with the asset data giving each UID's
+        Country Code, Sector Code and Area, without expanding the scenarios held as deltas. Their
+        group sums are the base's plus their deltas', and the minima, maxima and sketches of groups
+        holding no changed asset are the base's; only groups with changed assets are summarised
+        afresh. Queries on assets rebuild the selected assets' rows
+        """
+        cube = cls.__new__(cls)
+        cube.deltas = pathways
+        cube.store = None
+        cube.attributes = asset_data.set_index('UID')[['Country Code', 'Sector Code', 'Area']]
+        cube.by_asset = None
+
+        groups = ResultCube.keys[1:]
+        base = ResultCube.summarise(cube.long(pathways.base, pathways.base_name))
+        parts = ([base] if pathways.listed else []) + [ResultCube.summarise(cube.long(frame, name))
+                                                        for name, frame in pathways.full.items()]
+        members = pathways.base.index.get_level_values('UID')
+        member_groups = pd.MultiIndex.from_arrays([pathways.base.index.get_level_values('Pathway Code'),
+                                                   cube.attributes['Country Code'].reindex(members).to_numpy(),
+                                                   cube.attributes['Sector Code'].reindex(members).to_numpy()],
+                                                  names=groups)
+        for name, delta in pathways.deltas.items():
+            delta = cube.long(delta.sparse.to_dense(), name).assign(Area=0.0)  # areas are in the base's sums
+            touched = delta.index.droplevel(['UID', 'Scenario']).unique()
+            # Every asset of a touched group is summarised again, so its minima, maxima and sketches are complete
+            uids = members[member_groups.isin(touched)].unique()
+            fresh = ResultCube.summarise(cube.long(pathways.scenario(name, uids=uids), name))
+
+            def relabel(frame: pd.DataFrame) -> pd.DataFrame:
+                keep = ~frame.index.droplevel('Scenario').isin(touched)
+                return frame[keep].rename(index={pathways.base_name: name}, level='Scenario')
+
+            sums = (delta.droplevel('UID')
+                         .groupby(ResultCube.keys, observed=True)
+                         .sum()
+                    )
+            parts.append((base[0].rename(index={pathways.base_name: name}, level='Scenario').add(sums, fill_value=0),
+                          *(pd.concat([relabel(base_part), fresh_part]).sort_index()
+                            for base_part, fresh_part in zip(base[1:], fresh[1:]))))
+
+        cube.cube, cube.minimum, cube.maximum, cube.sketches = (pd.concat([part[i] for part in parts])
+                                                                 for i in range(4))
+        return cube
+
+    def long(self, frame: pd.DataFrame, scenario: str) -> pd.DataFrame:
+        """
+        Indexes a scenario's (UID, Pathway Code) frame as by_asset, from the asset attributes
+        """
+        uids = frame.index.get_level_values('UID')
+        attributes = self.attributes.reindex(uids)
+        index = pd.MultiIndex.from_arrays([uids, np.full(len(frame), scenario, dtype=object),
+                                           frame.index.get_level_values('Pathway Code'),
+                                           attributes['Country Code'].to_numpy(),
+                                           attributes['Sector Code'].to_numpy()],
+                                          names=['UID', *ResultCube.keys])
+        return (pd.DataFrame(frame.to_numpy(dtype=float), index=index, columns=frame.columns)
+                .assign(Area=attributes['Area'].to_numpy())
+                )
+
+    def asset_rows(self, assets) -> pd.DataFrame:
+        """
+        The asset-level rows of the given UIDs, indexed as by_asset
+        """
+        if self.by_asset is not None:
+            return self.by_asset.loc[self.by_asset.index.unique('UID').intersection(assets)]
+        if self.store is not None:
+            return ResultCube.index_rows(self.store.read(assets=list(assets)))
+        uids = self.attributes.index.intersection(assets)
+        return (pd.concat([self.long(self.deltas.scenario(name, uids=uids), name) for name in self.deltas.names])
+                .sort_index()
+                )
+
+    @staticmethod
+    def summarise(by_asset: pd.DataFrame):
+        """
+        The group sums, intensity minima, maxima and sketches of asset-level rows
+        """
+        cube = (by_asset.droplevel('UID')
+                        .groupby(ResultCube.keys, observed=True)
+                        .sum()
+                )
+        intensity = ResultCube.asset_intensities(by_asset).droplevel('UID')
+        return (cube,
+                intensity.groupby(ResultCube.keys, observed=True).min(),
+                intensity.groupby(ResultCube.keys, observed=True).max(),
+                ResultCube.sketch(intensity, by_asset['Area'].to_numpy()))
+
+    @staticmethod
+    def asset_intensities(by_asset: pd.DataFrame) -> pd.DataFrame:
+        return (by_asset.drop(columns=['Area'])
+                .div(by_asset['Area'], axis=0)
+                )
+
+    @staticmethod
+    def sketch(intensity: pd.DataFrame, area: np.ndarray, size: int = None) -> pd.DataFrame:
+        """
+        Compresses asset intensities into centroids (Year, Value, Weight) indexed by group
+        """
+        size = size or ResultCube.sketch_size
+        codes, groups = pd.factorize(intensity.index)
+        groups = groups.set_names(intensity.index.names)
+        parts = []
+        for year, values in intensity.items():
+            group, value, weight = compress(codes, values.to_numpy(dtype=float), area, size)
+            parts.append(pd.DataFrame({'Year': year, 'Value': value, 'Weight': weight},
+                                      index=groups[group]))
+        return pd.concat(parts).sort_index()
+
+    @staticmethod
+    def select(index: pd.MultiIndex, scenarios, path_type, countries=None, sectors=None) -> np.ndarray:
+        mask = ((index.get_level_values('Scenario').isin(scenarios))
+                & (index.get_level_values('Pathway Code') == path_type))
+        if countries is not None:
+            mask &= index.get_level_values('Country Code').isin(countries)
+        if sectors is not None:
+            mask &= index.get_level_values('Sector Code').isin(sectors)
+        return mask
+
+    def totals(self, scenarios, path_type, countries=None, sectors=None, assets=None) -> pd.DataFrame:
+        """
+        Sums the year columns and Area of the selected rows for each scenario. Selections left as
+        None are not filtered on. Filtering on assets falls back to the asset-level results,
+        since the cube does not retain UIDs
+        """
+        if assets is not None:
+            source = self.asset_rows(assets).droplevel('UID')
+        else:
+            source = self.cube
+
+        mask = ResultCube.select(source.index, scenarios, path_type, countries, sectors)
+        return (source[mask]
+                .groupby('Scenario', observed=True)
+                .sum()
+                )
+
+    def intensities(self, scenarios, path_type, countries=None, sectors=None, assets=None) -> pd.DataFrame:
+        """
+        Area-weighted pathways of the selection, with scenarios on the rows
+        """
+        sums = self.totals(scenarios, path_type, countries, sectors, assets)
+        return (sums.div(sums['Area'], axis=0)
+                .drop(columns=['Area'])
+                )
+
+    def bands(self, scenarios, path_type, countries=None, sectors=None, assets=None, quantiles=None) -> pd.DataFrame:
+        """
+        Distribution of asset intensities across the selection: the minimum, area-weighted
+        quantiles and maximum per year, with (Scenario, Statistic) on the rows. The quantiles
+        merge the sketches of the selected groups, so are approximate for large groups; filtering
+        on assets uses the exact asset intensities instead
+        """
+        quantiles = ResultCube.quantiles if quantiles is None else tuple(quantiles)
+        if assets is not None:
+            by_asset = self.asset_rows(assets)
+            intensity = ResultCube.asset_intensities(by_asset).droplevel('UID')
+            mask = ResultCube.select(intensity.index, scenarios, path_type, countries, sectors)
+            intensity = intensity[mask]
+            minimum = maximum = intensity
+            centroids = (ResultCube.sketch(intensity, by_asset['Area'].to_numpy()[mask], size=len(intensity))
+                         if len(intensity) else pd.DataFrame())
+        else:
+            minimum = self.minimum[ResultCube.select(self.minimum.index, scenarios, path_type, countries, sectors)]
+            maximum = self.maximum[ResultCube.select(self.maximum.index, scenarios, path_type, countries, sectors)]
+            centroids = self.sketches[ResultCube.select(self.sketches.index, scenarios, path_type, countries, sectors)]
+
+        labels = [f"p{round(quantile * 100):g}" for quantile in quantiles]
+        order = pd.MultiIndex.from_product([pd.Index(scenarios).intersection(minimum.index.unique('Scenario')),
+                                            ['min', *labels, 'max']], names=['Scenario', 'Statistic'])
+        if centroids.empty:
+            return pd.DataFrame(index=order, columns=minimum.columns, dtype=float)
+
+        rows = {}
+        for (scenario, year), part in centroids.groupby([centroids.index.get_level_values('Scenario'), 'Year'], observed=True):
+            rows[scenario, year] = weighted_quantiles(part['Value'].to_numpy(), part['Weight'].to_numpy(), quantiles)
+        percentiles = (pd.DataFrame(list(rows.values()),
+                                    index=pd.MultiIndex.from_tuples(rows, names=['Scenario', 'Year']),
+                                    columns=pd.Index(labels, name='Statistic'))
+                       .stack()
+                       .unstack('Year')
+                       )
+
+        return (pd.concat([minimum.groupby('Scenario', observed=True).min().assign(Statistic='min').set_index('Statistic', append=True),
+                           percentiles,
+                           maximum.groupby('Scenario', observed=True).max().assign(Statistic='max').set_index('Statistic', append=True)])
+                .reindex(index=order, columns=minimum.columns)
+                )
+
+
+class StrandingIndex:
+    def __init__(self, pathways: pd.DataFrame, targets: pd.DataFrame):
+        """
+        Compares every (Scenario, UID, Pathway Code) pathway with the asset's target pathway
+        (targets indexed by UID and Pathway Code) over all years at once. Keeps the gap per year,
+        each pathway's stranding year (the first year above target, NaN if it never is) and its
+        cumulative excess over the target, along with the UIDs of each scenario and pathway
+        type sorted by stranding year for stranding_before queries
+        """
+        pathways = pathways.drop(index=['Target'], level='Scenario', errors='ignore')
+        self.gaps, self.summary = StrandingIndex.compare(pathways, targets)
+        self.sort()
+
+    @staticmethod
+    def compare(pathways: pd.DataFrame, targets: pd.DataFrame):
+        """
+        The yearly gaps of pathways over their targets, and each pathway's stranding year and cumulative excess
+        """
+        years = pathways.columns.intersection(targets.columns)
+        rows = pd.MultiIndex.from_arrays([pathways.index.get_level_values('UID'),
+                                          pathways.index.get_level_values('Pathway Code')])
+        target_values = targets.reindex(index=rows, columns=years).to_numpy(dtype=float)
+        gap = pathways[years].to_numpy(dtype=float) - target_values
+
+        above = gap > 0
+        stranded = above.any(axis=1)
+        summary = pd.DataFrame({'Stranding Year': np.where(stranded, np.asarray(years)[above.argmax(axis=1)], np.nan),
+                                'Cumulative Excess': np.where(above, gap, 0).sum(axis=1)},
+                               index=pathways.index)
+        return pd.DataFrame(gap, index=pathways.index, columns=years), summary
+
+    def sort(self):
+        ordered = (self.summary['Stranding Year']
+                   .reset_index()
+                   .sort_values(['Scenario', 'Pathway Code', 'Stranding Year'], kind='stable')
+                   )
+        self.sorted = {key: (group['Stranding Year'].to_numpy(), group['UID'].to_numpy())
+                       for key, group in ordered.groupby(['Scenario', 'Pathway Code'], sort=False, observed=True)}
+
+    @classmethod
+    def from_deltas(cls, pathways, target: str = 'Target') -> 'StrandingIndex':
+        """
+        Builds the index from pathways held as ScenarioDeltas, whose target scenario is kept whole.
+        Only the changed assets of each scenario held as deltas are compared afresh, the rest taking
+        the base's comparison; so gaps holds the base's rows (if it is listed) and only the changed
+        rows of the others
+        """
+        index = cls.__new__(cls)
+        targets = pathways.full[target]
+        base_gaps, base_summary = StrandingIndex.compare(pathways.base, targets)
+        gaps, summaries, names = ([base_gaps], [base_summary], [pathways.base_name]) if pathways.listed else ([], [], [])
+        for name in pathways.names:
+            if name in names or name == target:
+                continue
+            if name in pathways.full:
+                gap, summary = StrandingIndex.compare(pathways.full[name], targets)
+            else:
+                gap, changed = StrandingIndex.compare(pathways.scenario(name, uids=pathways.changed(name)), targets)
+                summary = base_summary.copy()
+                summary.loc[changed.index.intersection(summary.index)] = changed
+                summary = pd.concat([summary, changed.drop(summary.index, errors='ignore')])
+            gaps.append(gap)
+            summaries.append(summary)
+            names.append(name)
+
+        index.gaps = pd.concat(gaps, keys=names, names=['Scenario'])
+        index.summary = pd.concat(summaries, keys=names, names=['Scenario'])
+        index.sort()
+        return index
+
+    @classmethod
+    def from_results(cls, results: pd.DataFrame, gaps: bool = True) -> 'StrandingIndex':
+        """
+        Builds the index from long-format results, as given to ResultCube, taking the Target
+        scenario's rows as the targets. With gaps unset, the yearly gaps are not kept (only their columns)
+        """
+        years = [column for column in results.columns if isinstance(column, (int, np.integer))]
+        pathways = results.set_index(['Scenario', 'UID', 'Pathway Code'])[years]
+        index = cls(pathways, pathways.xs('Target', level='Scenario'))
+        if not gaps:
+            index.gaps = index.gaps.iloc[:0]
+        return index
+
+    def stranding_before(self, year: int, scenario: str, path_type: str) -> np.ndarray:
+        """
+        UIDs whose pathway in the scenario first exceeds its target before the given year
+        """
+        years, uids = self.sorted.get((scenario, path_type), (np.array([]), np.array([], dtype=object)))
+        return uids[:np.searchsorted(years, year, side='left')]
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the model over a portfolio workbook. Completed results are persisted beside the
+workbook as a ResultStore, keyed by the contents of the workbook and the reference data, so
+that later runs on the same inputs (app reloads, other server workers) read them instead of recomputing
+"""
+
+import os
+import time
+import shutil
+import socket
+import hashlib
+import contextlib
+import pandas as pd
+
+import ReferenceData as data
+from Interventions import Model
+from Store import ResultStore
+from Schemas import Asset_Data, Consumption_Data, Intervention_Data, Rollout_Data, validate
+
+sheets = {'Assets': Asset_Data,
+          'Consumption': Consumption_Data,
+          'Interventions': Intervention_Data,
+          'Rollouts': Rollout_Data}
+
+
+def _ignore(stage: str, fraction: float):
+    pass
+
+
+def read_portfolio(input_file: str, encode: bool = True, cache_dir: str = None) -> dict:
+    """
+    Reads the portfolio sheets and ingests them. With cache_dir given, the sheets are read through
+    a binary cache kept there; otherwise straight from the workbook, so nothing is written beside it
+    """
+    if cache_dir is None:
+        portfolio = pd.read_excel(input_file, sheet_name=list(sheets))
+    else:
+        portfolio = {sheet: data.read_excel_cached(input_file, sheet_name=sheet, cache_dir=cache_dir)
+                     for sheet in sheets}
+    portfolio['Rollouts'] = portfolio['Rollouts'].fillna('-')
+    return ingest(portfolio, encode)
+
+
+def ingest(portfolio: dict, encode: bool = True) -> dict:
+    """
+    Validates each sheet of a portfolio against its schema. With encode set, the key columns
+    of every sheet are converted to categoricals shared across the sheets and the reference data
+    """
+    portfolio = {sheet: validate(df, sheets[sheet], sheet) for sheet, df in portfolio.items()}
+    if encode:
+        dtypes = data.key_dtypes(*portfolio.values())
+        portfolio = {sheet: data.encode_keys(df, dtypes) for sheet, df in portfolio.items()}
+    return portfolio
+
+
+def run_portfolio(portfolio: dict, progress=_ignore, **kwargs):
+    """
+    Builds the model for a portfolio and applies its scenarios, returning the model and the
+    pathways. progress is called with a stage name and the fraction of the run completed;
+    kwargs are passed to Model.apply_interventions
+    """
+    progress('Building model', 0.1)
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+
+    progress('Building scenarios', 0.4)
+    model.scenarios_from_df(portfolio['Interventions'], portfolio['Rollouts'])
+
+    progress('Applying interventions', 0.5)
+    return model, model.apply_interventions(model.scenarios, **kwargs)
+
+
+def results_key(input_file: str) -> str:
+    """
+    Identifies the current contents of the portfolio and reference workbooks
+    """
+    sources = [input_file,
+               data.default_factors.filepath,
+               data.default_pathways.filepath,
+               data.default_splits.filepath]
+    return hashlib.sha256(' '.join(data.workbook_digest(source)[0] for source in sources).encode()).hexdigest()[:16]
+
+
+def results_path(input_file: str, deltas: bool = False) -> str:
+    """
+    Where results for the current contents of the portfolio and reference workbooks are persisted.
+    Results stored as deltas against BAU are kept apart from full ones
+    """
+    key = results_key(input_file)
+    prefix = ''.join(c if c.isalnum() else '_' for c in os.path.basename(input_file))
+    kind = 'deltas' if deltas else 'results'
+    return os.path.join(os.path.dirname(input_file), '.cache', f"{prefix}-{kind}-{key}")
+
+
+def load_or_run(input_file: str, progress=_ignore, poll: float = 2, stale_after: float = 3600, **kwargs) -> pd.DataFrame:
+    """
+    Reads the persisted long-format pathways (with the asset data the dashboard filters on) for
+    the portfolio if present, and otherwise runs the model and persists its results (see open_results)
+    """
+    return open_results(input_file, progress, poll, stale_after, **kwargs).read()
+
+
+def _lock_abandoned(lock_path: str, stale_after: float) -> bool:
+    """
+    Whether a lock file's owner has gone: it records the host and PID of the process holding it,
+    so a lock taken on this host is abandoned once that process is no longer running. A lock
+    from another host, or not yet written, is only taken as abandoned after stale_after seconds
+    """
+    with open(lock_path) as f:
+        owner = f.read().split()
+    if len(owner) == 2 and owner[0] == socket.gethostname():
+        try:
+            os.kill(int(owner[1]), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:  # running, under another user
+            return False
+        return False
+    return time.time() - os.path.getmtime(lock_path) > stale_after
+
+
+def open_results(input_file: str, progress=_ignore, poll: float = 2, stale_after: float = 3600,
+                 **kwargs) -> ResultStore:
+    """
+    The ResultStore of the portfolio's results, running the model and persisting its results
+    first if they are not present. The store is written as uncompressed Arrow, so processes
+    reading it share its memory-mapped pages. With deltas in kwargs, the scenarios are stored
+    as deltas against BAU.
+    A lock file beside the results ensures only one process runs the model; others poll until
+    its results appear. A lock whose process has died mid-run is broken (see _lock_abandoned)
+    """
+    target = results_path(input_file, kwargs.get('deltas', False))
+    store = ResultStore(target)
+    lock_path = f"{target}.lock"
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    while True:
+        if store.exists():
+            progress('Loading saved results', 0.95)
+            return store
+
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if _lock_abandoned(lock_path, stale_after):
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            progress('Waiting for another process running the model', 0.0)
+            time.sleep(poll)
+            continue
+
+        try:
+            os.write(lock, f"{socket.gethostname()} {os.getpid()}".encode())
+            progress('Reading portfolio', 0.0)
+            model, pathways = run_portfolio(read_portfolio(input_file, cache_dir=os.path.dirname(target)),
+                                            progress, **kwargs)
+
+            progress('Saving results', 0.9)
+            cache_dir, name = os.path.split(target)
+            prefix = name.rsplit('-', 1)[0]
+            for stale in os.listdir(cache_dir):
+                if stale.startswith(f"{prefix}-") and not stale.endswith('.lock'):
+                    stale = os.path.join(cache_dir, stale)
+                    if os.path.isdir(stale):
+                        shutil.rmtree(stale, ignore_errors=True)
+                    else:
+                        os.remove(stale)
+            model.write_results(target, pathways, file_format='ipc')
+            return store
+        finally:
+            os.close(lock)
+            with contextlib.suppress(FileNotFoundError):  # broken by another process meanwhile
+                os.remove(lock_path)
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 """
-Defines Typed DataFrame schemas used throughout
+Defines Typed DataFrame schemas used throughout, and validates input tables against them
 """
 
+import numpy as np
 import pandas as pd
 from typedframe import TypedDataFrame
 
+# Columns identifying assets, utilities, scenarios and pathway types, held as shared categoricals once encoded
+key_columns = ['UID', 'Country Code', 'Sector Code', 'Utility', 'Scenario', 'Pathway Code']
+
 
 class Asset_Data(TypedDataFrame):
     schema = {
@@ -15,27 +19,72 @@ class Asset_Data(TypedDataFrame):
         'Country Code': str,
         'Area': float,
         }
-    
+
 class Asset_Data_Sortable(Asset_Data):
     schema = {
         'Intensities': float
         }
     #This might not always be an intensities column in future use cases?
-    
+
+class Consumption_Data(TypedDataFrame):
+    schema = {
+        'UID': str,
+        'Utility': str,
+        'Year': int,
+        'Consumption': float
+        }
+
 class Intervention_Data(TypedDataFrame):
     schema = {
+        'Scenario': str,
         'Target': str,
         'Year': int,
         'Type': str
         }
-    
+
 class Rollout_Data(TypedDataFrame):
     schema = {
-        'Intervention Type': str,
-        'Start Year': int,
-        'Count per Year': int,
+        'Scenario': str,
+        'Type': str,
+        'Start': int,
+        'Installations per year': int,
         'Country Scope': str,
         'Sector Scope': str
         }
-    
-    
+
+
+def validate(df: pd.DataFrame, schema, name: str = None) -> pd.DataFrame:
+    """
+    Checks a table against a schema class in one pass per column kind, rather than row by row.
+    Label (str) and int columns must be filled, and int and float columns numeric, with ints whole;
+    floats may be missing. Every problem found is reported in a single ValueError. Returns the
+    table with its numeric columns converted, and its label columns as given
+    """
+    name = name or schema.__name__
+    expected = schema.dtype(with_optional=False)
+    missing = [column for column in expected if column not in df.columns]
+    if missing:
+        raise ValueError(f"{name} is missing columns {missing}")
+
+    labels = [column for column, dtype in expected.items() if dtype is str]
+    numbers = [column for column, dtype in expected.items() if dtype is not str]
+    problems = {}
+
+    empty = df[labels].isna()
+    for column in empty.columns[empty.any().to_numpy()]:
+        problems[column] = ('empty', df.index[empty[column].to_numpy()])
+
+    converted = df[numbers].apply(pd.to_numeric, errors='coerce')
+    values = converted.to_numpy(dtype=float)
+    invalid = np.isnan(values) & df[numbers].notna().to_numpy()
+    whole = np.array([expected[column] is not float for column in numbers])
+    invalid |= whole & (np.isnan(values) | (values % 1 != 0))
+    for position in np.flatnonzero(invalid.any(axis=0)):
+        problems[numbers[position]] = ('not a valid number', df.index[invalid[:, position]])
+
+    if problems:
+        details = '; '.join(f"{column} {kind} in {len(rows)} rows (first {rows[:5].tolist()})"
+                            for column, (kind, rows) in problems.items())
+        raise ValueError(f"{name} does not match its schema: {details}")
+
+    return df.assign(**{column: converted[column].astype(expected[column]) for column in numbers})
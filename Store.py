@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk columnar store of model results, so that the dashboard, reports and notebooks read
+one copy of a run's results rather than rerunning the model. Each table is a hive-partitioned
+Arrow dataset, read through memory-mapped files so that processes reading the same store
+share the operating system's page cache instead of each holding a private copy
+"""
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+
+from Deltas import ScenarioDeltas
+
+
+class ResultStore:
+    # partition columns of each table
+    tables = {'pathways': ['Scenario', 'Pathway Code'],
+              'consumption': ['Scenario'],
+              'impacts': ['Scenario'],
+              'assets': []}
+    # columns rows are sorted by within each partition, so Parquet row group statistics can skip row groups
+    sort_keys = ['Country Code', 'Sector Code', 'UID']
+
+    # file under the root naming the version folder readers should use
+    pointer = 'CURRENT'
+
+    def __init__(self, root: str):
+        """
+        A store is a folder of versions, each a complete set of tables written once, and a pointer
+        file naming the current version. A store object reads the version current when its
+        metadata is first loaded
+        """
+        self.root = root
+        self.filesystem = pafs.LocalFileSystem(use_mmap=True)
+        self._metadata = None
+        self._version = None
+
+    @property
+    def path(self) -> str:
+        """
+        The folder of the version this store reads
+        """
+        if self._version is None:
+            with open(os.path.join(self.root, ResultStore.pointer)) as f:
+                self._version = f.read().strip()
+        return os.path.join(self.root, self._version)
+
+    @property
+    def metadata(self) -> dict:
+        if self._metadata is None:
+            with open(os.path.join(self.path, 'store.json')) as f:
+                self._metadata = json.load(f)
+        return self._metadata
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.root, ResultStore.pointer))
+
+    def write(self, pathways: pd.DataFrame, consumption: pd.DataFrame = None, impacts: pd.DataFrame = None,
+              file_format: str = 'parquet', assets: pd.DataFrame = None, deltas: dict = None):
+        """
+        Writes long-format results (named index levels become columns; year columns are stored under
+        their names and restored on read). 'parquet' files are compressed and carry row group statistics
+        for predicate pushdown; 'ipc' (Arrow) files are uncompressed, so memory-mapped reads are zero-copy.
+        deltas marks tables written from ScenarioDeltas.to_long, giving each its base scenario (and
+        whether it is listed), full scenarios, scenarios and row keys.
+        Each write builds a new version folder, then switches the pointer to it by an atomic rename,
+        so readers find either the previous store or the new one, never none or a partial one. The
+        previous version is kept for readers which resolved it before the switch; older ones are removed
+        """
+        version = f"v{time.time_ns()}-{os.getpid()}"
+        folder = os.path.join(self.root, version)
+        os.makedirs(folder)
+        metadata = {'format': file_format, 'tables': {}}
+
+        for name, df in {'pathways': pathways, 'consumption': consumption, 'impacts': impacts,
+                         'assets': assets}.items():
+            if df is None:
+                continue
+            index = [level for level in df.index.names if level is not None]
+            df = df.reset_index(level=index) if index else df
+            df = df.reset_index(drop=True)
+            sort_keys = [column for column in ResultStore.sort_keys if column in df.columns]
+            if sort_keys:
+                df = df.sort_values(sort_keys, kind='stable')
+
+            years = [column for column in df.columns if isinstance(column, (int, np.integer))]
+            df.columns = [str(column) for column in df.columns]
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            # NaN is stored as NaN rather than null, so float columns are read back without a copy
+            for position, column in enumerate(df.columns):
+                if df.dtypes.iloc[position] == np.float64:
+                    table = table.set_column(position, column,
+                                             pa.array(df.iloc[:, position].to_numpy(), from_pandas=False))
+            ds.write_dataset(table, os.path.join(folder, name), format=file_format,
+                             partitioning=ResultStore.tables[name] or None, partitioning_flavor='hive')
+            metadata['tables'][name] = {'index': index,
+                                        'columns': df.columns.tolist(),
+                                        'years': [int(year) for year in years]}
+            if deltas and name in deltas:
+                metadata['tables'][name]['deltas'] = deltas[name]
+
+        with open(os.path.join(folder, 'store.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        previous = None
+        if self.exists():
+            with open(os.path.join(self.root, ResultStore.pointer)) as f:
+                previous = f.read().strip()
+        pointer = os.path.join(self.root, f"{ResultStore.pointer}.{os.getpid()}.tmp")
+        with open(pointer, 'w') as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(self.root, ResultStore.pointer))
+        self._metadata = None
+        self._version = version
+        self._prune(version, previous)
+
+    def _prune(self, current: str, previous: str = None):
+        """
+        Removes versions older than the previous one, and the tables of a store written in one
+        folder before versions were kept. Versions newer than the previous one may be in progress
+        in another process, so are left
+        """
+        def stamp(entry: str) -> int:
+            return int(entry[1:].split('-')[0])
+
+        keep = stamp(previous) if previous is not None and previous.startswith('v') else stamp(current)
+        for entry in os.listdir(self.root):
+            path = os.path.join(self.root, entry)
+            if entry in (current, previous):
+                continue
+            if entry.startswith('v') and entry[1:].split('-')[0].isdigit():
+                if stamp(entry) < keep:
+                    shutil.rmtree(path, ignore_errors=True)
+            elif entry == 'store.json':
+                os.remove(path)
+            elif entry in ResultStore.tables:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def dataset(self, name: str = 'pathways') -> ds.Dataset:
+        partitioning = (ds.partitioning(pa.schema([(column, pa.string()) for column in ResultStore.tables[name]]),
+                                        flavor='hive')
+                        if ResultStore.tables[name] else None)
+        return ds.dataset(os.path.join(self.path, name), format=self.metadata['format'],
+                          partitioning=partitioning, filesystem=self.filesystem)
+
+    def read(self, name: str = 'pathways', scenarios=None, path_types=None, countries=None, sectors=None,
+             assets=None, years=None, index: bool = False) -> pd.DataFrame:
+        """
+        Loads the rows of a table selected by the given filters (None selects everything), and
+        only the requested years. Filters on Scenario and Pathway Code prune whole partitions; the
+        others are pushed down to the files. With index set, the table's index is restored.
+        Tables stored as deltas are read back as full scenarios (see read_deltas)
+        """
+        table_meta = self.metadata['tables'][name]
+        if 'deltas' in table_meta:
+            deltas, attributes = self.read_deltas(name, scenarios, path_types, countries, sectors, assets, years)
+            df = (deltas.to_frame(scenarios)
+                        .reset_index()
+                        .merge(attributes, on=table_meta['deltas']['keys'])
+                  )
+            year_names = {str(year): year for year in table_meta['years']}
+            df = df[[year_names.get(column, column) for column in table_meta['columns']
+                     if year_names.get(column, column) in df.columns]]
+        else:
+            df = self._load(name, scenarios, path_types, countries, sectors, assets, years)
+        if index and table_meta['index']:
+            df = df.set_index(table_meta['index'])
+        return df
+
+    def read_deltas(self, name: str = 'pathways', scenarios=None, path_types=None, countries=None, sectors=None,
+                    assets=None, years=None):
+        """
+        Loads a table stored as deltas, selected as by read (the base scenario's rows are always
+        loaded), as ScenarioDeltas of its year columns, along with the other columns of each row
+        (the asset data attached on writing) keyed as the rows are
+        """
+        encoding = self.metadata['tables'][name]['deltas']
+        base, keys = encoding['base'], encoding['keys']
+        if scenarios is not None:
+            scenarios = [base, *(scenario for scenario in scenarios if scenario != base)]
+        df = self._load(name, scenarios, path_types, countries, sectors, assets, years)
+
+        year_columns = [column for column in df.columns if isinstance(column, (int, np.integer))]
+        others = [column for column in df.columns if column not in ['Scenario', *keys, *year_columns]]
+        attributes = (df[[*keys, *others]]
+                      .drop_duplicates(keys)
+                      .reset_index(drop=True)
+                      )
+        # Scenarios which changed nothing have no rows, so are named from the metadata
+        names = [scenario for scenario in encoding['scenarios'] if scenarios is None or scenario in scenarios]
+        deltas = ScenarioDeltas.from_long(df.set_index(['Scenario', *keys])[year_columns], base,
+                                          [scenario for scenario in encoding['full'] if scenario in names], names,
+                                          encoding.get('listed', True))
+        return deltas, attributes
+
+    def _load(self, name: str, scenarios=None, path_types=None, countries=None, sectors=None,
+              assets=None, years=None) -> pd.DataFrame:
+        table_meta = self.metadata['tables'][name]
+        dataset = self.dataset(name)
+        selections = {'Scenario': scenarios, 'Pathway Code': path_types, 'Country Code': countries,
+                      'Sector Code': sectors, 'UID': assets}
+        expression = None
+        for column, values in selections.items():
+            if values is None or column not in table_meta['columns']:
+                continue
+            # Filter values take the stored type of the column (the values of a dictionary column)
+            stored = dataset.schema.field(column).type
+            stored = stored.value_type if pa.types.is_dictionary(stored) else stored
+            term = ds.field(column).isin(pa.array(list(values)).cast(stored))
+            expression = term if expression is None else expression & term
+
+        columns = table_meta['columns']
+        if years is not None:
+            dropped = {str(year) for year in table_meta['years']} - {str(year) for year in years}
+            columns = [column for column in columns if column not in dropped]
+
+        df = (dataset
+              .to_table(columns=columns, filter=expression)
+              .to_pandas(split_blocks=True)
+              )
+        year_names = {str(year): year for year in table_meta['years']}
+        df.columns = [year_names.get(column, column) for column in df.columns]
+        return df
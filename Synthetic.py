@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic portfolios (Assets, Consumption, Interventions and Rollouts tables,
+laid out as in the portfolio workbooks) using the codes found in the reference data, and
+synthetic reference workbooks laid out as those under 'Reference Data'
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import ReferenceData as data
+from Interventions import intervention_constructors
+
+
+def reference_codes() -> dict:
+    """
+    Country/sector combinations which have CRREM pathways, splits and emissions factors,
+    along with the utilities and intervention types the reference data can handle
+    """
+    countries = data.default_factors.default.index.unique('Country Code')
+    sectors = data.default_splits.default.columns
+    combinations = (data.default_pathways.default.reset_index()[['Country Code', 'Sector Code']]
+                    .drop_duplicates()
+                    )
+    combinations = combinations[combinations['Country Code'].isin(countries)
+                                & combinations['Sector Code'].isin(sectors)]
+
+    utilities = (data.default_splits.default.index.unique('Utility')
+                 .intersection(data.default_factors.default.index.unique('Utility')))
+    types = [intervention_type for intervention_type, kind in intervention_constructors.items()
+             if (intervention_type in data.efficiency_parameters.columns if kind == 'Efficiency'
+                 else (data.reassignment_parameters['Type'] == intervention_type).any())]
+
+    return {'combinations': combinations.reset_index(drop=True),
+            'utilities': utilities.tolist(),
+            'types': types}
+
+
+def generate_portfolio(n_assets: int,
+                       years=range(2018, 2021),
+                       utilities: list = None,
+                       mix: dict = None,
+                       scenarios: int = 3,
+                       interventions_per_asset: float = 0.2,
+                       rollouts_per_scenario: int = 2,
+                       rollout_density: float = 0.05,
+                       seed: int = 0) -> dict:
+    """
+    Returns a dict of the Assets, Consumption, Interventions and Rollouts tables for a random
+    portfolio of n_assets.
+    mix optionally weights (Country Code, Sector Code) tuples; otherwise every valid combination
+    is equally likely. interventions_per_asset is the expected number of individual interventions
+    per asset per scenario, and rollout_density the share of the portfolio each rollout installs
+    per year
+    """
+    rng = np.random.default_rng(seed)
+    codes = reference_codes()
+    years = list(years)
+    utilities = utilities if utilities is not None else codes['utilities']
+
+    combinations = codes['combinations']
+    weights = None
+    if mix is not None:
+        weights = np.array([mix.get((row['Country Code'], row['Sector Code']), 0)
+                            for _, row in combinations.iterrows()], dtype=float)
+        weights = weights / weights.sum()
+    picks = combinations.iloc[rng.choice(len(combinations), n_assets, p=weights)]
+
+    uids = pd.Index([f"SYN{i:07d}" for i in range(n_assets)])
+    assets = pd.DataFrame({'UID': uids,
+                           'Name': [f"Synthetic Asset {i}" for i in range(n_assets)],
+                           'Sector Code': picks['Sector Code'].to_numpy(),
+                           'Country Code': picks['Country Code'].to_numpy(),
+                           'Area': rng.uniform(500, 20000, n_assets).round()})
+
+    # Every asset uses the first utility; the others are present at random
+    has_utility = rng.random((n_assets, len(utilities))) < 0.5
+    has_utility[:, 0] = True
+    asset_pos, utility_pos = np.nonzero(has_utility)
+    base = rng.lognormal(np.log(50), 0.6, len(asset_pos)) * assets['Area'].to_numpy()[asset_pos]
+    trend = rng.normal(1, 0.05, (len(asset_pos), len(years)))
+    consumption = pd.DataFrame({'UID': np.repeat(uids[asset_pos], len(years)),
+                                'Utility': np.repeat(np.asarray(utilities)[utility_pos], len(years)),
+                                'Year': np.tile(years, len(asset_pos)),
+                                'Consumption': (base[:, None] * trend).ravel()})
+
+    names = [f"Scenario {i + 1}" for i in range(scenarios)]
+    start, horizon = years[-1] + 1, 2050
+    n_interventions = rng.poisson(interventions_per_asset * n_assets, scenarios)
+    interventions = pd.DataFrame({'Scenario': np.repeat(names, n_interventions),
+                                  'Target': rng.choice(uids, n_interventions.sum()),
+                                  'Year': rng.integers(start, horizon, n_interventions.sum()),
+                                  'Type': rng.choice(codes['types'], n_interventions.sum())})
+
+    n_rollouts = scenarios * rollouts_per_scenario
+    scopes = combinations.iloc[rng.choice(len(combinations), n_rollouts)]
+    rollouts = pd.DataFrame({'Scenario': np.repeat(names, rollouts_per_scenario),
+                             'Type': rng.choice(codes['types'], n_rollouts),
+                             'Start': rng.integers(start, start + 10, n_rollouts),
+                             'Country Scope': np.where(rng.random(n_rollouts) < 0.5, '-', scopes['Country Code']),
+                             'Sector Scope': np.where(rng.random(n_rollouts) < 0.5, '-', scopes['Sector Code'])})
+    # Each rollout installs fast enough to reach every asset in its scope by the horizon
+    in_scope = np.array([((rollout['Country Scope'] == '-') | (assets['Country Code'] == rollout['Country Scope']))
+                         .mul((rollout['Sector Scope'] == '-') | (assets['Sector Code'] == rollout['Sector Scope'])).sum()
+                         for _, rollout in rollouts.iterrows()])
+    rollouts.insert(3, 'Installations per year',
+                    np.maximum(max(1, round(rollout_density * n_assets)),
+                               -(-in_scope // (horizon - rollouts['Start'].to_numpy() + 1))))
+
+    return {'Assets': assets,
+            'Consumption': consumption,
+            'Interventions': interventions,
+            'Rollouts': rollouts}
+
+
+def write_portfolio(portfolio: dict, filepath: str):
+    """
+    Writes a generated portfolio to a workbook with the same sheets as the test portfolio
+    """
+    with pd.ExcelWriter(filepath) as writer:
+        for sheet_name, df in portfolio.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def write_reference_data(folder: str = 'Reference Data', seed: int = 0,
+                         countries=('GB', 'FR', 'DE'), sectors=('OFF', 'RHS', 'HOT', 'RSF'),
+                         years=range(2018, 2051)):
+    """
+    Writes random emissions factors, CRREM pathways and intervention parameters to the three
+    reference workbooks in folder, with the sheets and layouts ReferenceData reads. Every
+    intervention type in intervention_constructors is given parameters
+    """
+    rng = np.random.default_rng(seed)
+    years = list(years)
+    os.makedirs(folder, exist_ok=True)
+
+    with pd.ExcelWriter(os.path.join(folder, 'Emissions Factors.xlsx')) as writer:
+        for utility, base, decline in [('Elec', 0.25, 0.97), ('DH&C', 0.18, 1.0), ('Gas', 0.2, 1.0)]:
+            rows = [{'Utility': utility, 'Country Code': country,
+                     **{year: base * rng.uniform(0.8, 1.2) * decline ** (year - years[0]) for year in years}}
+                    for country in countries]
+            pd.DataFrame(rows).to_excel(writer, sheet_name=f"{utility} Emissions Factors", index=False)
+
+    with pd.ExcelWriter(os.path.join(folder, 'Pathways.xlsx')) as writer:
+        for code, sheet_name, scale in [('GHG-Int', 'GHG Pathways', 12),
+                                        ('CO2-Int', 'CO2 Pathways', 11),
+                                        ('kWh-Int', 'Energy Pathways', 60)]:
+            rows = [{'Pathway Code': code, 'Sector Code': sector, 'Country Code': country,
+                     **{year: scale * rng.uniform(0.6, 1.6) * 0.95 ** (year - years[0]) for year in years}}
+                    for sector in sectors for country in countries]
+            pd.DataFrame(rows).to_excel(writer, sheet_name=sheet_name, index=False)
+
+    uses = pd.MultiIndex.from_product([['Elec', 'Gas', 'DH&C'], ['Heating', 'Cooling', 'Lighting', 'Other']],
+                                      names=['Utility', 'Use'])
+    splits = pd.DataFrame(rng.uniform(0.05, 1, (len(uses), len(sectors))), index=uses, columns=list(sectors))
+    splits = splits.mask(rng.random(splits.shape) < 0.3, 0)
+    splits.loc[(slice(None), 'Heating'), :] += 0.1  # every utility keeps a use for each sector
+    splits = splits / splits.groupby('Utility').transform('sum')
+
+    efficiency_types = [intervention_type for intervention_type, kind in intervention_constructors.items()
+                        if kind == 'Efficiency']
+    efficiency = pd.DataFrame(rng.uniform(0, 0.3, (len(uses), len(efficiency_types))),
+                              index=uses, columns=efficiency_types)
+    efficiency = efficiency.mask(rng.random(efficiency.shape) < 0.5, 0)
+    reassignment = pd.DataFrame([
+        {'Type': 'Heat Pump', 'FromUtility': 'Gas', 'FromUse': 'Heating', 'ToUtility': 'Elec', 'ToUse': 'Heating', 'CoP': 3.0},
+        {'Type': 'Heat Pump', 'FromUtility': 'DH&C', 'FromUse': 'Heating', 'ToUtility': 'Elec', 'ToUse': 'Other', 'CoP': 2.5},
+        {'Type': 'Heat Pump - Renewable Power', 'FromUtility': 'Gas', 'FromUse': 'Heating', 'ToUtility': 'DH&C', 'ToUse': 'Heating', 'CoP': 3.5},
+    ])
+    with pd.ExcelWriter(os.path.join(folder, 'Intervention Parameters.xlsx')) as writer:
+        splits.to_excel(writer, sheet_name='Energy Splits')
+        efficiency.to_excel(writer, sheet_name='Efficiency Interventions')
+        reassignment.to_excel(writer, sheet_name='Reassignment Interventions', index=False)
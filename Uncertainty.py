@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo uncertainty over the efficiency savings, heat pump CoPs and emissions factors.
+Samples are an extra array axis: each scenario's intervention chains are compiled once, and
+every sample only recomposes the handful of chain operators before one batched product
+"""
+
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import ReferenceData as data
+import Engine
+
+# Standard deviation of the log of each multiplicative perturbation
+default_spread = {'efficiency': 0.2, 'cop': 0.1, 'factors': 0.1}
+
+
+def lognormal(rng, spread: float, size) -> np.ndarray:
+    """
+    Multipliers with mean 1
+    """
+    return np.exp(spread * rng.standard_normal(size) - spread ** 2 / 2)
+
+
+def draw(seed: int, samples, spread: dict, sizes: dict) -> dict:
+    """
+    Draws the multipliers of the given samples: one per efficiency intervention type (shared by
+    its uses), per reassignment row (scaling its CoP) and per utility (scaling its emissions factors).
+    Each sample has its own generator, seeded by (seed, sample), so results do not depend on how
+    samples are split into chunks or between processes
+    """
+    drawn = {name: np.empty((len(samples), size)) for name, size in sizes.items()}
+    for i, sample in enumerate(samples):
+        rng = np.random.default_rng([seed, sample])
+        for name, size in sizes.items():
+            drawn[name][i] = lognormal(rng, spread[name], size)
+    return drawn
+
+
+class SampleKernel:
+    def __init__(self, kernel, plans: dict, constructors: dict):
+        """
+        Compiles each scenario's plan (name -> (targets, years, types)) against a PlanKernel's
+        consumption block: the chain in force in every (asset, year) cell, and each chain's
+        sequence of intervention types. The reference parameters of the types used are gathered
+        into arrays, so operators are built for a whole chunk of samples at once
+        """
+        self.consumption = kernel.consumption
+        self.weights = kernel.weights
+        self.axis = kernel.axis
+        self.constructors = constructors
+        self.utilities = self.axis.unique('Utility')
+        self.use_utility = self.utilities.get_indexer(self.axis.get_level_values('Utility'))
+
+        self.types = sorted({intervention_type for _, _, types in plans.values() for intervention_type in types})
+        self.scenarios = {}
+        for name, (targets, years, types) in plans.items():
+            if len(targets) == 0:
+                self.scenarios[name] = (np.zeros(self.consumption.shape[:2], dtype=int), [()])
+                continue
+            chains, _, after_ids = Engine.compile_chains(np.asarray(targets, dtype=object), list(types),
+                                                         self.axis, constructors)
+            grid = Engine.chain_grid(self.consumption.shape[:2], kernel.uids.get_indexer(targets),
+                                     kernel.years.get_indexer(years), after_ids)
+            sequences = [tuple(self.types.index(t) for t in chain) for chain in sorted(chains.ids, key=chains.ids.get)]
+            self.scenarios[name] = (grid, sequences)
+
+        # As read by Engine.EfficiencyOperator and Engine.ReassignmentOperator
+        efficiency = data.efficiency_parameters
+        reassignment = data.reassignment_parameters
+        self.sizes = {'efficiency': len(efficiency.columns), 'cop': len(reassignment), 'factors': len(self.utilities)}
+        self.parameters = {}
+        for intervention_type in self.types:
+            if constructors[intervention_type] == 'Efficiency':
+                self.parameters[intervention_type] = (efficiency.columns.get_loc(intervention_type),
+                                                      efficiency[intervention_type].reindex(self.axis).fillna(0).to_numpy(dtype=float))
+            else:
+                self.parameters[intervention_type] = [(self.axis.get_loc((row.FromUtility, row.FromUse)),
+                                                       self.axis.get_loc((row.ToUtility, row.ToUse)),
+                                                       row.CoP, position)
+                                                      for position, row in enumerate(reassignment.itertuples())
+                                                      if row.Type == intervention_type]
+
+    def operators(self, drawn: dict) -> np.ndarray:
+        """
+        (sample, type, use, use) operators under each sample's multipliers, built as in Engine's
+        operator constructors: efficiency savings are capped at a full saving, and reassignment
+        rows are applied in sheet order
+        """
+        n_samples, n_uses = len(drawn['factors']), len(self.axis)
+        identity = np.broadcast_to(np.eye(n_uses), (n_samples, n_uses, n_uses))
+        operators = np.empty((n_samples, len(self.types), n_uses, n_uses))
+        for i, intervention_type in enumerate(self.types):
+            if self.constructors[intervention_type] == 'Efficiency':
+                column, savings = self.parameters[intervention_type]
+                scaled = np.minimum(drawn['efficiency'][:, column, None] * savings, 1)
+                operators[:, i] = identity * (1 - scaled)[:, None, :]
+                continue
+            operator = identity
+            for source, destination, cop, position in self.parameters[intervention_type]:
+                step = identity.copy()
+                step[:, destination] = 0
+                step[:, destination, source] = 1 / (cop * drawn['cop'][:, position])
+                step[:, source] = 0
+                operator = step @ operator
+            operators[:, i] = operator
+        return operators
+
+    def evaluate(self, samples, seed: int, spread: dict) -> dict:
+        """
+        Energy and emissions pathways (sample, asset, year) of every scenario for the given samples
+        """
+        drawn = draw(seed, samples, spread, self.sizes)
+        operators = self.operators(drawn)
+        factor_scale = drawn['factors'][:, self.use_utility]  # (sample, use)
+
+        n_samples, (n_assets, n_years, n_uses) = len(samples), self.consumption.shape
+        results = {}
+        for name, (grid, sequences) in self.scenarios.items():
+            energy = np.empty((n_samples, n_assets, n_years))
+            emissions = np.empty((n_samples, n_assets, n_years))
+            for chain_id, sequence in enumerate(sequences):
+                mask = grid == chain_id
+                if not mask.any():
+                    continue
+                matrices = np.broadcast_to(np.eye(n_uses), (n_samples, n_uses, n_uses))
+                for type_pos in sequence:
+                    matrices = operators[:, type_pos] @ matrices
+                cells = np.einsum('skj,mj->smk', matrices, self.consumption[mask])
+                energy[:, mask] = cells.sum(axis=2)
+                emissions[:, mask] = np.einsum('smk,mk,sk->sm', cells, self.weights[mask], factor_scale)
+            results[name] = {'kWh-Int': energy, 'GHG-Int': emissions}
+        return results
+
+
+_worker_state = {}
+
+
+def _init_worker(sample_kernel):
+    _worker_state['kernel'] = sample_kernel
+
+
+def _evaluate_chunk(samples, seed, spread, by_asset):
+    return collapse(_worker_state['kernel'].evaluate(samples, seed, spread), by_asset)
+
+
+def collapse(results: dict, by_asset: bool) -> dict:
+    """
+    Keeps per-asset pathways, or sums them to the portfolio (sample, year) pathway
+    """
+    if by_asset:
+        return results
+    return {name: {path_type: values.sum(axis=1) for path_type, values in paths.items()}
+            for name, paths in results.items()}
+
+
+def run(sample_kernel: SampleKernel, samples: int, seed: int = 0, spread: dict = None, chunk: int = 32,
+        workers: int = 1, by_asset: bool = False) -> dict:
+    """
+    Evaluates samples in chunks, bounding the memory of the (sample, asset, year) arrays,
+    spreading the chunks across a process pool when workers is above one. Returns pathways
+    per scenario and pathway type, with samples on the first axis
+    """
+    spread = {**default_spread, **(spread or {})}
+    chunks = [range(start, min(start + chunk, samples)) for start in range(0, samples, chunk)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(sample_kernel,)) as executor:
+            parts = list(executor.map(partial(_evaluate_chunk, seed=seed, spread=spread, by_asset=by_asset), chunks))
+    else:
+        parts = [collapse(sample_kernel.evaluate(samples, seed, spread), by_asset) for samples in chunks]
+
+    return {name: {path_type: np.concatenate([part[name][path_type] for part in parts])
+                   for path_type in parts[0][name]}
+            for name in parts[0]}
+
+
+def bands(pathways: dict, years: pd.Index, quantiles, uids: pd.Index = None) -> pd.DataFrame:
+    """
+    Mean and quantiles over samples, as rows (Scenario, [UID,] Pathway Code, Statistic) and year columns
+    """
+    labels = ['mean', *(f"p{round(quantile * 100):g}" for quantile in quantiles)]
+    frames = []
+    for name, paths in pathways.items():
+        for path_type, values in paths.items():
+            statistics = np.concatenate([values.mean(axis=0)[None], np.quantile(values, quantiles, axis=0)])
+            if uids is None:
+                index = pd.MultiIndex.from_product([[name], [path_type], labels],
+                                                   names=['Scenario', 'Pathway Code', 'Statistic'])
+                frames.append(pd.DataFrame(statistics, index=index, columns=years))
+            else:
+                index = pd.MultiIndex.from_product([[name], uids, [path_type], labels],
+                                                   names=['Scenario', 'UID', 'Pathway Code', 'Statistic'])
+                frames.append(pd.DataFrame(statistics.transpose(1, 0, 2).reshape(-1, len(years)),
+                                           index=index, columns=years))
+    return pd.concat(frames)
@@ -2,80 +2,143 @@
 First version of Dash app, adding interactivity to the process seen in Modeller.py
 """
 # Package imports
+import os
+import threading
 import numpy as np
 import pandas as pd
+from functools import lru_cache
 import plotly.express as px
-from dash import Dash, dcc, html, Input, Output
+import plotly.graph_objects as go
+from dash import Dash, dcc, html, Input, Output, no_update
 import dash_bootstrap_components as dbc
 
 idx = pd.IndexSlice
 
 # custom modules
-import pathwayFunctions as path
-from ReferenceData import Default_Splits, Configured_Data
-from Interventions import Scenario, Intervention, Rollout, Model
+import ReferenceData as data
+from Results import ResultCube, StrandingIndex
+from Runner import open_results
+from Profiling import profiler, profiled
+
+# Setting NZC_PROFILE instruments the model run, and shows the report in a debug panel
+if os.environ.get('NZC_PROFILE'):
+    profiler.enable()
 
 app = Dash(__name__,
            external_stylesheets=[dbc.themes.BOOTSTRAP])
+server = app.server  # for gunicorn, e.g. gunicorn app:server
+
+# NZC_PORTFOLIO selects the portfolio workbook to serve
+input_file = os.environ.get('NZC_PORTFOLIO', 'Reference Data/Large Test Portfolio.xlsx')
+# Setting NZC_DELTAS keeps the scenarios as deltas against BAU, rather than in full
+use_deltas = bool(os.environ.get('NZC_DELTAS'))
 
-input_file = 'Reference Data/Large Test Portfolio.xlsx'
+path_list = ['GHG-Int', 'kWh-Int']
 
-assets = pd.read_excel(input_file, sheet_name='Assets')
-consumption = pd.read_excel(input_file, sheet_name='Consumption')
-interventions_df = pd.read_excel(input_file, sheet_name='Interventions')
-rollouts_df = pd.read_excel(input_file, sheet_name='Rollouts').fillna('-')
+# The model runs in a background thread so the app serves requests straight away. The thread
+# reports into status, and fills lists (the dropdown options) and results as they become available
+status = {'stage': 'Starting', 'progress': 0.0, 'error': None}
+lists = {'asset': [], 'country': [], 'sector': [], 'scenario': [], 'year': []}
+results = None
+stranding = None
 
-default_splits = Default_Splits('Reference Data/Intervention Parameters.xlsx')
-splits = Configured_Data(default_splits)
+_start_lock = threading.Lock()
+_started_pid = None
 
-test_model = Model(assets, consumption)
 
-test_model.scenarios_from_df(interventions_df, rollouts_df)
+def report_progress(stage, fraction):
+    status.update(stage=stage, progress=fraction)
 
-df = (test_model.apply_interventions(test_model.scenarios)
-      .pipe(path.attach_asset_data, assets, ['Country Code', 'Sector Code', 'Area'])
-      .reset_index()
-      )
 
-asset_list = assets['UID'].unique()
-country_list = assets['Country Code'].unique()
-sector_list = assets['Sector Code'].unique()
-scenario_list = df['Scenario'].unique()
-path_list = ['GHG-Int', 'kWh-Int']
+def load_results():
+    global results, stranding
+    try:
+        assets = data.read_excel_cached(input_file, sheet_name='Assets')
+        lists.update(asset=assets['UID'].unique().tolist(),
+                     country=assets['Country Code'].unique().tolist(),
+                     sector=assets['Sector Code'].unique().tolist())
+
+        if use_deltas:
+            store = open_results(input_file, progress=report_progress, deltas=True)
+
+            report_progress('Aggregating results', 0.95)
+            pathways = store.read_deltas()[0]
+            stranding = StrandingIndex.from_deltas(pathways)
+            results = ResultCube.from_deltas(pathways, store.read('assets'))
+            lists['scenario'] = list(pathways.names)
+        else:
+            store = open_results(input_file, progress=report_progress)
+
+            # The rows are read (memory-mapped) only to build the summaries; the cube reads
+            # the rows of selected assets back from the store when asked for them
+            report_progress('Aggregating results', 0.95)
+            df = store.read()
+            stranding = StrandingIndex.from_results(df, gaps=False)
+            results = ResultCube.from_store(store, df)
+            lists['scenario'] = df['Scenario'].unique().tolist()
+            del df
+        lists['year'] = stranding.gaps.columns.tolist()
+        report_progress('Ready', 1.0)
+    except Exception as e:
+        status['error'] = f"{type(e).__name__}: {e}"
+        raise
+
+
+def start_model_run():
+    """
+    Starts the background run once per process. Checking the pid restarts it in workers forked
+    after import (gunicorn --preload), since threads do not survive a fork
+    """
+    global _started_pid
+    with _start_lock:
+        if _started_pid != os.getpid():
+            _started_pid = os.getpid()
+            threading.Thread(target=load_results, name='model-run', daemon=True).start()
+
+
+start_model_run()
 
 app.layout = dbc.Container(children=[
     html.H1(children='Dashboard'),
 
+    dbc.Row(dbc.Col(html.Div(id='status-panel', children=[
+        dbc.Progress(id='status-progress', value=0, striped=True, animated=True),
+        html.Small(id='status-text', children='Starting')
+    ]))),
+
+    dcc.Interval(id='status-interval', interval=1000),
+    dcc.Store(id='results-ready', data=False),
+
     dbc.Row(children=[
-        dbc.Col(dcc.Graph(
+        dbc.Col(dcc.Loading(dcc.Graph(
             id='pathway-graph'
-        ), width=8
+        )), width=8
         ),
 
         dbc.Col(dbc.Stack([
             dcc.Dropdown(
-                asset_list,
+                [],
                 id='asset-dropdown',
                 multi=True,
                 placeholder='Select Assets to include'
             ),
 
             dcc.Dropdown(
-                country_list,
+                [],
                 id='country-dropdown',
                 multi=True,
                 placeholder='Select Countries to include'
             ),
 
             dcc.Dropdown(
-                sector_list,
+                [],
                 id='sector-dropdown',
                 multi=True,
                 placeholder='Select Sectors to include'
             ),
 
             dcc.Dropdown(
-                scenario_list,
+                [],
                 id='scenario-dropdown',
                 placeholder='Select Scenarios to include'
             ),
@@ -84,6 +147,12 @@ app.layout = dbc.Container(children=[
                 path_list,
                 id='path-dropdown',
                 placeholder='Select Pathway Type to display'
+            ),
+
+            dcc.Dropdown(
+                [],
+                id='stranding-dropdown',
+                placeholder='Only include assets stranding before'
             )
         ],
             gap=3
@@ -94,51 +163,105 @@ app.layout = dbc.Container(children=[
 
     ]),
 
-    dbc.Row(
-
-    )
+    dbc.Row(id='profile-panel')
 ])
 
 
+@app.callback(
+    Output('status-progress', 'value'),
+    Output('status-progress', 'label'),
+    Output('status-text', 'children'),
+    Output('status-panel', 'hidden'),
+    Output('status-interval', 'disabled'),
+    Output('results-ready', 'data'),
+    Output('asset-dropdown', 'options'),
+    Output('country-dropdown', 'options'),
+    Output('sector-dropdown', 'options'),
+    Output('scenario-dropdown', 'options'),
+    Output('stranding-dropdown', 'options'),
+    Output('profile-panel', 'children'),
+    Input('status-interval', 'n_intervals')
+)
+def poll_status(n_intervals):
+    # the filters fill in as soon as the assets are read, and the graph once the results are ready
+    start_model_run()
+    ready = results is not None
+    percent = round(100 * status['progress'])
+    text = f"Model failed - {status['error']}" if status['error'] else status['stage']
+    profile = ([html.Details([html.Summary('Profile'),
+                              html.Pre(profiler.to_json(indent=2))])]
+               if ready and profiler.enabled else [])
+    return (percent, f"{percent}%", text, ready, ready or bool(status['error']), ready or no_update,
+            lists['asset'], lists['country'], lists['sector'], lists['scenario'], lists['year'], profile)
+
+
 @app.callback(
     Output('pathway-graph', 'figure'),
     Input('asset-dropdown', 'value'),
     Input('country-dropdown', 'value'),
     Input('sector-dropdown', 'value'),
     Input('scenario-dropdown', 'value'),
-    Input('path-dropdown', 'value')
+    Input('path-dropdown', 'value'),
+    Input('stranding-dropdown', 'value'),
+    Input('results-ready', 'data')
 )
-def plot_figure(input_assets, input_countries, input_sectors, input_scenario, input_path):
-    assets = input_assets if input_assets else asset_list
-    countries = input_countries if input_countries else country_list
-    sectors = input_sectors if input_sectors else sector_list
+def plot_figure(input_assets, input_countries, input_sectors, input_scenario, input_path, input_stranding, ready):
+    if not ready:
+        fig = go.Figure()
+        fig.update_layout(title='Model running...')
+        return fig
+
     scenario = input_scenario if input_scenario else 'Scenario 1'
     path_type = input_path if input_path else 'GHG-Int'
+    assets = input_assets
+    if input_stranding:
+        stranded = stranding.stranding_before(input_stranding, scenario, path_type)
+        if assets:
+            stranded = set(stranded)
+            assets = [asset for asset in assets if asset in stranded]
+        else:
+            assets = stranded
+        if len(assets) == 0:
+            fig = go.Figure()
+            fig.update_layout(title=f"No assets strand before {input_stranding} in {scenario}")
+            return fig
 
-    scenarios = ['BAU', 'Target']
-    scenarios.append(scenario)
+    # dropdown values arrive as lists, so are frozen to hashable keys for the figure cache
+    return render_figure(tuple(sorted(assets)) if assets is not None and len(assets) else None,
+                         tuple(sorted(input_countries)) if input_countries else None,
+                         tuple(sorted(input_sectors)) if input_sectors else None,
+                         scenario,
+                         path_type)
 
-    mask = ((df['UID'].isin(assets))
-            & (df['Country Code'].isin(countries))
-            & (df['Sector Code'].isin(sectors))
-            & (df['Pathway Code'] == path_type)
-            & (df['Scenario']).isin(scenarios)
-            )
 
-    plot_sums = (df[mask]
-                 .drop(columns=['Country Code', 'Sector Code', 'UID', 'Pathway Code'])
-                 .groupby('Scenario')
-                 .sum()  # TODO: would like to retain more aggregations (min, max, some percentiles) here in future
-                 )
+@lru_cache(maxsize=128)
+@profiled('render_figure')
+def render_figure(assets, countries, sectors, scenario, path_type):
+    scenarios = ['BAU', 'Target']
+    scenarios.append(scenario)
 
-    plot_data = (plot_sums.div(plot_sums['Area'], axis=0)
-                 .drop(columns=['Area'])
+    plot_data = (results.intensities(scenarios, path_type, countries, sectors, assets)
                  .T
                  .replace(0, np.nan)
                  )
 
     fig = px.line(plot_data, x=plot_data.index, y=scenarios)
 
+    # shade the spread of asset intensities around the selected scenario's area-weighted mean
+    bands = (results.bands([scenario], path_type, countries, sectors, assets)
+             .loc[scenario]
+             .T
+             .where(plot_data[scenario].notna())
+             )
+    for lower, upper, label in [('min', 'max', 'Range'), ('p10', 'p90', 'P10-P90'), ('p25', 'p75', 'P25-P75')]:
+        fig.add_trace(go.Scatter(x=bands.index, y=bands[lower], mode='lines', line_width=0,
+                                 showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=bands.index, y=bands[upper], mode='lines', line_width=0,
+                                 fill='tonexty', fillcolor='rgba(99, 110, 250, 0.15)',
+                                 name=f"{scenario} {label}"))
+    fig.add_trace(go.Scatter(x=bands.index, y=bands['p50'], mode='lines', line_dash='dot',
+                             name=f"{scenario} Median"))
+
     return fig
 
 
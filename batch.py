@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch runner: builds the model and scenarios of every portfolio workbook in a
+directory (or listed in a manifest, one path per line) and writes each portfolio's results
+to a ResultStore under the output directory. Portfolios are spread across a process pool;
+every attempt is logged to runs.jsonl in the output directory, with its stage timings.
+Nothing is written beside the input workbooks: their binary caches are kept under output/.cache
+
+    python batch.py portfolios/ --output results/ --workers 8
+    python batch.py nightly.txt --output results/ --workers 8 --resume
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import ReferenceData as data
+import Runner
+from Profiling import profiler
+from Store import ResultStore
+
+extensions = ('.xlsx', '.xlsm', '.xls')
+
+
+def find_portfolios(source: str) -> list:
+    """
+    The workbooks in a directory (recursively, skipping hidden and cache folders), or the paths
+    listed in a manifest file, relative to the manifest. Blank lines and # comments are skipped
+    """
+    if os.path.isdir(source):
+        found = []
+        for root, dirs, files in os.walk(source):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            found.extend(os.path.join(root, name) for name in sorted(files)
+                         if name.lower().endswith(extensions) and not name.startswith('~$'))
+        return found
+
+    with open(source) as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    base = os.path.dirname(os.path.abspath(source))
+    return [os.path.join(base, line) for line in lines if line]
+
+
+def result_name(input_file: str, source: str) -> str:
+    """
+    The folder results are written to: the workbook's path relative to the source directory (or
+    manifest), with anything but letters and digits replaced, so workbooks sharing a name do not collide
+    """
+    base = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+    relative = os.path.relpath(os.path.abspath(input_file), os.path.abspath(base))
+    return ''.join(c if c.isalnum() else '_' for c in relative)
+
+
+def completed(log_path: str) -> dict:
+    """
+    The key of the last successful run of each portfolio in a run log
+    """
+    done = {}
+    if not os.path.exists(log_path):
+        return done
+    with open(log_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            if record['status'] == 'ok':
+                done[record['portfolio']] = record['key']
+            else:
+                done.pop(record['portfolio'], None)
+    return done
+
+
+def _init_worker(memory_limit: int, profile: bool):
+    """
+    Caps the worker's address space (in MiB), so an oversized portfolio fails with a MemoryError
+    rather than exhausting the machine, and loads the reference data once for the worker's lifetime
+    """
+    if memory_limit:
+        limit = memory_limit * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # Each table is held by its Default_Data (or as a module global) once first read
+    for default in (data.default_pathways, data.default_factors, data.default_splits):
+        default.default
+    for name in ('efficiency_parameters', 'reassignment_parameters'):
+        getattr(data, name)
+    if profile:
+        profiler.enable()
+
+
+def run_one(input_file: str, key: str, target: str, file_format: str = 'parquet') -> dict:
+    """
+    Runs one portfolio and writes its results, returning a record of the run. Failures are
+    recorded rather than raised, so one bad portfolio does not stop the batch. The worker's peak
+    resident memory is that of its whole life (ru_maxrss), so covers the portfolios it ran before
+    """
+    record = {'portfolio': input_file, 'key': key, 'results': target, 'pid': os.getpid(),
+              'started': datetime.now().isoformat(timespec='seconds'), 'stages': {}}
+    profiler.reset()
+    start = last = time.perf_counter()
+    stage = 'Reading portfolio'
+
+    def progress(next_stage: str, fraction: float):
+        nonlocal stage, last
+        now = time.perf_counter()
+        record['stages'][stage] = record['stages'].get(stage, 0) + now - last
+        stage, last = next_stage, now
+
+    try:
+        output, name = os.path.split(target)
+        portfolio = Runner.read_portfolio(input_file, cache_dir=os.path.join(output, '.cache', name))
+        record['assets'] = len(portfolio['Assets'])
+        model, pathways = Runner.run_portfolio(portfolio, progress)
+        progress('Saving results', 0.9)
+        model.write_results(target, pathways, file_format=file_format)
+        progress('Done', 1.0)
+        record['status'] = 'ok'
+    except Exception as error:
+        progress('Failed', 1.0)
+        record['status'] = 'failed'
+        record['error'] = ''.join(traceback.format_exception_only(error)).strip()
+    finally:
+        # Lookups are memoised per portfolio, so are dropped before the worker takes the next one
+        for configured in (data.factors, data.pathways, data.splits):
+            configured.invalidate()
+        model = pathways = portfolio = None
+        gc.collect()
+
+    record['seconds'] = time.perf_counter() - start
+    record['worker_peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    if profiler.enabled:
+        record['profile'] = profiler.report()
+    return record
+
+
+def run_batch(portfolios: list, source: str, output: str, workers: int = 1, file_format: str = 'parquet',
+              resume: bool = False, memory_limit: int = None, tasks_per_worker: int = 10,
+              profile: bool = False) -> list:
+    """
+    Runs the portfolios across a process pool, appending a record per portfolio to
+    output/runs.jsonl as each finishes. With resume set, portfolios whose last run succeeded
+    on the same portfolio and reference data (and whose results are still present) are skipped.
+    Workers are replaced after tasks_per_worker portfolios, returning the memory they hold.
+    A portfolio which cannot be read to key it is logged as failed without being run
+    """
+    os.makedirs(output, exist_ok=True)
+    log_path = os.path.join(output, 'runs.jsonl')
+    done = completed(log_path) if resume else {}
+    if not resume and os.path.exists(log_path):
+        os.remove(log_path)
+
+    tasks = []
+    unreadable = []
+    for input_file in portfolios:
+        target = os.path.join(output, result_name(input_file, source))
+        try:
+            key = Runner.results_key(input_file)
+        except OSError as error:
+            unreadable.append({'portfolio': input_file, 'key': None, 'results': target, 'status': 'failed',
+                               'error': ''.join(traceback.format_exception_only(error)).strip()})
+            continue
+        if done.get(input_file) == key and ResultStore(target).exists():
+            print(f"skipped  {input_file}")
+            continue
+        tasks.append((input_file, key, target))
+
+    records = []
+
+    def report(record: dict, log):
+        log.write(json.dumps(record) + '\n')
+        log.flush()
+        records.append(record)
+        print(f"{record['status']:<8} {record['portfolio']}  {record.get('seconds', 0):8.2f}s"
+              + (f"  {record['error']}" if record['status'] != 'ok' else ''))
+
+    with open(log_path, 'a') as log, \
+            ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks))),
+                                mp_context=multiprocessing.get_context('spawn'),
+                                initializer=_init_worker, initargs=(memory_limit, profile),
+                                max_tasks_per_child=tasks_per_worker) as executor:
+        for record in unreadable:
+            report(record, log)
+        futures = {executor.submit(run_one, *task, file_format): task for task in tasks}
+        for future in as_completed(futures):
+            input_file, key, target = futures[future]
+            try:
+                record = future.result()
+            except BrokenProcessPool as error:
+                # A worker died outright (eg killed for memory); the portfolios it took down are logged as failed
+                record = {'portfolio': input_file, 'key': key, 'results': target,
+                          'status': 'failed', 'error': f"Worker process died: {error}"}
+            report(record, log)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='directory of portfolio workbooks, or a manifest listing them')
+    parser.add_argument('--output', default='batch_results')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--format', choices=['parquet', 'ipc'], default='parquet')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip portfolios which already have results for their current contents')
+    parser.add_argument('--memory-limit', type=int, default=None, help='address space cap per worker, in MiB')
+    parser.add_argument('--tasks-per-worker', type=int, default=10,
+                        help='portfolios each worker runs before it is replaced')
+    parser.add_argument('--profile', action='store_true', help='record a stage profile of every run')
+    args = parser.parse_args()
+
+    portfolios = find_portfolios(args.source)
+    records = run_batch(portfolios, args.source, args.output, args.workers, args.format, args.resume,
+                        args.memory_limit, args.tasks_per_worker, args.profile)
+    failed = [record for record in records if record['status'] != 'ok']
+    print(f"{len(records) - len(failed)} succeeded, {len(failed)} failed, "
+          f"{len(portfolios) - len(records)} skipped")
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Scaling benchmark: times each stage of a model run on synthetic portfolios of increasing
+size, and writes wall time and peak memory per stage to a JSON file for comparison
+between versions
+
+    python benchmark.py --sizes 100 1000 10000 --output benchmark_results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import plotly.express as px
+
+import pathwayFunctions as path
+from Interventions import Model
+from Results import ResultCube
+from Synthetic import generate_portfolio
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure(stage: str, n_assets: int, records: list, func, *args, **kwargs):
+    """
+    Runs func, appending its wall time and peak traced memory to records. tracemalloc
+    slows allocation-heavy stages, so times are best compared between runs of this script
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    records.append({'assets': n_assets, 'stage': stage, 'seconds': seconds, 'peak_bytes': peak})
+    print(f"{n_assets:>8} assets  {stage:<22} {seconds:9.3f}s  {peak / 2**20:9.1f} MiB")
+    return result
+
+
+def run_size(n_assets: int, seed: int, workers: int, records: list):
+    portfolio = generate_portfolio(n_assets, seed=seed)
+    assets = portfolio['Assets']
+
+    model = measure('Model.__init__', n_assets, records, Model, assets, portfolio['Consumption'])
+    measure('scenarios_from_df', n_assets, records,
+            model.scenarios_from_df, portfolio['Interventions'], portfolio['Rollouts'])
+    pathways = measure('apply_interventions', n_assets, records,
+                       model.apply_interventions, model.scenarios, workers=workers)
+
+    df = (pathways.pipe(path.attach_asset_data, assets, ['Country Code', 'Sector Code', 'Area'])
+                  .reset_index()
+          )
+    results = measure('ResultCube', n_assets, records, ResultCube, df)
+
+    def callback():
+        scenarios = ['BAU', 'Target', model.scenarios[0].name]
+        plot_data = results.intensities(scenarios, 'GHG-Int').T
+        return px.line(plot_data, x=plot_data.index, y=scenarios)
+
+    measure('dashboard callback', n_assets, records, callback)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    records = []
+    for n_assets in args.sizes:
+        run_size(n_assets, args.seed, args.workers, records)
+
+    report = {'revision': revision(),
+              'timestamp': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'workers': args.workers,
+              'results': records}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,30 +4,41 @@ Core functions for acting on pathway dataframes
 May ultimately become a custom accessor to dataframes
 """
 
+import numpy as np
 import pandas as pd
 import ReferenceData as data
 from Schemas import Asset_Data
+from PathwayCube import PathwayCube
+from Profiling import profiled, row_count
 
 
 def fill_to_horizon(consumptions, horizon=2050):
     """
     Fill out BAU forecasts with last year of actual data.
     This forward inference could be smarter, eg use a rolling average to keep more than one year's data involved
+    The missing years are allocated in one block rather than inserted column by column
     """
-    year = consumptions.columns.max()  # initialise to last year within actual data
-    while year < horizon:
-        consumptions[year + 1] = consumptions[year].copy()
-        year += 1
+    year = consumptions.columns.max()  # last year within actual data
+    if year >= horizon:
+        return consumptions
 
-    return consumptions
+    extension = pd.DataFrame(np.repeat(consumptions[[year]].to_numpy(), horizon - year, axis=1),
+                             index=consumptions.index,
+                             columns=pd.Index(range(year + 1, horizon + 1), name=consumptions.columns.name))
+    return pd.concat([consumptions, extension], axis=1)
 
 
+@profiled('path.forecast_BAU_Consumption', rows=row_count)
 def forecast_BAU_Consumption(asset_data, con_data, horizon=2050):
     """
     Uses an asset info df and consumption data for those assets in record form
     to return pathways for annual consumption out to the horizon, by pivoting
-    the record-form consumption data appropriately
+    the record-form consumption data appropriately.
+    con_data may also be a path to a CSV or Parquet file, which is then streamed in chunks
     """
+    if not isinstance(con_data, pd.DataFrame):
+        return stream_BAU_Consumption(asset_data, con_data, horizon)
+
     asset_con_data = con_data[con_data['UID'].isin(asset_data['UID'])]
     BAU_Consumption = (asset_con_data.pivot(index=['UID', 'Utility'], columns='Year', values='Consumption')
                                        .pipe(fill_to_horizon, horizon)
@@ -35,6 +46,48 @@ def forecast_BAU_Consumption(asset_data, con_data, horizon=2050):
     return BAU_Consumption
 
 
+def read_consumption(source, chunksize=1_000_000):
+    """
+    Yields record-form consumption data in chunks of at most chunksize rows, from a CSV or
+    Parquet file, or from a dataframe already in memory
+    """
+    columns = ['UID', 'Utility', 'Year', 'Consumption']
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunksize):
+            yield source.iloc[start:start + chunksize][columns]
+    elif str(source).endswith(('.parquet', '.pq')):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, usecols=columns, chunksize=chunksize)
+
+
+@profiled('path.stream_BAU_Consumption', rows=row_count)
+def stream_BAU_Consumption(asset_data, source, horizon=2050, chunksize=1_000_000):
+    """
+    As forecast_BAU_Consumption, but reads the consumption data in chunks, pivoting each chunk
+    as it arrives and folding it into the (UID, Utility) x Year frame. Peak memory is then
+    bounded by the chunk size and the size of the result, rather than the size of the input.
+    Where a (UID, Utility, Year) appears in more than one chunk, the later value is kept
+    """
+    uids = pd.Index(asset_data['UID'].unique())
+    BAU_Consumption = None
+    for chunk in read_consumption(source, chunksize):
+        chunk = chunk[chunk['UID'].isin(uids)]
+        if chunk.empty:
+            continue
+        wide = chunk.pivot(index=['UID', 'Utility'], columns='Year', values='Consumption')
+        BAU_Consumption = wide if BAU_Consumption is None else wide.combine_first(BAU_Consumption)
+
+    if BAU_Consumption is None:
+        raise ValueError(f"No consumption data found in {source} for the given assets")
+
+    BAU_Consumption = BAU_Consumption.sort_index().sort_index(axis=1)
+    BAU_Consumption.columns.name = 'Year'
+    return fill_to_horizon(BAU_Consumption, horizon)
+
+
 def attach_asset_data(pathways: pd.DataFrame, asset_data: pd.DataFrame, columns: list):
     """
     Takes a pathway (defined as having UID on level 0 of index, and years on outside
@@ -50,19 +103,33 @@ def attach_asset_data(pathways: pd.DataFrame, asset_data: pd.DataFrame, columns:
     return with_data
 
 
+@profiled('path.carbon_conversion', rows=row_count)
 def carbon_conversion(pathways, asset_data: Asset_Data):
     """
     Gets appropriate dataframe of emissions factors, and converts a frame of consumption pathways
-    to the corresponding carbon pathways
+    to the corresponding carbon pathways. Consumption held as a PathwayCube gives a cube of emissions
     """
-    factors = data.factors.get_data(asset_data)
+    if isinstance(pathways, PathwayCube):
+        factors = data.factors.get_data(asset_data)
+        return (pathways.multiply(PathwayCube.from_frame(factors))
+                        .dropna('Year')
+                        .sum(['Utility'])
+                )
 
-    # Apply factors and sum to get BAU Emissions
-    carbon = pathways * factors
+    # Factors come pre-aligned to the pathways (and cached), so the product is positional
+    factors = data.factors.get_aligned(asset_data, pathways)
+    carbon = pd.DataFrame(pathways.to_numpy(dtype=float) * factors.to_numpy(),
+                          index=pathways.index,
+                          columns=pathways.columns)
     emissions = (carbon.dropna(axis=1, how='all')
-                 .groupby(['UID'])  # don't like this hard-coded groupby
+                 .groupby(['UID'], observed=True)  # don't like this hard-coded groupby
                  .sum()
                  )
+
+    # Assets with factors but no consumption still get (zero) emissions, as under index alignment
+    covered = data.factors.get_index(asset_data).unique('UID')
+    if not covered.isin(emissions.index).all():
+        emissions = emissions.reindex(emissions.index.union(covered), fill_value=0)
     return emissions
 
 
@@ -86,16 +153,91 @@ def get_pathways(asset_data):
     return budgets
 
 
-def split_pathway(asset_data: Asset_Data, consumption_pathway):
-    split_df = consumption_pathway.multiply(data.splits.get_data(asset_data), axis=0)
+@profiled('path.split_pathway', rows=row_count)
+def split_pathway(asset_data: Asset_Data, consumption_pathway, sparse: bool = False):
+    """
+    Splits (UID, Utility) consumption pathways across end uses. The dense splits array is
+    broadcast against the consumption rows by position rather than aligned by index, giving
+    sorted (UID, Utility, Use) rows, which are NaN where an asset has no consumption of that utility.
+    Consumption held as a PathwayCube gives a cube with a Use axis.
+    With sparse set, the frame is stored with sparse columns, missing consumption being held as zero;
+    this saves memory at rest, not in the steps which densify it (see Model)
+    An asset listed more than once takes the splits of its first row
+    """
+    asset_data = asset_data.drop_duplicates('UID')
+    if isinstance(consumption_pathway, PathwayCube):
+        shares = PathwayCube.from_series(data.splits.get_data(asset_data))
+        return (consumption_pathway.multiply(shares)
+                                   .transpose(['UID', 'Utility', 'Use', 'Year'])
+                )
+
+    shares = data.splits.get_data(asset_data, dense=True)
+    uses = shares.columns
+    uids = shares.index.unique().sort_values()
+
+    index = pd.MultiIndex.from_arrays([np.repeat(uids.to_numpy(), len(uses)),
+                                       *(np.tile(uses.get_level_values(level), len(uids))
+                                         for level in range(uses.nlevels))],
+                                      names=['UID', *uses.names])
+    source = consumption_pathway.index.get_indexer(index.droplevel('Use'))
+    consumption = consumption_pathway.to_numpy(dtype=float)[source]
+    consumption[source < 0] = np.nan
+
+    share_rows = shares.index.get_indexer(uids)
+    split_values = consumption * shares.to_numpy()[share_rows].reshape(-1, 1)
+    if sparse:
+        return to_sparse(split_values, index, consumption_pathway.columns)
+
+    split_df = pd.DataFrame(split_values,
+                            index=index,
+                            columns=consumption_pathway.columns)
     return split_df
 
 
+def is_sparse(pathway) -> bool:
+    return isinstance(pathway, pd.DataFrame) and any(isinstance(dtype, pd.SparseDtype) for dtype in pathway.dtypes)
+
+
+def to_sparse(values: np.ndarray, index, columns) -> pd.DataFrame:
+    """
+    Builds a frame of sparse columns (ReferenceData.sparse, filled with zero) from an array,
+    with NaN stored as zero
+    """
+    values = np.nan_to_num(values, nan=0.0)
+    sparse_df = pd.DataFrame({i: pd.arrays.SparseArray(values[:, i], dtype=data.sparse)
+                              for i in range(values.shape[1])},
+                             index=index)
+    sparse_df.columns = columns
+    return sparse_df
+
+
+def sparse_sum(pathway: pd.DataFrame, levels: list) -> pd.DataFrame:
+    """
+    Groupby-sum of a sparse frame down to the given index levels. Each column's stored values
+    are added into their groups directly, so the frame is never densified, and the sums are
+    returned as sparse columns
+    """
+    keys = pathway.index.droplevel([name for name in pathway.index.names if name not in levels])
+    codes, groups = pd.factorize(keys, sort=True)
+    if not isinstance(groups, pd.MultiIndex) and len(levels) > 1:
+        groups = pd.MultiIndex.from_tuples(groups, names=levels)
+    groups.names = keys.names
+
+    sums = np.empty((len(groups), len(pathway.columns)))
+    for i, column in enumerate(pathway.columns):
+        array = pathway[column].array
+        stored = array.sp_index.to_int_index().indices
+        sums[:, i] = np.bincount(codes[stored], weights=np.nan_to_num(array.sp_values), minlength=len(groups))
+    return to_sparse(sums, groups, pathway.columns)
+
+
 def normalise(pathway):
     """
     Divides the columns of a pathway by its area column and then drops the areas,
-    if such a column exists
+    if such a column exists. A PathwayCube is divided by the area it carries
     """
+    if isinstance(pathway, PathwayCube):
+        return pathway.scale_by_area(-1)
     if 'Area' in pathway.columns.to_list():
         normalised = (pathway.div(pathway['Area'], axis=0)
                       .drop(columns=['Area'])
@@ -108,8 +250,10 @@ def normalise(pathway):
 def denormalise(pathway):
     """
     Multiplies the columns of a pathway by its area column and then drops the areas,
-    if such a column exists
+    if such a column exists. A PathwayCube is multiplied by the area it carries
     """
+    if isinstance(pathway, PathwayCube):
+        return pathway.scale_by_area(1)
     if 'Area' in pathway.columns.to_list():
         normalised = (pathway.multiply(pathway['Area'], axis=0)
                       .drop(columns=['Area'])
@@ -117,3 +261,15 @@ def denormalise(pathway):
         return normalised
     else:
         print(f"{pathway} does not have an 'Area' column")
+
+
+def aggregate(pathway, levels: list):
+    """
+    Sums a pathway down to the given index levels (axes, for a PathwayCube), keeping the years.
+    Sparse frames stay sparse
+    """
+    if isinstance(pathway, PathwayCube):
+        return pathway.sum([name for name in pathway.names if name not in levels and name != 'Year'])
+    if is_sparse(pathway):
+        return sparse_sum(pathway, levels)
+    return pathway.groupby(levels, observed=True).sum()
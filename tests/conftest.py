@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+The modules are imported from the repository root, and the reference workbooks read from
+'Reference Data' under the working directory: NZC_DATA_ROOT if set, else the repository root
+if it holds them. Otherwise synthetic reference workbooks are written to a temporary folder
+"""
+
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+data_root = os.environ.get('NZC_DATA_ROOT', root)
+
+
+@pytest.fixture(autouse=True, scope='session')
+def reference_data(tmp_path_factory):
+    folder = data_root
+    if not os.path.isdir(os.path.join(folder, 'Reference Data')):
+        if 'NZC_DATA_ROOT' in os.environ:
+            pytest.skip("no 'Reference Data' folder under NZC_DATA_ROOT")
+        import Synthetic
+        folder = str(tmp_path_factory.mktemp('reference'))
+        Synthetic.write_reference_data(os.path.join(folder, 'Reference Data'))
+    cwd = os.getcwd()
+    os.chdir(folder)
+    yield
+    os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def portfolio(reference_data):
+    """
+    A small synthetic portfolio, validated and encoded as Runner.read_portfolio would
+    """
+    import Runner
+    import Synthetic
+    return Runner.ingest(Synthetic.generate_portfolio(80, seed=3))
+
+
+@pytest.fixture(scope='session')
+def raw_portfolio(reference_data):
+    """
+    The same portfolio, validated but with its key columns left unencoded
+    """
+    import Runner
+    import Synthetic
+    return Runner.ingest(Synthetic.generate_portfolio(80, seed=3), encode=False)
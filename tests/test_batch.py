@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the batch runner over a folder of generated portfolios
+"""
+
+import json
+import os
+
+import batch
+import Synthetic
+from Store import ResultStore
+
+
+def listing(folder: str) -> list:
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, dirs, files in os.walk(folder) for name in dirs + files)
+
+
+def test_batch_writes_only_under_output(tmp_path):
+    inputs, output = tmp_path / 'portfolios', tmp_path / 'results'
+    os.makedirs(inputs / 'region')
+    for n, path in enumerate([inputs / 'a.xlsx', inputs / 'region' / 'a.xlsx']):
+        Synthetic.write_portfolio(Synthetic.generate_portfolio(20, seed=n), str(path))
+    with open(inputs / 'broken.xlsx', 'w') as f:
+        f.write('not a workbook')
+    before = listing(str(inputs))
+
+    portfolios = batch.find_portfolios(str(inputs))
+    records = batch.run_batch(portfolios, str(inputs), str(output), workers=2)
+    assert listing(str(inputs)) == before
+    assert sorted(record['status'] for record in records) == ['failed', 'ok', 'ok']
+    for record in records:
+        if record['status'] == 'ok':
+            assert ResultStore(record['results']).exists()
+    with open(output / 'runs.jsonl') as f:
+        assert len([json.loads(line) for line in f]) == 3
+
+    # A resumed run skips the portfolios which succeeded, reading nothing beside them either
+    records = batch.run_batch(portfolios, str(inputs), str(output), workers=2, resume=True)
+    assert [record['portfolio'] for record in records] == [str(inputs / 'broken.xlsx')]
+    assert listing(str(inputs)) == before
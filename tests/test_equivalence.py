@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the optimised paths give the same results as the paths they replace
+"""
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import Runner
+
+
+def run(portfolio: dict, **kwargs):
+    model, pathways = Runner.run_portfolio(portfolio, **kwargs)
+    return model, pathways
+
+
+def assert_results_equal(left, right, rtol: float = 1e-9):
+    """
+    Pathways, scenario consumption and impacts of two (model, pathways) runs agree
+    """
+    (left_model, left_pathways), (right_model, right_pathways) = left, right
+    assert_frame_equal(left_pathways.sort_index(), right_pathways.sort_index(), rtol=rtol,
+                       check_index_type=False, check_categorical=False)
+    assert_frame_equal(left_model.scenario_consumption_data.sort_index(),
+                       right_model.scenario_consumption_data.sort_index(), rtol=rtol,
+                       check_index_type=False, check_categorical=False)
+    assert_frame_equal(left_model.scenario_impact_data, right_model.scenario_impact_data, rtol=rtol,
+                       check_dtype=False, check_categorical=False)
+
+
+def test_batch_matches_sequential(portfolio):
+    assert_results_equal(run(portfolio, batch=True), run(portfolio, batch=False))
+
+
+def test_split_pathway_matches_aligned_multiply(portfolio):
+    import pathwayFunctions as path
+    import ReferenceData as data
+    from Interventions import Model
+
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+    split = path.split_pathway(model.asset_data, model.BAU_Consumption)
+    expected = model.BAU_Consumption.multiply(data.splits.get_data(model.asset_data), axis=0)
+    assert_frame_equal(split, expected.reindex(split.index), check_index_type=False, check_categorical=False)
+
+    duplicated = pd.concat([model.asset_data, model.asset_data.iloc[:3]])
+    assert_frame_equal(path.split_pathway(duplicated, model.BAU_Consumption), split)
+
+
+def test_parallel_matches_serial(portfolio):
+    assert_results_equal(run(portfolio), run(portfolio, workers=2))
+
+
+def test_incremental_matches_full(portfolio):
+    import ReferenceData as data
+    from Interventions import Model
+
+    full = run(portfolio)
+    model = Model(portfolio['Assets'], portfolio['Consumption'], asset_cache_size=30)
+    model.scenarios_from_df(portfolio['Interventions'], portfolio['Rollouts'])
+    for _ in range(2):  # the second run reads what the bounded cache kept
+        pathways = model.apply_interventions(model.scenarios, incremental=True)
+        assert len(model.asset_cache) <= 30
+        assert_results_equal(full, (model, pathways))
+
+    # Results cached under other reference data are not reused
+    data.factors.custom = data.default_factors.get_defaults(portfolio['Assets']) * 2
+    try:
+        model.apply_interventions(model.scenarios, incremental=True)
+        assert all(key[1][0] == data.reference_digest() for key in model.asset_cache)
+        impacts = model.scenario_impact_data
+        model.apply_interventions(model.scenarios)
+        assert_frame_equal(impacts, model.scenario_impact_data, check_dtype=False)
+    finally:
+        data.factors.custom = None
+    model.clear_cache()
+    assert len(model.asset_cache) == 0
+
+
+def test_plan_matches_rollout_unpack(portfolio):
+    from Interventions import Model, Scenario
+
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+    # Coarse intensities, so that many assets tie in the targeting sort
+    intensities = model.BAU_Pathways[model.base_year]
+    model.BAU_Pathways[model.base_year] = (intensities // intensities.median()).astype(float)
+    model.scenarios_from_df(portfolio['Interventions'], portfolio['Rollouts'])
+    interventions, rollouts = portfolio['Interventions'], portfolio['Rollouts']
+    for scenario in model.scenarios:
+        expected = Scenario.from_df(scenario.name, interventions[interventions['Scenario'] == scenario.name],
+                                    rollouts[rollouts['Scenario'] == scenario.name], model)
+        assert list(zip(*scenario.plan())) == [(intervention.target, intervention.year, intervention.intervention_type)
+                                               for intervention in expected.intervention_list]
+
+
+def test_carbon_conversion_matches_aligned_multiply(portfolio):
+    import pathwayFunctions as path
+    import ReferenceData as data
+    from Interventions import Model
+
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+    assets, consumption = model.asset_data, model.BAU_Consumption
+
+    def expected():
+        return (consumption * data.factors.get_data(assets)).dropna(axis=1, how='all').groupby(['UID'], observed=True).sum()
+
+    assert_frame_equal(path.carbon_conversion(consumption, assets), expected(), check_index_type=False)
+
+    # Alignments are keyed on the index contents, and only kept once asked for twice
+    data.factors.invalidate()
+    aligned = [data.factors.get_aligned(assets, consumption.copy(deep=True)) for _ in range(3)]
+    assert aligned[0] is not aligned[1] and aligned[1] is aligned[2]
+    assert len(data.factors._cache) == 2  # the aligned frame and the data it was built from
+
+    data.factors.custom = data.default_factors.get_defaults(assets.iloc[:5]) * 2
+    try:
+        assert_frame_equal(path.carbon_conversion(consumption.copy(), assets), expected(), check_index_type=False)
+    finally:
+        data.factors.custom = None
+
+
+def test_sparse_matches_dense(portfolio):
+    from Interventions import Model
+
+    dense = run(portfolio)
+    model = Model(portfolio['Assets'], portfolio['Consumption'], sparse=True)
+    model.scenarios_from_df(portfolio['Interventions'], portfolio['Rollouts'])
+    for kwargs in ({}, {'batch': False}, {'incremental': True}):
+        pathways = model.apply_interventions(model.scenarios, **kwargs)
+        model.scenario_consumption_data = model.scenario_consumption_data.sparse.to_dense()
+        assert_results_equal(dense, (model, pathways))
+
+
+def test_impact_log_matches_intervention_logs(portfolio):
+    from Interventions import Scenario
+
+    model, _ = run(portfolio, batch=False)
+    for scenario in model.scenarios:
+        expected = pd.DataFrame([intervention.impact_log for intervention in scenario.intervention_list])
+        assert_frame_equal(scenario.impact_log, expected, check_index_type=False)
+
+    empty = Scenario('Empty', interventions=[])
+    empty.act(model.bau_split()[0])
+    assert_frame_equal(empty.impact_log, pd.DataFrame())
+    empty.impact_log = expected
+    assert empty.impact_log is expected
+
+
+def test_encoded_matches_raw(portfolio, raw_portfolio):
+    assert_results_equal(run(portfolio), run(raw_portfolio))
+    assert_results_equal(run(portfolio, batch=False), run(raw_portfolio, batch=False))
+
+
+def test_deltas_match_full_frames(portfolio):
+    for kwargs in ({}, {'batch': False}, {'workers': 2}, {'incremental': True}):
+        model, pathways = run(portfolio, **kwargs)
+        consumption = model.scenario_consumption_data
+        deltas, delta_pathways = run(portfolio, deltas=True, **kwargs)
+        assert_frame_equal(delta_pathways.to_frame(), pathways, rtol=1e-9, check_index_type=False, check_categorical=False)
+        assert_frame_equal(deltas.scenario_consumption_data.to_frame(), consumption, rtol=1e-9,
+                           check_index_type=False, check_categorical=False)
+        assert_frame_equal(deltas.scenario_impact_data, model.scenario_impact_data)
+
+
+def test_uncertainty_without_spread_matches_deterministic(portfolio):
+    model, pathways = run(portfolio)
+    bands = model.uncertainty(model.scenarios, samples=3, spread={'efficiency': 0, 'cop': 0, 'factors': 0})
+    totals = pathways.groupby(['Scenario', 'Pathway Code'], observed=True).sum()
+    for scenario in ['BAU', *(scenario.name for scenario in model.scenarios)]:
+        for path_type in totals.loc[scenario].index:
+            expected = totals.loc[(scenario, path_type)]
+            for statistic in ['mean', 'p5', 'p50', 'p95']:
+                got = bands.loc[(scenario, path_type, statistic)].reindex(expected.index)
+                pd.testing.assert_series_equal(got, expected, rtol=1e-9, check_names=False)
+
+
+def test_uncertainty_independent_of_chunks_and_workers(portfolio):
+    model, _ = run(portfolio)
+    expected = model.uncertainty(model.scenarios, samples=20)
+    assert_frame_equal(model.uncertainty(model.scenarios, samples=20, chunk=7), expected)
+    assert_frame_equal(model.uncertainty(model.scenarios, samples=20, chunk=5, workers=2), expected)
+    by_asset = model.uncertainty(model.scenarios, samples=20, chunk=3, by_asset=True)
+    assert_frame_equal(model.uncertainty(model.scenarios, samples=20, chunk=20, workers=2, by_asset=True), by_asset)
+
+
+def test_streamed_consumption_matches_in_memory(raw_portfolio, tmp_path):
+    import pathwayFunctions as path
+
+    assets, consumption = raw_portfolio['Assets'], raw_portfolio['Consumption']
+    expected = path.forecast_BAU_Consumption(assets, consumption)
+    assert expected.columns.max() == 2050
+
+    csv, parquet = str(tmp_path / 'consumption.csv'), str(tmp_path / 'consumption.parquet')
+    shuffled = consumption.sample(frac=1, random_state=0)
+    shuffled.to_csv(csv, index=False)
+    shuffled.to_parquet(parquet, index=False)
+    for source in (csv, parquet, shuffled):
+        streamed = path.stream_BAU_Consumption(assets, source, chunksize=97)
+        assert_frame_equal(streamed, expected, check_index_type=False, check_column_type=False)
+    assert_frame_equal(path.forecast_BAU_Consumption(assets, parquet), expected, check_column_type=False)
+
+    # Assets outside the asset table are left out, and a repeated record keeps its later value
+    extra = pd.DataFrame({'UID': ['Unknown', expected.index[0][0]], 'Utility': ['Elec', expected.index[0][1]],
+                          'Year': [2018, 2018], 'Consumption': [1.0, -1.0]})
+    streamed = path.stream_BAU_Consumption(assets, pd.concat([consumption, extra], ignore_index=True), chunksize=50)
+    assert 'Unknown' not in streamed.index.get_level_values('UID')
+    assert streamed.iloc[0][2018] == -1.0
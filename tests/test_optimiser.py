@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that an optimised plan, applied as a scenario, records the costs the optimiser reports
+"""
+
+import pytest
+
+from Interventions import Model
+
+
+@pytest.fixture(scope='module')
+def optimised(portfolio):
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+    model.CRREM_Targets = model.CRREM_Targets * 0.1  # tight enough for assets to strand
+    scenario, summary = model.optimise(costs={'LED Lighting': 2.5, 'Heat Pump': 10})
+    return model, scenario, summary
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'batch': False}, {'workers': 2}, {'incremental': True}, {'deltas': True}])
+def test_applied_plan_records_optimiser_costs(optimised, kwargs):
+    model, scenario, summary = optimised
+    assert len(scenario.plan()[0]) > 0 and summary['Cost'].sum() > 0
+    model.apply_interventions([scenario], **kwargs)
+    impacts = model.scenario_impact_data.loc['Optimised']
+    table = scenario.intervention_plan.table
+    assert impacts['Target'].tolist() == table['Target'].tolist()
+    assert impacts['Cost'].tolist() == table['Cost'].tolist()
+    assert impacts['Cost'].sum() == pytest.approx(summary['Cost'].sum())
+    assert [intervention.cost for intervention in scenario.intervention_list] == table['Cost'].tolist()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that PathwayCube operations round trip to the results of the DataFrame paths
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import pathwayFunctions as path
+from Interventions import Model
+from PathwayCube import PathwayCube
+
+
+@pytest.fixture(scope='module')
+def split(portfolio):
+    model = Model(portfolio['Assets'], portfolio['Consumption'])
+    split = path.split_pathway(model.asset_data, model.BAU_Consumption).dropna(how='all')
+    split.iloc[::7, -3:] = np.nan  # rows with data in only some years
+    return split
+
+
+def test_frame_round_trip(split):
+    assert_frame_equal(PathwayCube.from_frame(split).to_frame(), split,
+                       check_index_type=False, check_categorical=False)
+
+
+@pytest.mark.parametrize('levels, absent', [(['UID', 'Utility'], True), (['UID'], False), (['Utility', 'Use'], False)])
+def test_sum_matches_groupby_sum(split, levels, absent):
+    cube = PathwayCube.from_frame(split)
+    summed = cube.sum([name for name in cube.names if name not in levels and name != 'Year'])
+    expected = split.groupby(levels, observed=True).sum()
+    # The cube holds every combination of labels, including those absent from the frame
+    assert (len(summed.to_frame(dropna=False)) > len(expected)) == absent
+    assert_frame_equal(summed.to_frame(), expected, check_index_type=False, check_categorical=False)
+
+
+def test_sum_without_column_axis_marks_empty_cells():
+    series = pd.Series([1.0, np.nan, 2.0],
+                       index=pd.MultiIndex.from_tuples([('a', 'x'), ('a', 'y'), ('b', 'x')], names=['UID', 'Use']))
+    summed = PathwayCube.from_series(series).sum('UID', column_axis=None)
+    np.testing.assert_array_equal(summed.values, [3.0, np.nan])
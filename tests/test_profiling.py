@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the stages and rows the profiler records
+"""
+
+import pytest
+
+import Runner
+from Profiling import profiler, profiled, row_count
+
+
+@pytest.fixture
+def profiling():
+    profiler.reset()
+    profiler.enable()
+    yield profiler
+    profiler.disable()
+    profiler.reset()
+
+
+def test_generator_stage_times_iteration(profiling):
+    import time
+
+    @profiled('slow_items', rows=len)
+    def slow_items():
+        for n in range(3):
+            time.sleep(0.01)
+            yield [None] * n
+
+    assert list(slow_items()) == [[], [None], [None, None]]
+    stats = profiling.report()['stages']['slow_items']
+    assert stats['calls'] == 1
+    assert stats['seconds'] >= 0.03
+    assert stats['rows'] == 3
+
+
+def test_parallel_stage_covers_pool_work(portfolio, profiling):
+    model, pathways = Runner.run_portfolio(portfolio, workers=2)
+    stages = profiling.report()['stages']
+    assert stages['evaluate_parallel']['calls'] == 1
+    assert stages['evaluate_parallel']['seconds'] > 0
+    assert stages['evaluate_parallel']['rows'] > 0
+    assert stages['evaluate_parallel']['seconds'] <= stages['Model.apply_interventions']['seconds']
+
+
+def test_row_count_of_deltas(portfolio, profiling):
+    model, pathways = Runner.run_portfolio(portfolio, deltas=True)
+    expected = (len(pathways.base) + sum(len(frame) for frame in pathways.full.values())
+                + sum(len(frame) for frame in pathways.deltas.values()))
+    assert row_count(pathways) == expected > len(pathways)
+    assert profiling.report()['stages']['Model.apply_interventions']['rows'] == expected
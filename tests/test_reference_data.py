@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the binary cache of workbook sheets and the deferred loading of the reference tables
+"""
+
+import os
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import ReferenceData as data
+
+
+def write_workbook(path, frames: dict):
+    with pd.ExcelWriter(path) as writer:
+        for sheet_name, df in frames.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+
+
+def test_cached_read_matches_workbook(tmp_path):
+    path = str(tmp_path / 'book.xlsx')
+    frame = pd.DataFrame({'UID': ['a', 'b'], 'Value': [1.5, 2.5]})
+    write_workbook(path, {'Sheet': frame})
+
+    first = data.read_excel_cached(path, sheet_name='Sheet', index_col=0)
+    assert_frame_equal(first, pd.read_excel(path, sheet_name='Sheet', index_col=0))
+    cached = os.listdir(tmp_path / '.cache')
+    assert len(cached) == 1
+    assert_frame_equal(data.read_excel_cached(path, sheet_name='Sheet', index_col=0), first)
+    assert os.listdir(tmp_path / '.cache') == cached
+
+    # Other read options are keyed apart; a changed workbook replaces its stale copy
+    assert_frame_equal(data.read_excel_cached(path, sheet_name='Sheet'), frame)
+    write_workbook(path, {'Sheet': frame.assign(Value=[3.5, 4.5])})
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10**9))
+    changed = data.read_excel_cached(path, sheet_name='Sheet', index_col=0)
+    assert changed['Value'].tolist() == [3.5, 4.5]
+    assert len(os.listdir(tmp_path / '.cache')) == 1
+
+
+def test_cache_dir_keeps_workbook_folder_clean(tmp_path):
+    inputs, cache = tmp_path / 'inputs', tmp_path / 'cache'
+    os.makedirs(inputs)
+    path = str(inputs / 'book.xlsx')
+    write_workbook(path, {'Sheet': pd.DataFrame({'Value': [1, 2]})})
+    data.read_excel_cached(path, sheet_name='Sheet', cache_dir=str(cache))
+    assert os.listdir(inputs) == ['book.xlsx']
+    assert len(os.listdir(cache)) == 1
+
+
+def test_reference_tables_load_on_first_access():
+    default = data.Default_Factors(data.default_factors.filepath)
+    assert default._default is None
+    table = default.default
+    assert default.default is table
+    assert_frame_equal(table, data.default_factors.default)
+    assert not table.to_numpy().flags.writeable
+
+    missing = data.Default_Factors('no such folder/Emissions Factors.xlsx')  # only read when used
+    assert missing._default is None
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the model registry bounds the models it holds, and that evicted models reload
+equal to those evicted
+"""
+
+import os
+import threading
+import time
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+import Synthetic
+from Registry import ModelRegistry, build_model, model_nbytes
+
+
+@pytest.fixture(scope='module')
+def portfolios():
+    return {f"client{i}": Synthetic.generate_portfolio(60, seed=i) for i in range(4)}
+
+
+class CountingBuild:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.count = 0
+
+    def __call__(self, source):
+        self.count += 1
+        time.sleep(self.delay)
+        return build_model(source)
+
+
+def test_byte_budget_evicts_and_spilled_models_reload(portfolios, tmp_path):
+    build = CountingBuild()
+    first = build_model(portfolios['client0'])
+    registry = ModelRegistry(max_models=10, max_bytes=int(model_nbytes(first) * 2.5),
+                             spill_dir=str(tmp_path), build=build)
+    models = {portfolio_id: registry.get(portfolio_id, source) for portfolio_id, source in portfolios.items()}
+    assert build.count == len(portfolios)
+    assert 1 <= len(registry) < len(portfolios)
+    assert registry.nbytes <= registry.max_bytes
+    # The least recently used were evicted, and spilled
+    assert [key[0] for key in registry.keys()] == list(portfolios)[-len(registry):]
+    assert len(os.listdir(tmp_path)) == len(portfolios) - len(registry)
+
+    reloaded = registry.get('client0', portfolios['client0'])
+    assert build.count == len(portfolios)  # read from the spill directory, not rebuilt
+    assert reloaded is not models['client0']
+    assert_frame_equal(reloaded.scenario_pathway_data, models['client0'].scenario_pathway_data)
+    assert_frame_equal(reloaded.scenario_consumption_data, models['client0'].scenario_consumption_data)
+    assert_frame_equal(reloaded.scenario_impact_data, models['client0'].scenario_impact_data)
+    assert 'client0' in registry
+
+
+def test_changed_portfolio_replaces_its_model(portfolios, tmp_path):
+    registry = ModelRegistry(max_models=1, spill_dir=str(tmp_path))
+    registry.get('client1', portfolios['client1'])
+    registry.get('client2', portfolios['client2'])
+    assert len(os.listdir(tmp_path)) == 1
+
+    changed = {sheet: df.copy() for sheet, df in portfolios['client1'].items()}
+    changed['Assets'].loc[0, 'Area'] += 1
+    registry.get('client1', changed)
+    # The spilled model of the old contents is dropped with them
+    assert [name for name in os.listdir(tmp_path) if name.startswith('client1')] == []
+
+
+def test_concurrent_requests_share_one_build(portfolios):
+    build = CountingBuild(delay=0.2)
+    registry = ModelRegistry(max_models=2, build=build)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get('client3', portfolios['client3'])))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert build.count == 1
+    assert len(results) == 6 and all(model is results[0] for model in results)
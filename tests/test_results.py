@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the pre-aggregated result stores against direct computation over asset-level rows
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Results import ResultCube, weighted_quantiles
+
+years = list(range(2020, 2026))
+
+
+def long_results(sizes: dict, seed: int = 0) -> pd.DataFrame:
+    """
+    Long-format results for groups of the given sizes, keyed by (Country Code, Sector Code),
+    in one scenario and pathway type
+    """
+    rng = np.random.default_rng(seed)
+    parts = []
+    for (country, sector), n in sizes.items():
+        intensity = rng.lognormal(3, 0.5, (n, len(years))) * np.linspace(1, 0.6, len(years))
+        area = rng.uniform(500, 20000, n).round()
+        parts.append(pd.DataFrame(intensity * area[:, None], columns=years)
+                     .assign(Scenario='BAU', UID=[f"{country}{sector}{i:05d}" for i in range(n)],
+                             **{'Pathway Code': 'GHG-Int', 'Country Code': country, 'Sector Code': sector},
+                             Area=area))
+    return pd.concat(parts, ignore_index=True)
+
+
+def exact_quantiles(results: pd.DataFrame, quantiles, mask=None) -> pd.DataFrame:
+    results = results if mask is None else results[mask]
+    intensity = results[years].div(results['Area'], axis=0)
+    return pd.DataFrame({year: weighted_quantiles(intensity[year].to_numpy(), results['Area'].to_numpy(), quantiles)
+                         for year in years}, index=quantiles)
+
+
+@pytest.fixture(scope='module')
+def results():
+    return long_results({('GB', 'OFF'): 40, ('GB', 'HOT'): 64, ('FR', 'OFF'): 700, ('DE', 'RHS'): 1500})
+
+
+def test_totals_and_intensities_match_groupby(results):
+    cube = ResultCube(results)
+    for countries, sectors in [(None, None), (['GB'], None), (['GB', 'FR'], ['OFF']), (None, ['RHS'])]:
+        mask = pd.Series(True, index=results.index)
+        if countries is not None:
+            mask &= results['Country Code'].isin(countries)
+        if sectors is not None:
+            mask &= results['Sector Code'].isin(sectors)
+        expected = results[mask].groupby('Scenario')[[*years, 'Area']].sum()
+        totals = cube.totals(['BAU'], 'GHG-Int', countries, sectors)
+        pd.testing.assert_frame_equal(totals, expected, check_names=False)
+        pd.testing.assert_frame_equal(cube.intensities(['BAU'], 'GHG-Int', countries, sectors),
+                                      expected[years].div(expected['Area'], axis=0), check_names=False)
+
+    assets = results['UID'].iloc[::5]
+    expected = results[results['UID'].isin(assets)].groupby('Scenario')[[*years, 'Area']].sum()
+    pd.testing.assert_frame_equal(cube.totals(['BAU'], 'GHG-Int', assets=assets), expected, check_names=False)
+
+
+def test_small_groups_are_exact(results):
+    cube = ResultCube(results)
+    quantiles = (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95)
+    for country, sector in [('GB', 'OFF'), ('GB', 'HOT')]:
+        bands = cube.bands(['BAU'], 'GHG-Int', [country], [sector], quantiles=quantiles).loc['BAU']
+        mask = (results['Country Code'] == country) & (results['Sector Code'] == sector)
+        expected = exact_quantiles(results, quantiles, mask)
+        np.testing.assert_allclose(bands.iloc[1:-1].to_numpy(dtype=float), expected.to_numpy(), rtol=1e-12)
+        intensity = results[mask][years].div(results[mask]['Area'], axis=0)
+        np.testing.assert_allclose(bands.loc['min'].to_numpy(dtype=float), intensity.min().to_numpy())
+        np.testing.assert_allclose(bands.loc['max'].to_numpy(dtype=float), intensity.max().to_numpy())
+
+
+def test_merged_groups_within_sketch_tolerance(results):
+    cube = ResultCube(results)
+    quantiles = np.array([0.1, 0.25, 0.5, 0.75, 0.9])
+    # Each centroid covers at most 1/sketch_size of its group's weight, so merged quantiles are
+    # within that share of the exact ones, by rank
+    slack = 1 / ResultCube.sketch_size
+    for countries in [None, ['FR', 'DE'], ['GB', 'DE']]:
+        bands = cube.bands(['BAU'], 'GHG-Int', countries, quantiles=quantiles).loc['BAU'].iloc[1:-1]
+        mask = None if countries is None else results['Country Code'].isin(countries)
+        lower = exact_quantiles(results, np.clip(quantiles - slack, 0, 1), mask)
+        upper = exact_quantiles(results, np.clip(quantiles + slack, 0, 1), mask)
+        assert (bands.to_numpy(dtype=float) >= lower.to_numpy() * (1 - 1e-12)).all()
+        assert (bands.to_numpy(dtype=float) <= upper.to_numpy() * (1 + 1e-12)).all()
+
+
+def test_asset_filter_is_exact(results):
+    cube = ResultCube(results)
+    assets = results['UID'].iloc[::9]
+    quantiles = (0.25, 0.5, 0.75)
+    bands = cube.bands(['BAU'], 'GHG-Int', assets=assets, quantiles=quantiles).loc['BAU']
+    expected = exact_quantiles(results, quantiles, results['UID'].isin(assets))
+    np.testing.assert_allclose(bands.iloc[1:-1].to_numpy(dtype=float), expected.to_numpy(), rtol=1e-12)
+
+
+@pytest.fixture(scope='module')
+def stranding_runs(portfolio):
+    import Runner
+
+    # Targets loosened so that some pathways strand late, and some never
+    scale = 4.0
+    model, pathways = Runner.run_portfolio(portfolio)
+    pathways = pathways.copy()
+    targets = pathways.index.get_level_values('Scenario') == 'Target'
+    pathways.loc[targets] = pathways.loc[targets] * scale
+    _, deltas = Runner.run_portfolio(portfolio, deltas=True)
+    deltas.full['Target'] = deltas.full['Target'] * scale
+    return pathways, deltas
+
+
+def naive_stranding(pathways: pd.DataFrame) -> pd.Series:
+    targets = pathways.xs('Target', level='Scenario')
+    stranding = {}
+    for (scenario, uid, path_type), values in pathways.iterrows():
+        if scenario == 'Target':
+            continue
+        target = targets.loc[(uid, path_type)]
+        stranding[scenario, uid, path_type] = next((year for year in pathways.columns if values[year] > target[year]),
+                                                   np.nan)
+    return pd.Series(stranding, dtype=float)
+
+
+def test_stranding_matches_naive_loop(stranding_runs):
+    from Results import StrandingIndex
+
+    pathways, _ = stranding_runs
+    index = StrandingIndex.from_results(pathways.reset_index())
+    expected = naive_stranding(pathways)
+    got = index.summary['Stranding Year']
+    got.index = got.index.to_flat_index()
+    assert expected.notna().any() and expected.isna().any() and expected.nunique() > 2
+    pd.testing.assert_series_equal(got.reindex(expected.index).astype(float), expected, check_names=False)
+
+    for (scenario, path_type), group in expected.groupby(level=[0, 2]):
+        for year in [2018, 2025, 2035, 2051]:
+            naive = sorted(uid for (_, uid, _), stranding in group.items() if stranding < year)
+            assert sorted(index.stranding_before(year, scenario, path_type)) == naive
+
+
+def test_stranding_from_deltas_matches_results(stranding_runs):
+    from Results import StrandingIndex
+
+    pathways, deltas = stranding_runs
+    from_results = StrandingIndex.from_results(pathways.reset_index())
+    from_deltas = StrandingIndex.from_deltas(deltas)
+    pd.testing.assert_frame_equal(from_deltas.summary.sort_index(), from_results.summary.sort_index(),
+                                  check_index_type=False, check_categorical=False, check_dtype=False)
+    assert from_deltas.sorted.keys() == from_results.sorted.keys()
+    for key in from_results.sorted:
+        for year in [2018, 2030, 2051]:
+            assert (sorted(from_deltas.stranding_before(year, *key))
+                    == sorted(from_results.stranding_before(year, *key)))
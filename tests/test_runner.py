@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that persisted results are shared between runs and guarded by the run lock
+"""
+
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import Runner
+import Synthetic
+
+
+class Waiting(Exception):
+    pass
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    path = str(tmp_path / 'portfolio.xlsx')
+    Synthetic.write_portfolio(Synthetic.generate_portfolio(20, seed=1), path)
+    return path
+
+
+def lock_path(input_file: str) -> str:
+    target = Runner.results_path(input_file)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return f"{target}.lock"
+
+
+def hold_lock(path: str, owner: str):
+    with open(path, 'w') as f:
+        f.write(owner)
+
+
+def wait_once(stage: str, fraction: float):
+    if stage.startswith('Waiting'):
+        raise Waiting
+
+
+def test_lock_of_dead_process_is_broken(input_file):
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    hold_lock(lock_path(input_file), f"{socket.gethostname()} {dead.pid}")
+
+    store = Runner.open_results(input_file, progress=wait_once, poll=0)
+    assert store.exists()
+    assert not os.path.exists(lock_path(input_file))
+    assert Runner.open_results(input_file, progress=wait_once).read().equals(store.read())
+
+
+def test_lock_of_running_process_is_kept(input_file):
+    path = lock_path(input_file)
+    hold_lock(path, f"{socket.gethostname()} {os.getpid()}")
+    with pytest.raises(Waiting):
+        Runner.open_results(input_file, progress=wait_once, poll=0, stale_after=0)
+
+    # A lock from another host is only broken once stale
+    hold_lock(path, f"elsewhere.invalid {os.getpid()}")
+    with pytest.raises(Waiting):
+        Runner.open_results(input_file, progress=wait_once, poll=0)
+    assert Runner.open_results(input_file, progress=wait_once, poll=0, stale_after=0).exists()
+
+
+def test_lock_removed_by_another_process(input_file, monkeypatch):
+    run_portfolio = Runner.run_portfolio
+
+    def run_and_lose_lock(*args, **kwargs):
+        os.remove(lock_path(input_file))
+        return run_portfolio(*args, **kwargs)
+
+    monkeypatch.setattr(Runner, 'run_portfolio', run_and_lose_lock)
+    assert Runner.open_results(input_file).exists()
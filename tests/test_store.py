@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that results written to a ResultStore read back whole and filtered, and that rewriting
+a store never leaves readers without one
+"""
+
+import os
+import threading
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import pathwayFunctions as path
+import Runner
+from Store import ResultStore
+
+keys = ['Scenario', 'Pathway Code', 'UID']
+
+
+@pytest.fixture(scope='module')
+def run(portfolio):
+    model, pathways = Runner.run_portfolio(portfolio)
+    expected = (pathways.pipe(path.attach_asset_data, portfolio['Assets'], ['Country Code', 'Sector Code', 'Area'])
+                        .reset_index())
+    return model, pathways, expected
+
+
+def normalised(df: pd.DataFrame, columns) -> pd.DataFrame:
+    df = df[list(columns)].astype({column: str for column in ['Scenario', 'Pathway Code', 'UID',
+                                                              'Country Code', 'Sector Code']})
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('file_format', ['parquet', 'ipc'])
+def test_round_trip_with_filters(run, tmp_path, file_format):
+    model, pathways, expected = run
+    store = model.write_results(str(tmp_path / 'store'), pathways, file_format=file_format)
+    assert_frame_equal(normalised(store.read(), expected.columns), normalised(expected, expected.columns),
+                       check_dtype=False)
+
+    country, sector = expected[['Country Code', 'Sector Code']].iloc[0]
+    selections = [{'scenarios': ['BAU', 'Scenario 1']},
+                  {'countries': [country]},
+                  {'sectors': [sector]},
+                  {'scenarios': ['Scenario 2'], 'path_types': ['GHG-Int'], 'countries': [country],
+                   'sectors': [sector], 'years': [2025, 2030]}]
+    columns = {'scenarios': 'Scenario', 'path_types': 'Pathway Code', 'countries': 'Country Code',
+               'sectors': 'Sector Code'}
+    for selection in selections:
+        mask = pd.Series(True, index=expected.index)
+        for argument, column in columns.items():
+            if argument in selection:
+                mask &= expected[column].astype(str).isin(selection[argument])
+        selected = [column for column in expected.columns
+                    if not isinstance(column, int) or column in selection.get('years', [column])]
+        got = store.read(**selection)
+        assert len(got) == mask.sum() > 0
+        assert_frame_equal(normalised(got, selected), normalised(expected[mask], selected), check_dtype=False)
+
+    impacts = store.read('impacts', index=True)
+    assert len(impacts) == len(model.scenario_impact_data)
+
+
+def test_rewrite_keeps_a_store_for_readers(run, tmp_path):
+    model, pathways, expected = run
+    root = str(tmp_path / 'store')
+    model.write_results(root, pathways, file_format='ipc')
+    before = ResultStore(root).read()
+
+    failures = []
+    stop = threading.Event()
+
+    def read_continuously():
+        while not stop.is_set():
+            try:
+                assert len(ResultStore(root).read(scenarios=['BAU'])) > 0
+            except Exception as error:
+                failures.append(error)
+
+    reader = threading.Thread(target=read_continuously)
+    reader.start()
+    try:
+        for _ in range(5):
+            model.write_results(root, pathways, file_format='ipc')
+    finally:
+        stop.set()
+        reader.join()
+    assert failures == []
+
+    # Only the current and previous versions are kept
+    versions = [entry for entry in os.listdir(root) if entry.startswith('v')]
+    assert len(versions) == 2
+    assert ResultStore(root).read().shape == before.shape
+
+
+def test_rewrite_replaces_unversioned_store(run, tmp_path):
+    model, pathways, expected = run
+    root = tmp_path / 'store'
+    os.makedirs(root / 'pathways')
+    (root / 'store.json').write_text('{}')
+    store = model.write_results(str(root), pathways)
+    assert sorted(entry for entry in os.listdir(root) if not entry.startswith('v')) == [ResultStore.pointer]
+    assert len(store.read()) == len(expected)
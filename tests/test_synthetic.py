@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that generated portfolios run end to end
+"""
+
+import pytest
+
+import Runner
+import Synthetic
+
+
+@pytest.mark.parametrize('n_assets', [10, 50, 200])
+@pytest.mark.parametrize('seed', range(6))
+def test_generated_portfolio_runs(n_assets, seed):
+    portfolio = Synthetic.generate_portfolio(n_assets, seed=seed)
+    rollouts = portfolio['Rollouts']
+    assert (rollouts['Installations per year'] >= 1).all()
+
+    model, pathways = Runner.run_portfolio(Runner.ingest(portfolio))
+    assert set(pathways.index.unique('Scenario')) >= {'BAU', *portfolio['Interventions']['Scenario']}
+    impacts = model.scenario_impact_data
+    assert impacts.empty or impacts['Year'].max() <= 2050